@@ -2,28 +2,42 @@
 # -*- coding: utf-8 -*-
 """
 模式：KF 私聊为主 + 欢迎语兜底（欢迎语只发一次）
+- 回调只解密、入队（jobs 表），立即返回 success；后台 worker 处理入群任务
 - 新人入群 → 创建 Pass2U → 先KF私聊发专属链接
 - KF失败 → 仅在该用户该场景未发过欢迎语时，用欢迎语模板发一次固定文案
-- 记录所有结果到 SQLite（bot.db）
+- 记录所有结果到存储（默认本地 SQLite bot.db；STORAGE_URL 指向 PostgreSQL 时多节点共享）
+- create_app() 为应用工厂；开发 `python app.py`，生产 `gunicorn -c gunicorn.conf.py wsgi:application`
 """
 
-import os, json, sqlite3
-from datetime import datetime
+import atexit, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree as ET
-from flask import Flask, request, abort, jsonify, send_from_directory
-from dotenv import load_dotenv
+from flask import Flask, Response, request, abort, jsonify, send_from_directory
+import env  # 先加载 .env
 from wechatpy.enterprise.crypto import WeChatCrypto
 from wechatpy.exceptions import InvalidSignatureException
 
-from wecom_api import WeComAPI
-from pass2u_api import create_pass2u_link, Pass2UError
-try:
-    from pass2u_api import create_pass2u_raw   # 若你实现了原始返回
-except Exception:
-    create_pass2u_raw = None  # type: ignore
+from wecom_api import API_BASE, WeComAPI, is_throttled
+from ratelimit import ThrottledError, jittered_backoff
+from db import Database
+from jobqueue import JobQueue
+import inventory
+import pass_pool
+from redelivery import PendingMinter, Redeliverer
+from dedup import EventDedup, event_key, signature_key
+from cache import TTLCache
+import search
+from served import ServedCache
+from journal import Journal
+from retention import Retention
+from storage import open_storage
+import eventlog
+import metrics
+from metrics import timed
+from pass2u_api import get_client as get_pass2u_client, extract_link, Pass2UError, Pass2UCircuitOpen
+from pass2u_api import breaker as pass2u_breaker
 
 # -------------------- 配置 --------------------
-load_dotenv()
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 app = Flask(__name__)
 
@@ -35,146 +49,129 @@ PORT = int(os.getenv("PORT", "8000"))
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:8000")
 VERIFY_FILENAME = os.getenv("WECOM_VERIFY_FILENAME", "WW_verify_example.txt")
 WELCOME_TPL_ID = os.getenv("WECOM_GROUP_WELCOME_TEMPLATE_ID", "")  # 有值才会启用兜底欢迎语
-
-crypto = WeChatCrypto(TOKEN, ENCODING_AES_KEY, CORP_ID)
-api = WeComAPI()
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "4"))           # 后台处理入群任务的线程数
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))  # 执行中自动续租
+MEMBER_CONCURRENCY = int(os.getenv("MEMBER_CONCURRENCY", "8"))  # 同一事件内并发处理的成员数上限
+PASS_POOL_ENABLED = os.getenv("PASS_POOL_ENABLED", "0") == "1"   # 预铸券池：入群优先从本地库存领取
+PASS_POOL_LOW = int(os.getenv("PASS_POOL_LOW", "50"))
+PASS_POOL_HIGH = int(os.getenv("PASS_POOL_HIGH", "200"))
+PASS_POOL_INTERVAL = float(os.getenv("PASS_POOL_INTERVAL", "10"))
+REDELIVERY_ENABLED = os.getenv("REDELIVERY_ENABLED", "1") == "1"  # KF 失败的行后台补发
+REDELIVERY_MAX_ATTEMPTS = int(os.getenv("REDELIVERY_MAX_ATTEMPTS", "8"))
+REDELIVERY_MAX_AGE_HOURS = float(os.getenv("REDELIVERY_MAX_AGE_HOURS", "48"))
+REDELIVERY_INTERVAL = float(os.getenv("REDELIVERY_INTERVAL", "30"))
+REDELIVERY_BATCH = int(os.getenv("REDELIVERY_BATCH", "50"))
+DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", "3600"))  # 回调去重窗口
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "10000"))
+REJOIN_POLICY = os.getenv("REJOIN_POLICY", "reuse")  # 已送达过的成员再次入群：reuse 不再发 / resend 重发原券 / mint 新建券
+SERVED_CACHE_SIZE = int(os.getenv("SERVED_CACHE_SIZE", "50000"))
+SERVED_FILTER_CAPACITY = int(os.getenv("SERVED_FILTER_CAPACITY", "1000000"))
+SERVED_EXCLUSIVE = os.getenv("SERVED_EXCLUSIVE", "0") == "1"  # 单进程部署且没有 CLI 同时写库时才可置 1
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", os.path.join(BASE_DIR, "journal"))  # 解密后的回调事件日志；置空关闭
+JOURNAL_SEGMENT_MB = int(os.getenv("JOURNAL_SEGMENT_MB", "64"))
+JOURNAL_FSYNC_INTERVAL = float(os.getenv("JOURNAL_FSYNC_INTERVAL", "1"))
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "0") == "1"  # 已送达老数据整行归档，主表留瘦行
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "90"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "1000"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", os.path.join(BASE_DIR, "bot_archive.db"))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))  # 退出时等待在途任务的秒数
+WARM_UP_TIMEOUT = float(os.getenv("WARM_UP_TIMEOUT", "10"))  # 预热最多等待的秒数（须明显小于 gunicorn timeout）
+STORAGE_URL = os.getenv("STORAGE_URL", "")  # 空：本地 SQLite；postgresql://…：多节点共享 PostgreSQL
+ADMIN_STATS_TTL = float(os.getenv("ADMIN_STATS_TTL", "2"))  # /admin/stats 响应缓存秒数
+
+# 由 create_app() 创建：导入模块本身不读密钥、不建出站会话
+crypto: WeChatCrypto | None = None
+api: WeComAPI | None = None
 
 # -------------------- DB --------------------
 DB_PATH = os.path.join(BASE_DIR, "bot.db")
-
-def db_conn():
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    return con
+db = Database(DB_PATH)  # 每线程长连接 + WAL；写操作走 db.transaction()
+store = open_storage(STORAGE_URL, db)  # assignments / 库存 / 去重；SQLite 时与任务队列共用 bot.db
+jobs = JobQueue(db, max_attempts=JOB_MAX_ATTEMPTS, lease_seconds=JOB_LEASE_SECONDS)
+pool_filler = pass_pool.PassPoolFiller(get_pass2u_client, store, low=PASS_POOL_LOW, high=PASS_POOL_HIGH,
+                                      interval=PASS_POOL_INTERVAL, ready=lambda: pass2u_breaker.state != "open")
+dedup = EventDedup(store, ttl=DEDUP_TTL_SECONDS, maxsize=DEDUP_CACHE_SIZE)
+served = ServedCache(store, maxsize=SERVED_CACHE_SIZE, capacity=SERVED_FILTER_CAPACITY,
+                     exclusive=SERVED_EXCLUSIVE)
+journal = Journal(JOURNAL_DIR, segment_bytes=JOURNAL_SEGMENT_MB << 20,
+                  fsync_interval=JOURNAL_FSYNC_INTERVAL) if JOURNAL_DIR else None
+retention = Retention(db, ARCHIVE_DB_PATH, keep_days=RETENTION_DAYS, batch_size=RETENTION_BATCH,
+                      interval=RETENTION_INTERVAL)
 
 def init_db():
-    with db_conn() as con:
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS assignments(
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          external_userid TEXT NOT NULL,
-          chat_id TEXT,
-          link TEXT NOT NULL,
-          notes TEXT,
-          delivered INTEGER DEFAULT 0,
-          created_at TEXT NOT NULL
-        );
-        """)
-    ensure_schema()
-
-def ensure_schema():
-    """补充列 & 建幂等索引（external_userid+scene）"""
-    with db_conn() as con:
-        cols = {r[1] for r in con.execute("PRAGMA table_info(assignments)")}
-        def add(col, typ="TEXT", default_sql=None):
-            if col not in cols:
-                sql = f"ALTER TABLE assignments ADD COLUMN {col} {typ}"
-                if default_sql is not None:
-                    sql += f" DEFAULT {default_sql}"
-                con.execute(sql)
-
-        # pass 结果
-        add("scene")
-        add("pass_id")
-        add("model_id")
-        add("barcode_message")
-        add("download_url")
-        add("expiration_date")
-        add("created_time")
-        add("raw_resp")
-
-        # 欢迎语只发一次
-        add("gw_sent", "INTEGER", 0)
-        add("gw_sent_at")
-
-        con.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS
-            idx_assignments_user_scene
-            ON assignments (external_userid, COALESCE(scene,''))
-        """)
+    store.init_schema()  # assignments / 去重 / 库存
+    jobs.init_db()       # 本地任务队列
 
 def log_pass_creation(external_userid: str, chat_id: str | None, scene: str,
                       download_url: str | None, resp: dict | None):
     """创建/更新一条（幂等：相同 external_userid+scene）"""
-    pass_id = (resp or {}).get("passId")
-    model_id = (resp or {}).get("modelId")
-    barcode_message = (resp or {}).get("barcodeMessage")
-    expiration_date = (resp or {}).get("expirationDate")
-    created_time = (resp or {}).get("createdTime")
-    raw_json = json.dumps(resp or {}, ensure_ascii=False)
-
-    with db_conn() as con:
-        con.execute("""
-          INSERT INTO assignments (
-            external_userid, chat_id, link, notes, delivered, created_at,
-            scene, pass_id, model_id, barcode_message, download_url,
-            expiration_date, created_time, raw_resp
-          )
-          VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-          ON CONFLICT(external_userid, scene) DO UPDATE SET
-            link=excluded.link,
-            pass_id=excluded.pass_id,
-            model_id=excluded.model_id,
-            barcode_message=excluded.barcode_message,
-            download_url=excluded.download_url,
-            expiration_date=excluded.expiration_date,
-            created_time=excluded.created_time,
-            raw_resp=excluded.raw_resp
-        """, (
-            external_userid, chat_id, download_url or "", "pass2u_api",
-            datetime.utcnow().isoformat(),
-            scene, pass_id, str(model_id or ""), barcode_message, download_url or "",
-            expiration_date, created_time, raw_json
-        ))
+    store.upsert_assignment(external_userid, chat_id, scene, download_url, resp)
+    served.remember(external_userid, scene, download_url)
 
 def mark_delivered_by_user_scene(external_userid: str, scene: str):
-    with db_conn() as con:
-        con.execute("UPDATE assignments SET delivered=1 WHERE external_userid=? AND COALESCE(scene,'')=?",
-                    (external_userid, scene))
-
-def is_welcome_sent(external_userid: str, scene: str) -> bool:
-    with db_conn() as con:
-        cur = con.cursor()
-        cur.execute("SELECT gw_sent FROM assignments WHERE external_userid=? AND COALESCE(scene,'')=?",
-                    (external_userid, scene))
-        row = cur.fetchone()
-        return bool(row and row[0] == 1)
+    store.mark_delivered(external_userid, scene)
+    served.mark_delivered(external_userid, scene)
+
+def schedule_redelivery(external_userid: str, scene: str, delay: float):
+    """KF 失败：放入补发队列（已在队列中的保持原计划）"""
+    store.schedule_redelivery(external_userid, scene, time.time() + delay)
 
 def mark_welcome_sent(external_userid: str, scene: str):
-    with db_conn() as con:
-        con.execute("UPDATE assignments SET gw_sent=1, gw_sent_at=? WHERE external_userid=? AND COALESCE(scene,'')=?",
-                    (datetime.utcnow().isoformat(), external_userid, scene))
+    store.mark_welcome_sent(external_userid, scene)
 
-# -------------------- 业务 --------------------
-def create_pass_and_log(external_userid: str, chat_id: str, scene: str) -> str | None:
-    """创建Pass；写库；返回直链（可能为None）"""
-    extras = {"scene": scene, "chat_id": chat_id}
+def enqueue_job(kind: str, payload: dict):
+    jobs.enqueue(kind, payload)
 
-    # 若你实现了 create_pass2u_raw，优先用它拿完整返回
-    if callable(create_pass2u_raw):
+# -------------------- 业务 --------------------
+def create_pass(external_userid: str, chat_id: str, scene: str) -> tuple[str | None, dict | None]:
+    """只调用 Pass2U，不写库；返回 (直链, 原始返回)，失败返回 (None, None)"""
+    if PASS_POOL_ENABLED:
         try:
-            resp = create_pass2u_raw(external_userid, extras)  # type: ignore
-            link = resp.get("downloadUrl") or resp.get("url") or resp.get("link")
-            log_pass_creation(external_userid, chat_id, scene, link, resp)
-            return link
+            claimed = pass_pool.claim(store, external_userid, chat_id)
         except Exception as e:
-            print("[Pass2U RAW 失败]", e)
+            claimed = None
+            eventlog.error("pass_pool_claim_failed", exc=e)
+        pool_filler.kick()
+        if claimed:
+            return claimed
 
-    # 否则使用 link 版本
+    # 券池关闭或已空：实时创建
+    extras = {"scene": scene, "chat_id": chat_id}
     try:
-        link = create_pass2u_link(external_userid, extras)
-        log_pass_creation(external_userid, chat_id, scene, link, None)
-        return link
+        client = get_pass2u_client()
+        resp = client.create_pass_raw(external_userid, extras)
+        return extract_link(resp, client.base), resp
+    except ThrottledError:
+        raise  # 限流：交给任务队列延后重试，不写空占位
+    except Pass2UCircuitOpen:
+        pass   # 熔断中：不等超时，直接降级
     except Pass2UError as e:
-        print("[Pass2U API 失败]", e)
+        eventlog.error("pass2u_failed", exc=e)
     except Exception as e:
-        print("[Pass2U 未知异常]", e)
+        eventlog.error("pass2u_unexpected", exc=e)
+    return None, None
 
+def create_pass_and_log(external_userid: str, chat_id: str, scene: str) -> str | None:
+    """创建Pass；写库；返回直链（可能为None）"""
     # 即便没拿到link，也要先写一条占位记录，避免后续欢迎语重复
-    log_pass_creation(external_userid, chat_id, scene, None, None)
-    return None
+    link, resp = create_pass(external_userid, chat_id, scene)
+    log_pass_creation(external_userid, chat_id, scene, link, resp)
+    return link
 
 # -------------------- 路由 --------------------
+# 每个请求一个 trace_id：回调入队时随任务落库，后台处理的日志沿用同一个 id
+@app.before_request
+def _bind_trace():
+    request.environ["eventlog.token"] = eventlog.bind(trace_id=eventlog.new_id())
+
+@app.teardown_request
+def _unbind_trace(_exc):
+    token = request.environ.pop("eventlog.token", None)
+    if token is not None:
+        eventlog.unbind(token)
+
 @app.get("/")
 def health():
     return "OK"
@@ -189,20 +186,82 @@ def wecom_domain_verify_file():
 
 # 管理接口（可选）
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+def require_admin():
+    if ADMIN_TOKEN and request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        abort(401)
+
+_stats_cache = TTLCache(maxsize=64, ttl=ADMIN_STATS_TTL)
+
 @app.get("/admin/stats")
 def admin_stats():
-    if ADMIN_TOKEN and request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+    """计数来自触发器维护的 assignment_stats，不扫 assignments 全表；结果短暂缓存"""
+    require_admin()
+    days = min(request.args.get("days", default=30, type=int), 366)
+    chats = min(request.args.get("chats", default=50, type=int), 1000)
+    cached = _stats_cache.get((days, chats))
+    if cached is not None:
+        return jsonify(cached)
+    body = {**store.assignment_stats(days, chats),
+            "redelivery_backlog": redeliverer.backlog(),
+            "pass2u_breaker": pass2u_breaker.snapshot(),
+            "inventory": store.inventory_stats()}
+    _stats_cache.set((days, chats), body)
+    return jsonify(body)
+
+# 查询：?external_userid= / chat_id= / pass_id= / since= / until= / delivered= ，cursor 为上一页的 next_cursor
+@app.get("/admin/assignments")
+def admin_assignments():
+    require_admin()
+    try:
+        return jsonify(store.search_assignments(request.args,
+                                                cursor=request.args.get("cursor", type=int),
+                                                limit=request.args.get("limit", default=100, type=int)))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+# 单条的 Pass2U 原始返回（按需解压）
+@app.get("/admin/assignments/<int:assignment_id>/raw")
+def admin_assignment_raw(assignment_id: int):
+    require_admin()
+    resp = store.load_raw(assignment_id)
+    if resp is None:
+        abort(404)
+    return jsonify(resp)
+
+# 导出：过滤条件同上，?format=ndjson|csv，分块流式输出
+@app.get("/admin/assignments/export")
+def admin_assignments_export():
+    require_admin()
+    args = request.args.to_dict()
+    fmt = args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"error": "format 只能是 ndjson 或 csv"}), 400
+    try:
+        search.build_where(args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(store.export_assignments(args, fmt), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=assignments.{fmt}"})
+
+# 库存导入：请求体即 CSV，边读边写，不整体载入内存
+@app.post("/admin/inventory/import")
+def admin_inventory_import():
+    require_admin()
+    batch = request.args.get("batch", default=inventory.IMPORT_BATCH_SIZE, type=int)
+    try:
+        counts = inventory.import_binary_stream(request.stream, store.insert_inventory, batch_size=batch)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(counts)
+
+# Prometheus 指标（METRICS_TOKEN 有值时需 Authorization: Bearer <token>）
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+@app.get("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
         abort(401)
-    with db_conn() as con:
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM assignments")
-        total = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM assignments WHERE delivered=1")
-        delivered = cur.fetchone()[0]
-        cur.execute("""SELECT id, external_userid, scene, link, pass_id, delivered, created_at
-                       FROM assignments ORDER BY id DESC LIMIT 20""")
-        last20 = [dict(r) for r in cur.fetchall()]
-    return jsonify({"total": total, "delivered": delivered, "undelivered": total - delivered, "last20": last20})
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # --- 企业微信：GET 验证 ---
 @app.get("/wecom/callback")
@@ -221,54 +280,323 @@ def wecom_verify():
 # --- 企业微信：事件回调（POST） ---
 @app.post("/wecom/callback")
 def wecom_events():
+    msg_signature = request.args.get("msg_signature")
+    timestamp = request.args.get("timestamp")
+    nonce = request.args.get("nonce")
+
+    # 原样重推的密文：不解密直接确认
+    sig_key = signature_key(msg_signature, timestamp, nonce)
+    if dedup.seen(sig_key):
+        callback_counter.inc(("duplicate",))
+        eventlog.success("callback", result="duplicate")
+        return "success"
+
     try:
-        msg = crypto.decrypt_message(
-            request.data,
-            request.args.get("msg_signature"),
-            request.args.get("timestamp"),
-            request.args.get("nonce"),
-        )
+        with timed("callback_decrypt"):
+            msg = crypto.decrypt_message(request.data, msg_signature, timestamp, nonce)
     except InvalidSignatureException:
+        callback_counter.inc(("bad_signature",))
+        eventlog.warning("callback", result="bad_signature", remote=request.remote_addr)
         abort(403)
 
-    root = ET.fromstring(msg)
+    with timed("xml_parse"):
+        root = ET.fromstring(msg)
     event = root.findtext("Event")
     change_type = root.findtext("ChangeType")
+    chat_id = root.findtext("ChatId")
+    eus = [n.text for n in root.findall(".//ExternalUserID") if n is not None and n.text]
+    if journal is not None:
+        journal.append({"ts": time.time(), "event": event, "change_type": change_type, "chat_id": chat_id,
+                        "members": eus, "create_time": root.findtext("CreateTime"), "xml": msg})
 
     if event == "change_external_chat" and change_type == "add_member":
-        chat_id = root.findtext("ChatId")
-        scene = "wecom_group_join"
-        eus = [n.text for n in root.findall(".//ExternalUserID") if n is not None]
-
-        for eu in eus:
-            # 1) 创建专属券 & 落库
-            link = create_pass_and_log(eu, chat_id, scene)
-
-            # 2) KF 私聊发专属链接（有无链接都可发：没有就简短文案引导）
-            if link:
-                text = f"欢迎加入 Cityheroes Billiards！这是你的专属卡券：\n{link}\n打开即可添加到 Wallet。"
-            else:
-                text = "欢迎加入 Cityheroes Billiards！请私聊我领取专属新人礼～"
-
-            kf = api.kf_send_text(eu, text)
-
-            if isinstance(kf, dict) and kf.get("errcode") in (0, None):
-                mark_delivered_by_user_scene(eu, scene)
-            else:
-                # 3) KF失败 → 兜底：仅在未发过欢迎语且配置了模板ID时，发一次群欢迎语
-                if WELCOME_TPL_ID and not is_welcome_sent(eu, scene):
-                    gw = api.send_group_welcome(chat_id, eu)
-                    if isinstance(gw, dict) and gw.get("errcode") == 0:
-                        mark_welcome_sent(eu, scene)
-                    else:
-                        # 选填：打印“开启会话链接”，方便人工引导
-                        start_url = api.kf_add_contact_url(eu, scene="pass2u")
-                        print(f"[欢迎语失败] eu={eu} gw={gw} start_url={start_url}")
-
+        ev_key = event_key(chat_id, change_type, eus, root.findtext("CreateTime"))
+        if eus and dedup.claim(ev_key):
+            # 只落库任务，耗时调用交给后台 worker（企业微信 5 秒内收不到响应会重试）
+            try:
+                jobs.enqueue("add_member", {
+                    "chat_id": chat_id,
+                    "scene": "wecom_group_join",
+                    "members": eus,
+                })
+            except Exception:
+                dedup.forget(ev_key)
+                raise
+            callback_counter.inc(("enqueued",))
+            eventlog.success("callback", result="enqueued", chat_id=chat_id, members=len(eus))
+        elif eus:
+            callback_counter.inc(("duplicate",))
+            eventlog.success("callback", result="duplicate", chat_id=chat_id, members=len(eus))
+
+    dedup.claim(sig_key)
     return "success"
 
-# ---- 启动 ----
+# -------------------- 后台任务 --------------------
+def welcome_text(link: str | None) -> str:
+    if link:
+        return f"欢迎加入 Cityheroes Billiards！这是你的专属卡券：\n{link}\n打开即可添加到 Wallet。"
+    return "欢迎加入 Cityheroes Billiards！请私聊我领取专属新人礼～"
+
+_member_pool = ThreadPoolExecutor(max_workers=MEMBER_CONCURRENCY, thread_name_prefix="member")
+
+def process_member(eu: str, chat_id: str, scene: str, writes: list, reuse_link: bool = False):
+    """
+    单个新成员：建券 → KF 私聊 → 欢迎语兜底；写库操作追加到 writes，由调用方统一提交
+    reuse_link：重试时沿用上次已建好的券，避免重复调用 Pass2U
+    """
+    # 1) 专属券：发过且已送达的按 REJOIN_POLICY 处理；发过未送达 / 重试沿用原券；否则新建（落库延后）
+    link = None
+    prev = served.lookup(eu, scene)
+    if prev:
+        link, delivered = prev
+        if delivered and not reuse_link:
+            if REJOIN_POLICY == "reuse":
+                return
+            if REJOIN_POLICY == "mint":
+                link = None
+    if not link:
+        link, resp = create_pass(eu, chat_id, scene)
+        writes.append((log_pass_creation, (eu, chat_id, scene, link, resp)))
+
+    # 2) KF 私聊发专属链接（有无链接都可发：没有就简短文案引导）
+    kf = api.kf_send_text(eu, welcome_text(link))
+    if is_throttled(kf):
+        raise ThrottledError(f"kf_send_text throttled: {kf}")
+
+    if isinstance(kf, dict) and kf.get("errcode") in (0, None):
+        eventlog.success("kf_sent", has_link=bool(link))
+        if link:
+            writes.append((mark_delivered_by_user_scene, (eu, scene)))
+        elif REDELIVERY_ENABLED:
+            # 只发了“私聊领取”文案：券由补发线程稍后补建并私聊
+            writes.append((schedule_redelivery, (eu, scene, redeliverer.next_delay(0))))
+    else:
+        # KF失败 → 进补发队列，稍后重试私聊（用户开启会话后即可送达）
+        eventlog.warning("kf_send_failed", resp=kf, has_link=bool(link))
+        if REDELIVERY_ENABLED:
+            writes.append((schedule_redelivery, (eu, scene, redeliverer.next_delay(0))))
+        # 3) KF失败 → 兜底：仅在未发过欢迎语且配置了模板ID时，发一次群欢迎语
+        if WELCOME_TPL_ID and not store.is_welcome_sent(eu, scene):
+            gw = api.send_group_welcome(chat_id, eu)
+            if is_throttled(gw):
+                raise ThrottledError(f"send_group_welcome throttled: {gw}")
+            if isinstance(gw, dict) and gw.get("errcode") == 0:
+                writes.append((mark_welcome_sent, (eu, scene)))
+            else:
+                # 选填：“开启会话链接”方便人工引导；不在入群链路上同步取，交给任务队列
+                eventlog.warning("group_welcome_failed", resp=gw)
+                writes.append((enqueue_job, ("kf_contact_url", {"external_userid": eu, "scene": "pass2u"})))
+
+def _run_member(eu: str, chat_id: str, scene: str, reuse_link: bool) -> tuple[list, Exception | None]:
+    """单成员错误隔离：异常不影响同一事件里的其他人，已产生的写操作照常提交"""
+    writes: list = []
+    with eventlog.trace(member_trace=eventlog.new_id(), eu=eu, chat_id=chat_id):
+        try:
+            with eventlog.span("member", reuse_link=reuse_link):
+                process_member(eu, chat_id, scene, writes, reuse_link=reuse_link)
+            return writes, None
+        except Exception as e:
+            return writes, e  # span 已记录
+
+def apply_writes(writes: list):
+    """同一事件的所有写操作放在一个事务里提交（helper 内的 store.transaction() 并入外层）"""
+    if not writes:
+        return
+    with store.transaction():
+        for fn, args in writes:
+            fn(*args)
+
+# 可延后重放的写操作：参数都能 JSON 序列化，按函数名落进任务队列
+_DEFERRABLE_WRITES = {fn.__name__: fn for fn in (
+    log_pass_creation, mark_delivered_by_user_scene, schedule_redelivery, mark_welcome_sent, enqueue_job)}
+
+def defer_writes(writes: list):
+    """
+    提交失败（存储暂时不可用等）时把写操作单独入队重放：建券、私聊这些外部调用已经做完，
+    整个事件重试会重复建券、重复私聊
+    """
+    jobs.enqueue("apply_writes", {"writes": [[fn.__name__, list(args)] for fn, args in writes]})
+
+def handle_apply_writes(payload: dict):
+    apply_writes([(_DEFERRABLE_WRITES[name], tuple(args)) for name, args in payload["writes"]])
+
+jobs.register("apply_writes", handle_apply_writes)
+
+def handle_add_member(payload: dict):
+    chat_id = payload.get("chat_id")
+    scene = payload.get("scene") or "wecom_group_join"
+    members = payload.get("members") or []
+    reuse_link = bool(payload.get("reuse_link"))
+
+    run = eventlog.bound(_run_member)  # 成员线程沿用本任务的 trace_id
+    results = list(_member_pool.map(lambda eu: run(eu, chat_id, scene, reuse_link), members))
+    writes = [w for ws, _ in results for w in ws]
+    deferred = False
+    try:
+        apply_writes(writes)
+    except Exception as e:
+        eventlog.error("apply_writes_failed", exc=e, writes=len(writes))
+        defer_writes(writes)  # 入队也失败才让整个任务重试
+        deferred = True
+
+    failed = [(eu, err) for eu, (_, err) in zip(members, results) if err is not None]
+    if len(members) == 1 and failed and not deferred:
+        raise failed[0][1]  # 单成员任务交给队列按退避重试
+    # 写操作已转入重放任务时不能让本任务重试（会重复建券），失败成员同样单独重新入队
+    # 失败的成员单独重新入队（限流按建议延迟，否则抖动退避），避免整批重试导致成功者重复收到消息
+    for eu, err in failed:
+        delay = getattr(err, "retry_after", None) or jittered_backoff(1, base=jobs.retry_base)
+        jobs.enqueue("add_member", {"chat_id": chat_id, "scene": scene, "members": [eu], "reuse_link": True},
+                     delay=delay)
+
+jobs.register("add_member", handle_add_member)
+
+def handle_contact_url(payload: dict):
+    """欢迎语兜底失败后取 KF 会话链接（结果有缓存）；限流抛 ThrottledError 由队列延后重试"""
+    url = api.kf_add_contact_url(payload["external_userid"], scene=payload.get("scene") or "pass2u")
+    eventlog.info("kf_contact_url", eu=payload["external_userid"], start_url=url)
+
+jobs.register("kf_contact_url", handle_contact_url)
+
+def redeliver(row: dict) -> bool:
+    """补发一条 KF 私聊（券已建成的行；券没建成的由 mint_pending 负责）"""
+    kf = api.kf_send_text(row["external_userid"], welcome_text(row["link"]))
+    ok = isinstance(kf, dict) and kf.get("errcode") in (0, None)
+    if ok:
+        served.mark_delivered(row["external_userid"], row.get("scene"))
+    return ok
+
+def mint_pending(row: dict) -> bool:
+    """补建券（needs_mint=1）：建成即落库，再私聊专属链接；私聊失败转入补发队列"""
+    eu, chat_id, scene = row["external_userid"], row.get("chat_id"), row.get("scene") or ""
+    link, resp = create_pass(eu, chat_id, scene)
+    if not link:
+        return False
+    log_pass_creation(eu, chat_id, scene, link, resp)
+    try:
+        kf = api.kf_send_text(eu, welcome_text(link))
+    except Exception as e:
+        eventlog.warning("kf_send_failed", err=repr(e), has_link=True)
+        kf = None
+    if isinstance(kf, dict) and kf.get("errcode") in (0, None):
+        mark_delivered_by_user_scene(eu, scene)
+    elif REDELIVERY_ENABLED:
+        schedule_redelivery(eu, scene, 0)
+    return True
+
+redeliverer = Redeliverer(store, redeliver, batch_size=REDELIVERY_BATCH, interval=REDELIVERY_INTERVAL,
+                          max_attempts=REDELIVERY_MAX_ATTEMPTS, max_age_hours=REDELIVERY_MAX_AGE_HOURS)
+minter = PendingMinter(store, mint_pending, ready=lambda: pass2u_breaker.state != "open",
+                       batch_size=REDELIVERY_BATCH, interval=REDELIVERY_INTERVAL)
+
+# -------------------- 指标 --------------------
+callback_counter = metrics.register(metrics.Counter(
+    "wecom_pass2u_callbacks_total", "WeCom callbacks by outcome", ("result",)))
+metrics.register(metrics.Gauge(
+    "wecom_pass2u_jobs", "Jobs in the queue by status",
+    lambda: {(k,): v for k, v in jobs.depth().items()}, ("status",)))
+metrics.register(metrics.Gauge(
+    "wecom_pass2u_pass_pool_available", "Unassigned pre-minted passes",
+    lambda: store.count_unassigned(source=pass_pool.SOURCE)))
+metrics.register(metrics.Gauge(
+    "wecom_pass2u_redelivery_backlog", "Assignments waiting for KF redelivery", redeliverer.backlog))
+metrics.register(metrics.Gauge(
+    "wecom_pass2u_dedup_cache_entries", "In-memory callback dedup entries", lambda: len(dedup._mem)))
+metrics.register(metrics.Gauge(
+    "wecom_pass2u_pass2u_breaker_open", "Pass2U circuit breaker state (0 closed, 0.5 half-open, 1 open)",
+    lambda: {"closed": 0, "half_open": 0.5, "open": 1}[pass2u_breaker.state]))
+metrics.register(metrics.Gauge(
+    "wecom_pass2u_served_cache_entries", "In-memory served-member cache entries", lambda: len(served)))
+metrics.register(metrics.Gauge(
+    "wecom_pass2u_log_dropped", "Log records dropped because the log queue was full", eventlog.dropped))
+
+def warm_up(timeout: float = WARM_UP_TIMEOUT):
+    """
+    接流量前预热，最多等 timeout 秒；失败 / 超时只记录不阻止启动
+    - 出站（access_token、WeCom / Pass2U 连接池）在后台线程做，超时不等，做完的部分照样生效
+    - 热点查询在当前线程跑一遍：确认库可用、把常用页读进缓存（gthread 的请求线程各自建连接）
+    - 已发券缓存不在这里：served.start() 后台加载，就绪前 lookup 直接查库
+    """
+    t0 = time.monotonic()
+    deadline = t0 + timeout
+
+    def step(name, fn):
+        try:
+            fn()
+        except Exception as e:
+            eventlog.error("warm_up_failed", exc=e, step=name)
+
+    def left() -> float:
+        return max(0.5, deadline - time.monotonic())
+
+    def outbound():
+        step("access_token", api.access_token)
+        step("wecom 连接", lambda: api.s.head(API_BASE, timeout=left()))
+        step("pass2u 连接", lambda: (lambda c: c.s.head(c.base, timeout=left()))(get_pass2u_client()))
+
+    t = threading.Thread(target=outbound, name="warm-up", daemon=True)
+    t.start()
+    step("存储", store.warm_up)
+    t.join(max(0.0, deadline - time.monotonic()))
+    eventlog.info("warm_up", ms=round((time.monotonic() - t0) * 1000, 1), complete=not t.is_alive())
+
+def start_workers():
+    metrics.start_snapshots()
+    served.start()
+    jobs.start(WORKER_COUNT)
+    if PASS_POOL_ENABLED:
+        pool_filler.start()
+    minter.start()  # 与 REDELIVERY_ENABLED 无关：券没建成的行总要补建
+    if REDELIVERY_ENABLED:
+        redeliverer.start()
+    if RETENTION_ENABLED and not store.shared:
+        retention.start()  # 归档库是本地 SQLite 的做法；共享库由数据库侧做分区 / 清理
+
+_drained = False
+
+def drain(timeout: float = DRAIN_TIMEOUT):
+    """
+    优雅退出：停止领取新任务，等在途的入群任务做完，刷盘回调日志
+    超时仍未做完的任务留在队列里（running），租约到期后由本机其他进程或重启后重新领取
+    """
+    global _drained
+    if _drained:
+        return
+    _drained = True
+    deadline = time.monotonic() + timeout
+    pool_filler.stop()
+    retention.stop()
+    drained = jobs.stop(timeout)
+    redeliverer.stop(max(0.0, deadline - time.monotonic()))
+    minter.stop(max(0.0, deadline - time.monotonic()))
+    if journal is not None:
+        journal.close()
+    try:
+        metrics.write_snapshot()  # 退出前最后一次，已退出 worker 的计数仍计入 /metrics
+    except OSError as e:
+        eventlog.error("metrics_snapshot_failed", exc=e)
+    # 超时：剩余任务租约到期后重新领取
+    eventlog.info("drain", drained=drained)
+    eventlog.shutdown()
+
+def create_app(migrate: bool = True, serve: bool = True) -> Flask:
+    """
+    应用工厂：建出站客户端；migrate 时建表 / 迁移；serve 时建回调解密器、预热、启动后台线程
+    gunicorn 下迁移由 master 启动时做一次（gunicorn.conf.py），各 worker 只 serve
+    """
+    global crypto, api
+    if api is None:
+        api = WeComAPI()
+    if migrate:
+        init_db()
+    if serve and crypto is None:
+        crypto = WeChatCrypto(TOKEN, ENCODING_AES_KEY, CORP_ID)
+        warm_up()
+        start_workers()
+        atexit.register(drain)
+    return app
+
+# ---- 启动（开发）----
 if __name__ == "__main__":
-    init_db()
-    app.run(host="0.0.0.0", port=PORT)
+    create_app().run(host="0.0.0.0", port=PORT)
 
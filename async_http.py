@@ -0,0 +1,49 @@
+# async_http.py
+# -*- coding: utf-8 -*-
+"""
+异步出站 HTTP：AsyncWeComAPI 与 AsyncPass2UClient 共用一个 aiohttp 连接池
+- aiohttp 为可选依赖，只有用到异步客户端时才需要安装
+- 会话绑定事件循环：同一循环内复用，换循环（如多次 asyncio.run）自动新建
+"""
+
+import asyncio
+import os
+from typing import Optional
+
+import env  # 先加载 .env
+
+try:
+    import aiohttp
+except ImportError:  # 可选依赖
+    aiohttp = None
+
+HTTP_LIMIT = int(os.getenv("ASYNC_HTTP_LIMIT", "1000"))                    # 全部在途连接上限
+HTTP_LIMIT_PER_HOST = int(os.getenv("ASYNC_HTTP_LIMIT_PER_HOST", "200"))   # 单个域名在途连接上限
+
+_session: Optional["aiohttp.ClientSession"] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def require_aiohttp():
+    if aiohttp is None:
+        raise RuntimeError("aiohttp 未安装：pip install aiohttp（异步客户端需要）")
+
+
+def get_session() -> "aiohttp.ClientSession":
+    """当前事件循环的共享会话（须在协程内调用）"""
+    global _session, _session_loop
+    require_aiohttp()
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT, limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = _session_loop = None
@@ -0,0 +1,76 @@
+# bench/callbacks.py
+# -*- coding: utf-8 -*-
+"""
+生成签名 + 加密正确的 change_external_chat / add_member 回调（与真实企业微信推送同格式）
+
+    python bench/callbacks.py --members 20 > one_callback.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from wechatpy.enterprise.crypto import WeChatCrypto
+
+import env  # 先加载 .env（与 app 同一份配置）
+
+
+def make_crypto() -> WeChatCrypto:
+    """用与 app 相同的 WECHAT_TOKEN / WECHAT_ENCODING_AES_KEY / WECHAT_CORP_ID"""
+    return WeChatCrypto(os.getenv("WECHAT_TOKEN", ""), os.getenv("WECHAT_ENCODING_AES_KEY", ""),
+                        os.getenv("WECHAT_CORP_ID", ""))
+
+
+def event_xml(chat_id: str, members: list[str], create_time: int | None = None) -> str:
+    items = "".join(f"<Item><ExternalUserID><![CDATA[{m}]]></ExternalUserID></Item>" for m in members)
+    return (
+        "<xml>"
+        f"<ToUserName><![CDATA[{os.getenv('WECHAT_CORP_ID', '')}]]></ToUserName>"
+        "<FromUserName><![CDATA[sys]]></FromUserName>"
+        f"<CreateTime>{create_time or int(time.time())}</CreateTime>"
+        "<MsgType><![CDATA[event]]></MsgType>"
+        "<Event><![CDATA[change_external_chat]]></Event>"
+        f"<ChatId><![CDATA[{chat_id}]]></ChatId>"
+        "<ChangeType><![CDATA[add_member]]></ChangeType>"
+        f"<MemChangeList>{items}</MemChangeList>"
+        "</xml>"
+    )
+
+
+def build_callback(crypto: WeChatCrypto, chat_id: str, members: list[str],
+                   create_time: int | None = None) -> tuple[dict, bytes]:
+    """返回 (query 参数, 请求体)，直接 POST 到 /wecom/callback"""
+    nonce = uuid.uuid4().hex[:16]
+    timestamp = str(int(time.time()))
+    enc = crypto.encrypt_message(event_xml(chat_id, members, create_time), nonce, timestamp)
+    root = ET.fromstring(enc)
+    params = {
+        "msg_signature": root.findtext("MsgSignature"),
+        "timestamp": root.findtext("TimeStamp"),
+        "nonce": root.findtext("Nonce"),
+    }
+    return params, enc.encode("utf-8")
+
+
+def random_members(n: int, prefix: str = "wmBench") -> list[str]:
+    return [f"{prefix}{uuid.uuid4().hex[:20]}" for _ in range(n)]
+
+
+def main():
+    p = argparse.ArgumentParser(description="build one signed add_member callback")
+    p.add_argument("--chat", default="wrBenchChat")
+    p.add_argument("--members", type=int, default=1)
+    args = p.parse_args()
+    params, body = build_callback(make_crypto(), args.chat, random_members(args.members))
+    print(json.dumps({"params": params, "body": body.decode("utf-8")}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# bench/mock_servers.py
+# -*- coding: utf-8 -*-
+"""
+本地替身服务：企业微信 API + Pass2U 建券接口（压测用，不碰真实服务）
+
+    python bench/mock_servers.py --wecom-port 9001 --pass2u-port 9002 \
+        --latency-ms 80 --jitter-ms 40 --error-rate 0.01 --throttle-rate 0.02
+
+然后启动 app 时指向它们：
+    WECOM_API_BASE=http://127.0.0.1:9001/cgi-bin PASS2U_BASE=http://127.0.0.1:9002 python app.py
+
+GET /_stats 返回各路径的调用次数。
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class Behaviour:
+    def __init__(self, latency_ms: float = 50, jitter_ms: float = 20,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def hit(self, path: str) -> str:
+        """记一次调用，睡眠模拟延迟，返回 ok / error / throttle"""
+        with self._lock:
+            self.calls[path] += 1
+        delay = max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        time.sleep(delay)
+        r = random.random()
+        if r < self.throttle_rate:
+            return "throttle"
+        if r < self.throttle_rate + self.error_rate:
+            return "error"
+        return "ok"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive，贴近真实连接复用
+    behaviour: Behaviour
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> dict:
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+
+    def _send(self, status: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stats(self) -> bool:
+        if urlparse(self.path).path == "/_stats":
+            self._send(200, dict(self.behaviour.calls))
+            return True
+        return False
+
+
+class WeComHandler(_Handler):
+    def do_GET(self):
+        if self._stats():
+            return
+        path = urlparse(self.path).path
+        if path.endswith("/gettoken"):
+            self.behaviour.hit(path)
+            self._send(200, {"errcode": 0, "access_token": f"mock-{uuid.uuid4().hex}", "expires_in": 7200})
+        else:
+            self._send(404, {"errcode": 404, "errmsg": "not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        payload = self._body()
+        outcome = self.behaviour.hit(path)
+        if outcome == "throttle":
+            return self._send(200, {"errcode": 45009, "errmsg": "api freq out of limit"})
+        if outcome == "error":
+            return self._send(200, {"errcode": 95018, "errmsg": "send msg not allowed"})
+        if path.endswith("/kf/send_msg"):
+            self._send(200, {"errcode": 0, "errmsg": "ok", "msgid": payload.get("msgid")})
+        elif path.endswith("/kf/add_contact"):
+            self._send(200, {"errcode": 0, "errmsg": "ok", "url": f"https://work.weixin.qq.com/kfid/mock?u={payload.get('external_userid')}"})
+        elif path.endswith("/group_welcome_template/send"):
+            self._send(200, {"errcode": 0, "errmsg": "ok"})
+        elif path.endswith("/group_welcome_template/get"):
+            self._send(200, {"errcode": 0, "errmsg": "ok", "template_list": []})
+        elif path.endswith("/group_welcome_template/add"):
+            self._send(200, {"errcode": 0, "errmsg": "ok", "template_id": f"tpl-{uuid.uuid4().hex[:8]}"})
+        elif path.endswith("/group_welcome_template/del"):
+            self._send(200, {"errcode": 0, "errmsg": "ok"})
+        else:
+            self._send(404, {"errcode": 404, "errmsg": "not found"})
+
+
+class Pass2UHandler(_Handler):
+    def do_GET(self):
+        if not self._stats():
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        payload = self._body()
+        if not (path.startswith("/v2/models/") and path.endswith("/passes")):
+            return self._send(404, {"error": "not found"})
+        outcome = self.behaviour.hit(path)
+        if outcome == "throttle":
+            return self._send(429, {"error": "too many requests"})
+        if outcome == "error":
+            return self._send(503, {"error": "service unavailable"})
+        pass_id = uuid.uuid4().hex
+        self._send(200, {
+            "passId": pass_id,
+            "modelId": path.split("/")[3],
+            "barcodeMessage": (payload.get("barcode") or {}).get("message"),
+            "createdTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "downloadUrl": f"http://{self.headers.get('Host')}/v2/passes/{pass_id}/download",
+        })
+
+
+def serve(handler_cls, port: int, behaviour: Behaviour, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """后台线程启动一个替身服务；port=0 取随机端口（srv.server_port）"""
+    cls = type(handler_cls.__name__, (handler_cls,), {"behaviour": behaviour})
+    srv = ThreadingHTTPServer((host, port), cls)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name=f"mock-{handler_cls.__name__}", daemon=True).start()
+    return srv
+
+
+def main():
+    p = argparse.ArgumentParser(description="WeCom / Pass2U mock servers")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--wecom-port", type=int, default=9001)
+    p.add_argument("--pass2u-port", type=int, default=9002)
+    p.add_argument("--latency-ms", type=float, default=50)
+    p.add_argument("--jitter-ms", type=float, default=20)
+    p.add_argument("--pass2u-latency-ms", type=float, help="Pass2U 单独的平均延迟（默认同 --latency-ms）")
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--throttle-rate", type=float, default=0.0)
+    args = p.parse_args()
+
+    wecom = Behaviour(args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate)
+    pass2u = Behaviour(args.pass2u_latency_ms or args.latency_ms, args.jitter_ms,
+                       args.error_rate, args.throttle_rate)
+    w = serve(WeComHandler, args.wecom_port, wecom, args.host)
+    s = serve(Pass2UHandler, args.pass2u_port, pass2u, args.host)
+    print(f"WECOM_API_BASE=http://{args.host}:{w.server_port}/cgi-bin")
+    print(f"PASS2U_BASE=http://{args.host}:{s.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# bench/run.py
+# -*- coding: utf-8 -*-
+"""
+回调压测驱动：按「每个回调的成员数 × 并发数」扫参，输出吞吐和延迟
+
+    # 1) 起替身服务
+    python bench/mock_servers.py --latency-ms 80
+    # 2) 起 app，指向替身
+    WECOM_API_BASE=http://127.0.0.1:9001/cgi-bin PASS2U_BASE=http://127.0.0.1:9002 python app.py
+    #    （多进程：同样的环境变量 + gunicorn -c gunicorn.conf.py wsgi:application）
+    # 3) 压测
+    python bench/run.py --url http://127.0.0.1:8000 --members 1,10,50 --concurrency 1,8,32 --events 200
+
+每组参数输出：
+- callback_eps / p50 / p99：回调接口本身（入队即返回）的吞吐与延迟
+- members_per_s：从第一条回调到队列排空，后台实际处理的成员数/秒
+- db_wait_p99：/metrics 里 db_* 阶段耗时的 p99 近似（SQLite 写锁竞争的代理指标）
+
+注意 app 默认出站限流 pass2u=10/1，测极限吞吐时启动 app 加 RATE_LIMITS="pass2u=1000/1,kf/send_msg=1000/1"
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from callbacks import build_callback, make_crypto, random_members
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def scrape(url: str, token: str | None) -> str:
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    r = requests.get(f"{url}/metrics", headers=headers, timeout=10)
+    r.raise_for_status()
+    return r.text
+
+
+def parse_metrics(text: str) -> dict:
+    """只取本脚本关心的几项：队列深度、db_* 直方图桶"""
+    jobs = 0.0
+    db_buckets: dict[float, float] = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        if name.startswith("wecom_pass2u_jobs{") and 'status="failed"' not in name:
+            jobs += float(value)
+        elif name.startswith("wecom_pass2u_stage_seconds_bucket{") and 'stage="db_' in name:
+            le = name.split('le="', 1)[1].split('"', 1)[0]
+            b = float("inf") if le == "+Inf" else float(le)
+            db_buckets[b] = db_buckets.get(b, 0) + float(value)
+    return {"jobs": jobs, "db_buckets": db_buckets}
+
+
+def bucket_delta(after: dict, before: dict) -> dict:
+    return {b: after[b] - before.get(b, 0) for b in after}
+
+
+def histogram_quantile(buckets: dict, q: float) -> float:
+    """按累计桶估算分位数（取桶上界）"""
+    if not buckets:
+        return 0.0
+    total = buckets.get(float("inf"), max(buckets.values()))
+    if total <= 0:
+        return 0.0
+    for b in sorted(buckets):
+        if buckets[b] >= q * total:
+            return b
+    return float("inf")
+
+
+def wait_drained(url: str, token: str | None, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if parse_metrics(scrape(url, token))["jobs"] == 0:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def run_case(url: str, crypto, members: int, concurrency: int, events: int,
+             token: str | None, drain_timeout: float) -> dict:
+    before = parse_metrics(scrape(url, token))
+    # 预先生成请求，签名/加密不计入延迟
+    chat = f"wrBench{uuid.uuid4().hex[:8]}"
+    prepared = [build_callback(crypto, chat, random_members(members)) for _ in range(events)]
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    latencies: list[float] = []
+    errors = 0
+
+    def post(item):
+        params, body = item
+        t0 = time.perf_counter()
+        r = session.post(f"{url}/wecom/callback", params=params, data=body, timeout=30)
+        return time.perf_counter() - t0, r.status_code == 200 and r.text == "success"
+
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        for dt, ok in ex.map(post, prepared):
+            latencies.append(dt)
+            errors += not ok
+    t_sent = time.perf_counter()
+    drained = wait_drained(url, token, drain_timeout)
+    t_done = time.perf_counter()
+
+    after = parse_metrics(scrape(url, token))
+    db = bucket_delta(after["db_buckets"], before["db_buckets"])
+    return {
+        "members": members,
+        "concurrency": concurrency,
+        "events": events,
+        "errors": errors,
+        "callback_eps": round(events / (t_sent - t_start), 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        "members_per_s": round(events * members / (t_done - t_start), 1),
+        "drained": drained,
+        "db_wait_p99_s": histogram_quantile(db, 0.99),
+    }
+
+
+def int_list(s: str) -> list[int]:
+    return [int(x) for x in s.split(",") if x.strip()]
+
+
+def main():
+    p = argparse.ArgumentParser(description="benchmark /wecom/callback")
+    p.add_argument("--url", default="http://127.0.0.1:8000")
+    p.add_argument("--members", type=int_list, default=[1, 10, 50], help="每个回调的成员数，逗号分隔")
+    p.add_argument("--concurrency", type=int_list, default=[1, 8, 32], help="并发连接数，逗号分隔")
+    p.add_argument("--events", type=int, default=200, help="每组参数发送的回调数")
+    p.add_argument("--metrics-token", default=None)
+    p.add_argument("--drain-timeout", type=float, default=300)
+    args = p.parse_args()
+
+    crypto = make_crypto()
+    for m in args.members:
+        for c in args.concurrency:
+            print(json.dumps(run_case(args.url, crypto, m, c, args.events,
+                                      args.metrics_token, args.drain_timeout)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# breaker.py
+# -*- coding: utf-8 -*-
+"""
+熔断器（按最近 N 次调用的失败率 / 慢调用率）
+- closed：正常放行，窗口内失败率或慢调用率超过阈值 → open
+- open：直接拒绝（调用方立即走降级），open_seconds 后 → half_open
+- half_open：只放行少量探测请求；探测成功 → closed，失败 → 再次 open
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import eventlog
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, window: int = 20, min_calls: int = 10, failure_rate: float = 0.5,
+                 slow_seconds: float = 5.0, slow_rate: float = 0.5, open_seconds: float = 30.0,
+                 probes: int = 1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self._calls: deque = deque(maxlen=window)  # (失败, 慢)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = 0
+        self._opens = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否放行本次调用；放行后必须调用 record() 或 release()"""
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._state, self._probing = HALF_OPEN, 0
+            if self._state == HALF_OPEN:
+                if self._probing >= self.probes:
+                    return False
+                self._probing += 1
+            return True
+
+    def release(self):
+        """放行的调用没有可计入的结果（如被限流）"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probing > 0:
+                self._probing -= 1
+
+    def record(self, ok: bool, seconds: float = 0.0):
+        slow = seconds >= self.slow_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probing = max(0, self._probing - 1)
+                if ok and not slow:
+                    self._state = CLOSED
+                    self._calls.clear()
+                else:
+                    self._trip()
+                return
+            if self._state == OPEN:
+                return  # 打开前已放行的调用，结果不再计入
+            self._calls.append((not ok, slow))
+            n = len(self._calls)
+            if n >= self.min_calls:
+                failures = sum(f for f, _ in self._calls)
+                slows = sum(s for _, s in self._calls)
+                if failures / n >= self.failure_rate or slows / n >= self.slow_rate:
+                    self._trip()
+
+    def _trip(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probing = 0
+        self._opens += 1
+        self._calls.clear()
+        eventlog.warning("breaker_open", name=self.name, probe_in=self.open_seconds)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN  # 下一次调用即探测
+            return self._state
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            n = len(self._calls)
+            retry_in: Optional[float] = None
+            if self._state == OPEN:
+                retry_in = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+            return {
+                "state": self._state,
+                "calls": n,
+                "failure_rate": round(sum(f for f, _ in self._calls) / n, 3) if n else 0.0,
+                "slow_rate": round(sum(s for _, s in self._calls) / n, 3) if n else 0.0,
+                "opens": self._opens,
+                "retry_in": round(retry_in, 1) if retry_in is not None else None,
+            }
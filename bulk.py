@@ -0,0 +1,124 @@
+# bulk.py
+# -*- coding: utf-8 -*-
+"""
+wecom.py 批量命令的执行器
+- 输入 CSV（表头）或 NDJSON（.ndjson / .jsonl），逐行读取，不整体载入内存
+- 共享一个 API 客户端（同一个 token），线程池并发；在途任务数有上限
+- 限频（errcode 45009 等 / 本地令牌不足）按抖动退避重试
+- 断点续跑：检查点文件逐行记录已成功的行号，重跑时跳过；失败的行不记，重跑时再试
+- 结果逐行写 NDJSON
+"""
+
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, Optional, TextIO
+
+from ratelimit import ThrottledError, jittered_backoff
+
+# 列名别名：统一成 user / chat / text / scene
+ALIASES = {"external_userid": "user", "chat_id": "chat", "content": "text"}
+
+
+def _normalize(row: Dict) -> Dict:
+    out = {}
+    for k, v in row.items():
+        if k is None:
+            continue
+        k = k.strip()
+        out[ALIASES.get(k, k)] = v.strip() if isinstance(v, str) else v
+    return out
+
+
+def read_rows(path: str) -> Iterator[Dict]:
+    """按扩展名识别 NDJSON，其余按 CSV；空行跳过"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            for line in f:
+                if line.strip():
+                    yield _normalize(json.loads(line))
+        else:
+            for r in csv.DictReader(f):
+                yield _normalize(r)
+
+
+class Checkpoint:
+    """已成功的行号，一行一个；每写一条就 flush，进程被杀也最多丢正在处理的几行"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.done: set[int] = set()
+        self._f: Optional[TextIO] = None
+        if path:
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    self.done = {int(x) for x in f if x.strip()}
+            self._f = open(path, "a", encoding="utf-8")
+
+    def mark(self, row_no: int):
+        if self._f:
+            self._f.write(f"{row_no}\n")
+            self._f.flush()
+
+    def close(self):
+        if self._f:
+            self._f.close()
+
+
+def _call(fn: Callable[[Dict], Dict], row: Dict, retries: int) -> Dict:
+    """执行单行；被限流时退避重试，其余异常记为失败"""
+    for attempt in range(retries + 1):
+        try:
+            return fn(row)
+        except ThrottledError as e:
+            if attempt == retries:
+                return {"ok": False, "error": f"throttled: {e}"}
+            time.sleep(e.retry_after or jittered_backoff(attempt + 1, base=1.0, cap=60))
+        except Exception as e:
+            return {"ok": False, "error": repr(e)}
+    return {"ok": False, "error": "unreachable"}
+
+
+def run(rows: Iterator[Dict], fn: Callable[[Dict], Dict], out: TextIO, checkpoint: Checkpoint,
+        concurrency: int = 8, retries: int = 3, progress=None) -> Dict[str, int]:
+    """
+    fn(row) -> {"ok": bool, ...}；限流时应抛 ThrottledError
+    返回 {rows, skipped, ok, failed}；skipped 为检查点中已成功的行，失败的行不进检查点
+    """
+    counts = {"rows": 0, "skipped": 0, "ok": 0, "failed": 0}
+    pending: Dict = {}
+
+    def collect(done):
+        for fut in done:
+            row_no, row = pending.pop(fut)
+            result = fut.result()
+            counts["ok" if result.get("ok") else "failed"] += 1
+            out.write(json.dumps({"row": row_no, **row, **result}, ensure_ascii=False) + "\n")
+            out.flush()
+            if result.get("ok"):
+                checkpoint.mark(row_no)
+        if progress:
+            progress(dict(counts))
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk") as ex:
+        for row_no, row in enumerate(rows, start=1):
+            counts["rows"] += 1
+            if row_no in checkpoint.done:
+                counts["skipped"] += 1
+                continue
+            pending[ex.submit(_call, fn, row, retries)] = (row_no, row)
+            if len(pending) >= concurrency * 4:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+    return counts
+
+
+def print_progress(c: Dict[str, int]):
+    print(f"\r已读 {c['rows']} 行：成功 {c['ok']}，失败 {c['failed']}，跳过 {c['skipped']}",
+          end="", file=sys.stderr, flush=True)
@@ -0,0 +1,121 @@
+# cache.py
+# -*- coding: utf-8 -*-
+"""
+进程内有界 LRU + TTL 缓存（线程安全）
+- PersistentTTLCache：同样的接口，另写一份到 SQLite，重启 / 其他进程（如 CLI）也能命中
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from db import Database
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            expire_at, value = item
+            if expire_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        expire_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class PersistentTTLCache(TTLCache):
+    """
+    内存 LRU 在前，SQLite 表在后（值需可 JSON 序列化）
+    - 内存未命中时查表，命中且未过期则回填内存
+    - 表按过期时间清理，并保持不超过 maxsize 行
+    """
+
+    def __init__(self, db: Database, table: str, maxsize: int = 10000, ttl: float = 3600,
+                 prune_every: int = 500):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.db = db
+        self.table = table
+        self.prune_every = prune_every
+        self._writes = 0
+        self.db.conn().execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expire_at REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def _dump_key(key: Hashable) -> str:
+        return json.dumps(key, ensure_ascii=False)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = super().get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        row = self.db.conn().execute(f"SELECT value, expire_at FROM {self.table} WHERE key=?",
+                                     (self._dump_key(key),)).fetchone()
+        if row is None or row[1] <= time.time():
+            return default
+        value = json.loads(row[0])
+        super().set(key, value, ttl=row[1] - time.time())
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        super().set(key, value, ttl=ttl)
+        con = self.db.conn()
+        con.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, expire_at) VALUES (?, ?, ?)",
+                    (self._dump_key(key), json.dumps(value, ensure_ascii=False), time.time() + ttl))
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self.prune()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        value = super().pop(key, default)
+        self.db.conn().execute(f"DELETE FROM {self.table} WHERE key=?", (self._dump_key(key),))
+        return value
+
+    def clear(self):
+        super().clear()
+        self.db.conn().execute(f"DELETE FROM {self.table}")
+
+    def prune(self):
+        con = self.db.conn()
+        con.execute(f"DELETE FROM {self.table} WHERE expire_at <= ?", (time.time(),))
+        con.execute(f"""
+            DELETE FROM {self.table} WHERE key IN (
+                SELECT key FROM {self.table} ORDER BY expire_at DESC LIMIT -1 OFFSET ?
+            )""", (self.maxsize,))
@@ -0,0 +1,107 @@
+# db.py
+# -*- coding: utf-8 -*-
+"""
+SQLite 连接管理
+- 每个线程一条长连接（复用连接和已编译语句，不再每次 helper 调用都 open/close）
+- WAL + busy_timeout：读写不互斥，写锁竞争时等待而不是直接报 database is locked
+- transaction() 是工作单元：可嵌套，只有最外层提交，内部 helper 的写操作随外层一起提交或回滚
+- 线程退出时其连接随线程局部存储一起回收并关闭（开发服务器每个请求一个线程，不能只增不减）
+"""
+
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Iterator
+
+import env  # 先加载 .env
+
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))   # 每条连接的页缓存
+SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")          # WAL 下 NORMAL 足够安全
+CACHED_STATEMENTS = 256
+
+
+class _Slot:
+    """线程局部存储里的连接持有者：线程退出后被回收，finalizer 关闭连接（sqlite3.Connection 不支持弱引用）"""
+    __slots__ = ("con", "__weakref__")
+
+    def __init__(self, con: sqlite3.Connection):
+        self.con = con
+
+
+def _close_quietly(con: sqlite3.Connection):
+    try:
+        con.close()
+    except sqlite3.Error:
+        pass
+
+
+class Database:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._all: "weakref.WeakSet[_Slot]" = weakref.WeakSet()  # 仍存活线程的连接，close() 时统一关闭
+        self._all_lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        con = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,  # autocommit；事务由 transaction() 显式控制
+            cached_statements=CACHED_STATEMENTS,
+            check_same_thread=False,  # 只在本线程使用；关闭时可能由其他线程调用
+        )
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")  # 只对新建的空库生效，须在切 WAL 之前；老库见 wecom.py db-compact
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        con.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+        con.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+        con.execute("PRAGMA temp_store=MEMORY")
+        return con
+
+    def conn(self) -> sqlite3.Connection:
+        """当前线程的长连接"""
+        slot = getattr(self._local, "slot", None)
+        if slot is None:
+            con = self._open()
+            slot = self._local.slot = _Slot(con)
+            weakref.finalize(slot, _close_quietly, con)
+            with self._all_lock:
+                self._all.add(slot)
+            self._local.depth = 0
+        return slot.con
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """工作单元：BEGIN IMMEDIATE … COMMIT；嵌套调用并入外层事务"""
+        con = self.conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield con
+            finally:
+                self._local.depth -= 1
+            return
+
+        con.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield con
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        else:
+            con.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        """关闭所有线程的连接（进程退出 / 测试清理）"""
+        with self._all_lock:
+            slots, self._all = list(self._all), weakref.WeakSet()
+        for slot in slots:
+            _close_quietly(slot.con)
+        self._local = threading.local()
@@ -0,0 +1,60 @@
+# dedup.py
+# -*- coding: utf-8 -*-
+"""
+回调幂等：企业微信响应慢时会重复推送同一事件
+- 先查进程内 LRU（微秒级），再查存储（跨进程 / 跨节点 / 重启后仍有效）
+- 首次出现的 key 用一条 upsert 抢占（过期记录可被覆盖），抢不到即为重复
+"""
+
+import hashlib
+import time
+from typing import Iterable, Optional
+
+from cache import TTLCache
+
+
+def event_key(chat_id: Optional[str], change_type: Optional[str],
+              members: Iterable[str], create_time: Optional[str]) -> str:
+    """事件身份：ChatId + ChangeType + 成员列表 + CreateTime"""
+    raw = "\x1f".join([chat_id or "", change_type or "", ",".join(sorted(members)), create_time or ""])
+    return "ev:" + hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def signature_key(msg_signature: Optional[str], timestamp: Optional[str], nonce: Optional[str]) -> str:
+    """原样重推的密文：msg_signature + timestamp + nonce 完全一致"""
+    return f"sig:{msg_signature or ''}:{timestamp or ''}:{nonce or ''}"
+
+
+class EventDedup:
+    def __init__(self, store, ttl: float = 3600, maxsize: int = 10000, prune_every: int = 1000):
+        self.store = store  # storage.Storage
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._mem = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inserts = 0
+
+    def seen(self, key: str) -> bool:
+        """只查询，不登记"""
+        if key in self._mem:
+            return True
+        seen = self.store.event_seen(key, time.time() - self.ttl)
+        if seen:
+            self._mem.set(key, True)
+        return seen
+
+    def claim(self, key: str) -> bool:
+        """首次出现返回 True 并登记；重复返回 False"""
+        if key in self._mem:
+            return False
+        now = time.time()
+        first = self.store.claim_event(key, now, now - self.ttl)  # 过期的旧记录视为不存在
+        self._inserts += 1
+        if self._inserts % self.prune_every == 0:
+            self.store.prune_events(now - self.ttl)
+        self._mem.set(key, True)
+        return first
+
+    def forget(self, key: str):
+        """处理失败时撤销登记，让重试可以再次进入"""
+        self._mem.pop(key)
+        self.store.forget_event(key)
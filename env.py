@@ -0,0 +1,13 @@
+# env.py
+# -*- coding: utf-8 -*-
+"""
+.env 只在这里加载一次（同目录，可选）：在模块顶层读配置的模块先 import env
+已存在的环境变量优先，不会被 .env 覆盖
+"""
+
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ENV_PATH = Path(__file__).with_name(".env")
+load_dotenv(dotenv_path=ENV_PATH)
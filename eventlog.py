@@ -0,0 +1,221 @@
+# eventlog.py
+# -*- coding: utf-8 -*-
+"""
+结构化事件日志（每行一个 JSON）
+- 调用方只组装一个 dict 放进有界队列，格式化和写文件都在后台监听线程；队列满时丢弃并计数，热路径不阻塞
+- trace(…) 把 trace_id / member_trace 等字段绑到当前上下文（contextvars），之后的每条记录自动带上
+  回调一个 trace_id，随任务 payload 传到后台 worker；每个成员再分一个 member_trace
+- 成功类记录（success / call 的成功）按 LOG_SAMPLE 采样；warning 及以上、失败的调用全部保留
+- LOG_FILE 有值时按大小轮转（LOG_MAX_MB × LOG_BACKUPS）；可含 {pid}，多进程部署每个 worker 各写一个文件
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+import env  # 先加载 .env
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "")           # 空：只写 stderr
+LOG_MAX_MB = int(os.getenv("LOG_MAX_MB", "50"))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_SAMPLE = float(os.getenv("LOG_SAMPLE", "0.1"))  # 成功记录的采样率（0~1）
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar("eventlog_context", default={})
+
+logger = logging.getLogger("wecom_pass2u")
+logger.propagate = False
+logger.setLevel(LOG_LEVEL)  # 导入即生效：级别判断在 setup() 之前，不能沿用 root 的 WARNING
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current(key: str) -> Optional[str]:
+    return _context.get().get(key)
+
+
+def bound(fn):
+    """把当前上下文带进线程池：返回的函数每次调用都在当前上下文的副本里执行"""
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.copy().run(fn, *a, **kw)
+
+
+def bind(**fields) -> contextvars.Token:
+    """同 trace()，用于无法包 with 的场景（如 Flask before_request）；配对调用 unbind(token)"""
+    return _context.set({**_context.get(), **{k: v for k, v in fields.items() if v is not None}})
+
+
+def unbind(token: contextvars.Token):
+    _context.reset(token)
+
+
+@contextmanager
+def trace(**fields):
+    """with trace(trace_id=…, member_trace=…):  范围内的记录都带上这些字段（值为 None 的不绑定）"""
+    token = bind(**fields)
+    try:
+        yield
+    finally:
+        unbind(token)
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {"ts": round(record.created, 3), "level": record.levelname.lower(), "event": record.msg,
+               **record.fields}
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+
+class _DropQueueHandler(logging.handlers.QueueHandler):
+    """有界队列：满了丢弃（计数）而不是阻塞或抛错；不在调用线程格式化"""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # 格式化留给监听线程
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: Optional[_DropQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+class _StderrHandler(logging.StreamHandler):
+    """每次写都取当前的 sys.stderr：被替换（pytest 捕获、重定向）后不会写进已关闭的旧流"""
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, _):
+        pass
+
+
+def _output_handlers() -> list:
+    fmt = _JsonFormatter()
+    handlers = []
+    if LOG_FILE:
+        path = LOG_FILE.format(pid=os.getpid())
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            path, maxBytes=LOG_MAX_MB << 20, backupCount=LOG_BACKUPS, encoding="utf-8"))
+    else:
+        handlers.append(_StderrHandler())
+    for h in handlers:
+        h.setFormatter(fmt)
+    return handlers
+
+
+def setup():
+    """首次写日志时自动调用；进程退出时 shutdown() 写完队列"""
+    global _handler, _listener
+    with _setup_lock:
+        if _handler is not None:
+            return
+        q: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(q, *_output_handlers(), respect_handler_level=False)
+        _listener.start()
+        _handler = _DropQueueHandler(q)
+        logger.addHandler(_handler)
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """停止监听线程（先写完队列里剩余的记录）"""
+    global _handler, _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for h in _listener.handlers:
+                h.close()
+        if _handler is not None:
+            logger.removeHandler(_handler)
+        _handler = _listener = None
+
+
+def dropped() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+
+def _emit(level: int, event: str, fields: dict, exc_info=None):
+    if not logger.isEnabledFor(level):
+        return
+    if _handler is None:
+        setup()
+    record = logger.makeRecord(logger.name, level, "", 0, event, (), exc_info)
+    record.fields = {**_context.get(), **fields}
+    logger.handle(record)
+
+
+def debug(event: str, **fields):
+    _emit(logging.DEBUG, event, fields)
+
+
+def info(event: str, **fields):
+    _emit(logging.INFO, event, fields)
+
+
+def success(event: str, **fields):
+    """成功路径的记录：按 LOG_SAMPLE 采样，在组装记录之前就决定，未采中几乎零开销"""
+    if LOG_SAMPLE >= 1 or random.random() < LOG_SAMPLE:
+        _emit(logging.INFO, event, fields)
+
+
+def warning(event: str, **fields):
+    _emit(logging.WARNING, event, fields)
+
+
+def error(event: str, exc: Optional[BaseException] = None, **fields):
+    """exc 给出时记录 err=repr(exc)；traceback 只在 LOG_LEVEL=DEBUG 时附上"""
+    if exc is not None:
+        fields["err"] = repr(exc)
+    exc_info = None
+    if exc is not None and logger.isEnabledFor(logging.DEBUG):
+        exc_info = (type(exc), exc, exc.__traceback__)
+    _emit(logging.ERROR, event, fields, exc_info)
+
+
+def call(target: str, seconds: float, ok: bool, **fields):
+    """一次出站调用的耗时：失败全部记录，成功按采样"""
+    fields = {"target": target, "ms": round(seconds * 1000, 1), "ok": ok, **fields}
+    if ok:
+        success("call", **fields)
+    else:
+        _emit(logging.WARNING, "call", fields)
+
+
+@contextmanager
+def span(event: str, **fields):
+    """with span("member"):  结束时记一条带耗时的记录：异常按 error 记（原样抛出），正常按 success 采样"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        error(event, exc=e, ms=round((time.perf_counter() - t0) * 1000, 1), **fields)
+        raise
+    success(event, ms=round((time.perf_counter() - t0) * 1000, 1), **fields)
@@ -0,0 +1,46 @@
+# gunicorn.conf.py
+# -*- coding: utf-8 -*-
+"""
+生产入口：gunicorn -c gunicorn.conf.py wsgi:application
+- master 启动时跑一次建表 / 迁移（子进程执行，master 自己不导入 app、不持有数据库连接）
+- gthread：每个 worker 用 threads 个线程处理请求，主循环照常心跳；/admin 导出 / 导入这类长请求
+  只占一个线程，既不会被 timeout 判死，也不会挡住同一 worker 上的回调
+- 多 worker 共享配额与指标：出站限流按 worker 数平分（RATE_LIMIT_PROCESSES），
+  /metrics 汇总 METRICS_MULTIPROC_DIR 下各 worker 的快照（master 启动时清空）
+- 每个 worker 导入 wsgi 时预热（access_token、出站连接池、热点语句）后才接流量；
+  预热在心跳开始前执行，上限 WARM_UP_TIMEOUT 默认取 timeout 的三分之一，慢依赖不会让 worker 被判超时
+- 退出（SIGTERM / 重启）时 worker 先停止接新请求，再排空在途的入群任务；超过 graceful_timeout 才被强杀
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import env  # 先加载 .env
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))  # gthread 下只管心跳，不限单个请求的耗时
+os.environ.setdefault("WARM_UP_TIMEOUT", str(timeout / 3))  # worker 由 master fork，继承环境变量
+os.environ.setdefault("RATE_LIMIT_PROCESSES", str(workers))
+os.environ.setdefault("METRICS_MULTIPROC_DIR",
+                      os.path.join(tempfile.gettempdir(), f"wecom_pass2u-metrics-{os.getenv('PORT', '8000')}"))
+graceful_timeout = int(float(os.getenv("DRAIN_TIMEOUT", "30"))) + 5
+preload_app = False  # 每个 worker 自己建连接 / 线程，fork 前不持有任何句柄
+
+
+def on_starting(server):
+    # 上一轮部署留下的指标快照不再代表当前进程，清掉重新计数
+    shutil.rmtree(os.environ["METRICS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["METRICS_MULTIPROC_DIR"], exist_ok=True)
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "wecom.py"),
+                    "db-migrate"], check=True)
+
+
+def worker_exit(server, worker):
+    import app
+    app.drain()
@@ -1,10 +1,14 @@
 # inventory.py
 import os
 import csv
+import io
 import sqlite3
-from datetime import datetime
+
+import eventlog
+from db import Database
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "coupons.db")
+_db = Database(DB_PATH)  # 本地库存库（SQLiteStorage）；读写见 storage.Storage
 
 DDL = """
 CREATE TABLE IF NOT EXISTS inventory (
@@ -20,113 +24,143 @@ CREATE TABLE IF NOT EXISTS inventory (
 CREATE INDEX IF NOT EXISTS idx_inventory_assigned ON inventory (assigned_to);
 """
 
+# 后加的列（老库 ALTER 补齐）
+EXTRA_COLUMNS = {
+    "source": "TEXT",    # csv / pass2u（预铸券池）
+    "pass_id": "TEXT",   # Pass2U passId
+    "raw_resp": "TEXT",  # Pass2U 创建返回
+}
+
+# 物化计数：按 source 分行，触发器增量维护，stats() 不再扫全表
+_STATS_APPLY = """
+    INSERT INTO inventory_stats (source, total, assigned, delivered)
+    VALUES (COALESCE({row}.source, ''), {sign}, {sign} * ({row}.assigned_to IS NOT NULL),
+            {sign} * ({row}.delivered IS 1))
+    ON CONFLICT (source) DO UPDATE SET
+        total = total + excluded.total,
+        assigned = assigned + excluded.assigned,
+        delivered = delivered + excluded.delivered;
+"""
+STATS_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS inventory_stats (
+        source TEXT PRIMARY KEY,
+        total INTEGER NOT NULL DEFAULT 0,
+        assigned INTEGER NOT NULL DEFAULT 0,
+        delivered INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_inventory_stats_insert AFTER INSERT ON inventory
+    BEGIN {_STATS_APPLY.format(sign=1, row="NEW")} END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_inventory_stats_delete AFTER DELETE ON inventory
+    BEGIN {_STATS_APPLY.format(sign=-1, row="OLD")} END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_inventory_stats_update
+    AFTER UPDATE OF source, assigned_to, delivered ON inventory
+    WHEN OLD.source IS NOT NEW.source OR (OLD.assigned_to IS NULL) != (NEW.assigned_to IS NULL)
+      OR OLD.delivered IS NOT NEW.delivered
+    BEGIN {_STATS_APPLY.format(sign=-1, row="OLD")} {_STATS_APPLY.format(sign=1, row="NEW")} END
+    """,
+]
+
 def _conn():
-    con = sqlite3.connect(DB_PATH, isolation_level=None)  # autocommit
-    con.row_factory = sqlite3.Row
-    return con
+    """当前线程的长连接（WAL，autocommit；事务用 _db.transaction()）"""
+    return _db.conn()
 
 def init_db():
     con = _conn()
-    try:
-        con.executescript(DDL)
-    finally:
-        con.close()
+    con.executescript(DDL)
+    cols = {r[1] for r in con.execute("PRAGMA table_info(inventory)")}
+    for col, typ in EXTRA_COLUMNS.items():
+        if col not in cols:
+            con.execute(f"ALTER TABLE inventory ADD COLUMN {col} {typ}")
+    # 未分配库存的部分索引：领取只扫描空闲行
+    con.execute("DROP INDEX IF EXISTS idx_inventory_source")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_inventory_free ON inventory (id) WHERE assigned_to IS NULL")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_inventory_free_source"
+                " ON inventory (source, id) WHERE assigned_to IS NULL")
+    _ensure_unique_link(con)
+    with _db.transaction() as tx:
+        fresh = not tx.execute("SELECT 1 FROM sqlite_master WHERE name='inventory_stats'").fetchone()
+        for sql in STATS_SQL:
+            tx.execute(sql)
+        if fresh:
+            rebuild_stats(tx)
 
-def import_csv(file_path: str) -> int:
-    """
-    导入 CSV：必须包含 download_link 列，passcode/notes 可选
-    """
-    init_db()
-    rows = []
-    with open(file_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        fields = set([c.strip() for c in (reader.fieldnames or [])])
-        if "download_link" not in fields:
-            raise ValueError("CSV 必须包含列: download_link")
-        for r in reader:
-            link = (r.get("download_link") or "").strip()
-            if not link:
-                continue
-            passcode = (r.get("passcode") or "").strip()
-            notes = (r.get("notes") or "").strip()
-            rows.append((link, passcode, notes, 0))
-
-    if not rows:
-        return 0
+def rebuild_stats(con):
+    """按 inventory 全量重算计数（需在写事务内调用）"""
+    con.execute("DELETE FROM inventory_stats")
+    con.execute("""
+        INSERT INTO inventory_stats (source, total, assigned, delivered)
+        SELECT COALESCE(source, ''), COUNT(*), SUM(assigned_to IS NOT NULL), SUM(delivered IS 1)
+        FROM inventory GROUP BY COALESCE(source, '')
+    """)
 
-    con = _conn()
+def _ensure_unique_link(con):
+    """download_link 唯一：重复导入直接跳过。老库先清掉未分配的重复行（保留最早一条）"""
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_inventory_link'").fetchone():
+        return
+    con.execute("""
+        DELETE FROM inventory
+        WHERE assigned_to IS NULL
+          AND id NOT IN (SELECT MIN(id) FROM inventory GROUP BY download_link)
+    """)
     try:
-        cur = con.cursor()
-        cur.executemany(
-            "INSERT INTO inventory (download_link, passcode, notes, delivered) VALUES (?, ?, ?, ?)",
-            rows
-        )
-        return cur.rowcount or 0
-    finally:
-        con.close()
-
-def assign_one(external_userid: str, chat_id: str | None):
+        con.execute("CREATE UNIQUE INDEX idx_inventory_link ON inventory (download_link)")
+    except sqlite3.IntegrityError:
+        # 已分配的记录中存在重复 download_link：建不了唯一索引，导入去重失效
+        eventlog.error("inventory_unique_index_failed")
+
+IMPORT_BATCH_SIZE = 5000
+
+def import_stream(f, insert, batch_size: int = IMPORT_BATCH_SIZE, progress=None, source: str = "csv") -> dict:
     """
-    分配一条未被占用的记录（FIFO）
-    使用单条 UPDATE 竞争，避免并发重复分配
+    流式导入 CSV（文本流）：必须包含 download_link 列，passcode/notes 可选
+    - 每 batch_size 行一个事务，内存占用与文件大小无关
+    - insert(batch) 写入一批 (download_link, passcode, notes, source) 并返回新增行数（Storage.insert_inventory）
+    - 唯一索引去重：重复的 download_link 计入 skipped
+    - 空链接计入 invalid；progress(counts) 在每批提交后回调
     """
-    init_db()
-    con = _conn()
-    try:
-        cur = con.cursor()
-        # 选一条未分配的
-        cur.execute("""
-            SELECT id, download_link, passcode
-            FROM inventory
-            WHERE assigned_to IS NULL
-            ORDER BY id ASC
-            LIMIT 1
-        """)
-        row = cur.fetchone()
-        if not row:
-            return None
-
-        now = datetime.utcnow().isoformat()
-        # 仅当仍未分配时更新（避免并发抢占）
-        cur.execute("""
-            UPDATE inventory
-            SET assigned_to = ?, assigned_chat_id = ?, assigned_at = ?
-            WHERE id = ? AND assigned_to IS NULL
-        """, (external_userid, chat_id, now, row["id"]))
-
-        if cur.rowcount == 0:
-            return None  # 被别的并发拿走了
-
-        return {"id": row["id"], "download_link": row["download_link"], "passcode": row["passcode"]}
-    finally:
-        con.close()
-
-def mark_delivered(inv_id: int):
-    con = _conn()
-    try:
-        con.execute("UPDATE inventory SET delivered=1 WHERE id=?", (inv_id,))
-    finally:
-        con.close()
+    reader = csv.DictReader(f)
+    reader.fieldnames = [c.strip() for c in (reader.fieldnames or [])]
+    if "download_link" not in reader.fieldnames:
+        raise ValueError("CSV 必须包含列: download_link")
 
-def lookup_by_id(inv_id: int):
-    con = _conn()
-    try:
-        cur = con.cursor()
-        cur.execute("SELECT * FROM inventory WHERE id=?", (inv_id,))
-        return cur.fetchone()
-    finally:
-        con.close()
+    counts = {"rows": 0, "inserted": 0, "skipped": 0, "invalid": 0}
 
-def stats():
-    con = _conn()
-    try:
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM inventory WHERE assigned_to IS NULL")
-        unassigned = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM inventory WHERE assigned_to IS NOT NULL")
-        assigned = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM inventory WHERE delivered=1")
-        delivered = cur.fetchone()[0]
-        return {"unassigned": unassigned, "assigned": assigned, "delivered": delivered}
-    finally:
-        con.close()
+    def flush(batch):
+        inserted = insert(batch)
+        counts["inserted"] += inserted
+        counts["skipped"] += len(batch) - inserted
+        if progress:
+            progress(dict(counts))
+
+    batch = []
+    for r in reader:
+        counts["rows"] += 1
+        link = (r.get("download_link") or "").strip()
+        if not link:
+            counts["invalid"] += 1
+            continue
+        passcode = (r.get("passcode") or "").strip()
+        notes = (r.get("notes") or "").strip()
+        batch.append((link, passcode, notes, source))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return counts
+
+def import_binary_stream(stream, insert, **kwargs) -> dict:
+    """字节流（如 HTTP 请求体）按 UTF-8 解码后流式导入"""
+    return import_stream(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""), insert, **kwargs)
+
+def import_csv(file_path: str, insert, batch_size: int = IMPORT_BATCH_SIZE, progress=None) -> dict:
+    """导入 CSV 文件，返回 {rows, inserted, skipped, invalid}"""
+    with open(file_path, newline="", encoding="utf-8-sig") as f:
+        return import_stream(f, insert, batch_size=batch_size, progress=progress)
@@ -0,0 +1,199 @@
+# jobqueue.py
+# -*- coding: utf-8 -*-
+"""
+持久化任务队列（SQLite）
+- 回调只负责入队，立即返回 success；耗时的 Pass2U / KF 调用交给后台 worker
+- 任务按租约（lease）领取，执行期间后台线程每 lease/3 续一次约：租约可以很短，
+  worker 崩溃、进程被杀或排空超时后，任务在一个租约内就会被重新领取
+- 失败按带抖动的指数退避重试，超过次数标记为 failed 保留现场
+- 异常带 retry_after（如限流）时按其延迟重新排队
+"""
+
+import json
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import eventlog
+from db import Database
+
+DDL = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending / running / failed（成功即删除）
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,              -- pending: 可执行时间；running: 租约到期时间
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (available_at, id) WHERE status != 'failed';
+"""
+
+
+class JobQueue:
+    def __init__(self, db: Database, max_attempts: int = 5, lease_seconds: float = 60,
+                 retry_base: float = 5.0, poll_interval: float = 1.0):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.retry_base = retry_base
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+        self._cv = threading.Condition()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._inflight: set[int] = set()  # 本进程正在执行的任务，由续约线程续租
+        self._inflight_lock = threading.Lock()
+        self._renew_stop = threading.Event()
+        self._renewer: Optional[threading.Thread] = None
+
+    def init_db(self):
+        self.db.conn().executescript(DDL)
+
+    def register(self, kind: str, handler: Callable[[Dict[str, Any]], None]):
+        self._handlers[kind] = handler
+
+    # ---------- 生产者 ----------
+    def enqueue(self, kind: str, payload: Dict[str, Any], delay: float = 0) -> int:
+        """当前上下文有 trace_id 时随 payload 一起落库，worker 执行时沿用"""
+        trace_id = eventlog.current("trace_id")
+        if trace_id and "trace_id" not in payload:
+            payload = {**payload, "trace_id": trace_id}
+        now = time.time()
+        cur = self.db.conn().execute(
+            "INSERT INTO jobs (kind, payload, status, attempts, available_at, created_at, updated_at)"
+            " VALUES (?, ?, 'pending', 0, ?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), now + delay, now, now),
+        )
+        job_id = cur.lastrowid
+        with self._cv:
+            self._cv.notify()
+        return job_id
+
+    # ---------- 消费者 ----------
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """单条 UPDATE … RETURNING 领取一条到期任务（pending 或租约过期的 running）"""
+        now = time.time()
+        rows = self.db.conn().execute("""
+            UPDATE jobs
+            SET status='running', attempts=attempts+1, available_at=?, updated_at=?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE status != 'failed' AND available_at <= ?
+                ORDER BY available_at, id
+                LIMIT 1
+            )
+            RETURNING id, kind, payload, attempts
+        """, (now + self.lease_seconds, now, now)).fetchall()
+        return rows[0] if rows else None
+
+    def _finish(self, job_id: int):
+        self.db.conn().execute("DELETE FROM jobs WHERE id=?", (job_id,))
+
+    def _fail(self, job_id: int, attempts: int, error: str, retry_after: Optional[float] = None):
+        now = time.time()
+        con = self.db.conn()
+        if attempts >= self.max_attempts:
+            con.execute("UPDATE jobs SET status='failed', last_error=?, updated_at=? WHERE id=?",
+                        (error, now, job_id))
+        else:
+            if retry_after is None:
+                retry_after = random.uniform(0.5, 1.0) * self.retry_base * (2 ** (attempts - 1))
+            retry_at = now + retry_after
+            con.execute("UPDATE jobs SET status='pending', available_at=?, last_error=?, updated_at=? WHERE id=?",
+                        (retry_at, error, now, job_id))
+
+    def _renew(self):
+        """给本进程在途的任务续租；已被别处改掉状态的任务不受影响"""
+        with self._inflight_lock:
+            ids = list(self._inflight)
+        if not ids:
+            return
+        now = time.time()
+        self.db.conn().execute(
+            f"UPDATE jobs SET available_at=?, updated_at=? WHERE status='running'"
+            f" AND id IN ({','.join('?' * len(ids))})",
+            (now + self.lease_seconds, now, *ids))
+
+    def _renew_loop(self):
+        while not self._renew_stop.wait(self.lease_seconds / 3):
+            try:
+                self._renew()
+            except sqlite3.Error as e:
+                eventlog.error("jobqueue_db_error", exc=e)
+
+    def run_one(self) -> bool:
+        """领取并执行一条任务；没有可执行任务返回 False"""
+        job = self._claim()
+        if job is None:
+            return False
+        with self._inflight_lock:
+            self._inflight.add(job["id"])
+        try:
+            self._execute(job)
+        finally:
+            with self._inflight_lock:
+                self._inflight.discard(job["id"])
+        return True
+
+    def _execute(self, job: sqlite3.Row):
+        handler = self._handlers.get(job["kind"])
+        try:
+            payload = json.loads(job["payload"])
+            trace_id = payload.get("trace_id") if isinstance(payload, dict) else None
+        except ValueError:
+            payload, trace_id = None, None  # 解析失败照常走 _fail()，不能让 worker 线程退出
+        with eventlog.trace(trace_id=trace_id or eventlog.new_id(), job_id=job["id"], job_kind=job["kind"]):
+            try:
+                if handler is None:
+                    raise RuntimeError(f"no handler for job kind {job['kind']!r}")
+                if not isinstance(payload, dict):
+                    raise ValueError(f"malformed payload for job {job['id']}")
+                handler(payload)
+            except Exception as e:
+                eventlog.error("job_failed", exc=e, attempts=job["attempts"])
+                self._fail(job["id"], job["attempts"], repr(e), getattr(e, "retry_after", None))
+            else:
+                self._finish(job["id"])
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                if self.run_one():
+                    continue
+            except sqlite3.Error as e:
+                eventlog.error("jobqueue_db_error", exc=e)
+            with self._cv:
+                self._cv.wait(self.poll_interval)
+
+    def start(self, workers: int):
+        if self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew_loop, name="jobqueue-lease", daemon=True)
+            self._renewer.start()
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"jobqueue-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float | None = None) -> bool:
+        """不再领取新任务，等在途任务做完；timeout 为所有线程合计的等待上限；返回是否全部退出"""
+        self._stop.set()
+        with self._cv:
+            self._cv.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in self._threads:
+            t.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        alive = [t for t in self._threads if t.is_alive()]
+        self._threads = alive
+        # 超时没做完的任务不再续租：进程退出后一个租约内由其他进程接手
+        self._renew_stop.set()
+        return not alive
+
+    def depth(self) -> Dict[str, int]:
+        rows = self.db.conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {r[0]: r[1] for r in rows}
@@ -0,0 +1,128 @@
+# journal.py
+# -*- coding: utf-8 -*-
+"""
+回调日志：解密后的每个事件追加写入 NDJSON 分段文件，供故障后重放 / 补数
+- append() 只入内存队列，回调线程不碰磁盘；后台线程成批写入
+- fsync 按时间批量做（默认每秒一次），进程崩溃最多丢最后一批
+- 单段超过 segment_bytes 即轮转；文件名 events-<时间>-<pid>-<序号>.ndjson，多进程互不干扰，按名排序即大致时间序
+- 读取时跳过写了一半的尾行
+"""
+
+import atexit
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+import eventlog
+
+_STOP = object()
+
+
+class Journal:
+    def __init__(self, directory: str, segment_bytes: int = 64 << 20, fsync_interval: float = 1.0,
+                 prefix: str = "events"):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.prefix = prefix
+        self._q: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._f = None
+        self._seq = 0
+        self._size = 0
+        self._last_sync = 0.0
+        self._dirty = False
+
+    def append(self, record: dict):
+        if self._thread is None:
+            self._start()
+        self._q.put(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    # ---------- 写线程 ----------
+    def _open_segment(self):
+        self._seq += 1
+        name = f"{self.prefix}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self._seq:04d}.ndjson"
+        self._f = open(os.path.join(self.directory, name), "a", encoding="utf-8")
+        self._size = 0
+
+    def _sync(self):
+        if self._f and self._dirty:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            try:
+                item = self._q.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                self._sync()
+                continue
+            batch = []
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                try:
+                    item = self._q.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    eventlog.error("journal_write_failed", exc=e, records=len(batch))
+            if stop or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+        if self._f:
+            self._f.close()
+
+    def _write(self, lines: list):
+        if self._f is None or self._size >= self.segment_bytes:
+            if self._f:
+                self._sync()
+                self._f.close()
+            self._open_segment()
+        data = "".join(lines)
+        self._f.write(data)
+        self._size += len(data.encode("utf-8"))
+        self._dirty = True
+
+    def close(self, timeout: float = 5.0):
+        """写完队列里剩余记录并 fsync"""
+        t = self._thread
+        if t is not None and t.is_alive():
+            self._q.put(_STOP)
+            t.join(timeout)
+
+
+# ---------- 读取 ----------
+def segments(directory: str, prefix: str = "events") -> list[str]:
+    return sorted(glob.glob(os.path.join(directory, f"{prefix}-*.ndjson")))
+
+
+def read(paths: Iterable[str]) -> Iterator[dict]:
+    """逐行流式读取；解析失败的行（崩溃时写了一半）跳过"""
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    eventlog.warning("journal_bad_line", path=path)
@@ -0,0 +1,304 @@
+# metrics.py
+# -*- coding: utf-8 -*-
+"""
+进程内指标（Prometheus 文本格式导出）
+- 计数器 / 直方图按线程分片：热路径只改本线程的 dict，不加锁；抓取时再汇总
+- Gauge 在抓取时回调取值（队列深度、券池水位等）
+- timed("stage") 既可作 with 语句也可作装饰器：记录耗时，异常计入错误数；call=True 的出站调用另记一条事件日志
+- 多进程（gunicorn 多 worker）：设置 METRICS_MULTIPROC_DIR 后每个进程定期把计数器 / 直方图写成
+  metrics-<pid>.json，/metrics 无论落到哪个 worker 都汇总全部进程；已退出进程的文件保留，计数不回退。
+  Gauge 仍只取本进程（队列深度等读的是共享库，各 worker 一致）
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import env  # 先加载 .env
+import eventlog
+
+MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")
+SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", "5"))
+
+Labels = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: Iterable[str], values: Labels, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Sharded:
+    """
+    每个线程一份 dict；新线程第一次写时加锁登记
+    已退出线程的分片在登记新线程 / 抓取时并入 _base，线程一请求一个的服务器上分片数不会只增不减
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: list[tuple[threading.Thread, dict]] = []
+        self._base: dict = {}
+        self._lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        d = getattr(self._local, "d", None)
+        if d is None:
+            d = self._local.d = {}
+            with self._lock:
+                self._fold_dead()
+                self._shards.append((threading.current_thread(), d))
+        return d
+
+    def _merge(self, base: dict, d: dict):
+        raise NotImplementedError
+
+    def _fold_dead(self):
+        """持锁调用：线程已退出就不会再写它的分片，可以安全并入 _base"""
+        live = []
+        for t, d in self._shards:
+            if t.is_alive():
+                live.append((t, d))
+            else:
+                self._merge(self._base, d)
+        self._shards = live
+
+    def _local_values(self) -> dict:
+        raise NotImplementedError
+
+    def values(self) -> dict:
+        """本进程 + （多进程模式下）其他进程最近一次快照"""
+        out = self._local_values()
+        for d in _other_processes(self.name):
+            self._merge(out, d)
+        return out
+
+    def _snapshot(self) -> list[list]:
+        with self._lock:
+            self._fold_dead()
+            base = [(k, list(v) if isinstance(v, list) else v) for k, v in self._base.items()]
+            shards = [d for _, d in self._shards]
+        return [base] + [list(d.items()) for d in shards]
+
+
+class Counter(_Sharded):
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__()
+        self.name, self.help, self.labelnames = name, help, labelnames
+
+    def inc(self, labels: Labels = (), n: float = 1):
+        d = self._shard()
+        d[labels] = d.get(labels, 0) + n
+
+    def _merge(self, base: dict, d: dict):
+        for k, v in d.items():
+            base[k] = base.get(k, 0) + v
+
+    def _local_values(self) -> Dict[Labels, float]:
+        out: Dict[Labels, float] = {}
+        for items in self._snapshot():
+            for k, v in items:
+                out[k] = out.get(k, 0) + v
+        return out
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, v in sorted(self.values().items()):
+            lines.append(f"{self.name}{_fmt_labels(self.labelnames, labels)} {v}")
+        return lines
+
+
+class Histogram(_Sharded):
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__()
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: Labels = ()):
+        d = self._shard()
+        h = d.get(labels)
+        if h is None:
+            h = d[labels] = [0] * (len(self.buckets) + 2)  # 各桶（非累计）+ +Inf + sum
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                h[i] += 1
+                break
+        else:
+            h[len(self.buckets)] += 1
+        h[-1] += value
+
+    def _merge(self, base: dict, d: dict):
+        for k, h in d.items():
+            m = base.setdefault(k, [0] * len(h))
+            for i, v in enumerate(h):
+                m[i] += v
+
+    def _local_values(self) -> Dict[Labels, list]:
+        merged: Dict[Labels, list] = {}
+        for items in self._snapshot():
+            for k, h in items:
+                m = merged.setdefault(k, [0] * len(h))
+                for i, v in enumerate(list(h)):
+                    m[i] += v
+        return merged
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, h in sorted(self.values().items()):
+            acc = 0
+            for b, c in zip(self.buckets, h):
+                acc += c
+                le = _fmt_labels(self.labelnames, labels, 'le="%s"' % b)
+                lines.append(f"{self.name}_bucket{le} {acc}")
+            acc += h[len(self.buckets)]
+            le = _fmt_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {acc}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {h[-1]}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {acc}")
+        return lines
+
+
+class Gauge:
+    """抓取时调用 fn()；返回数字，或 {labels: 数字}"""
+
+    def __init__(self, name: str, help: str, fn: Callable, labelnames: Tuple[str, ...] = ()):
+        self.name, self.help, self.fn, self.labelnames = name, help, fn, labelnames
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            v = self.fn()
+        except Exception as e:
+            return lines + [f"# error: {e!r}".replace("\n", " ")]
+        items = v.items() if isinstance(v, dict) else [((), v)]
+        for labels, val in sorted(items):
+            lines.append(f"{self.name}{_fmt_labels(self.labelnames, labels)} {val}")
+        return lines
+
+
+_registry: list = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    lines: list[str] = []
+    for m in _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- 多进程汇总 ----------
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(MULTIPROC_DIR, f"metrics-{pid}.json")
+
+
+def write_snapshot():
+    """把本进程的计数器 / 直方图写入 METRICS_MULTIPROC_DIR（写临时文件后原子替换）"""
+    if not MULTIPROC_DIR:
+        return
+    doc = {m.name: [[list(k), v] for k, v in m._local_values().items()]
+           for m in _registry if isinstance(m, _Sharded)}
+    path = _snapshot_path(os.getpid())
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(doc, f)
+    os.replace(path + ".tmp", path)
+
+
+def _other_processes(name: str) -> Iterator[dict]:
+    if not MULTIPROC_DIR:
+        return
+    own = _snapshot_path(os.getpid())
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, "metrics-*.json")):
+        if path == own:
+            continue
+        try:
+            with open(path, encoding="utf-8") as f:
+                doc = json.load(f)
+        except (OSError, ValueError):
+            continue  # 正在被替换 / 已被清理
+        yield {tuple(k): v for k, v in doc.get(name, [])}
+
+
+def clear_snapshots():
+    """master 启动时调用：清掉上一轮部署留下的快照"""
+    if MULTIPROC_DIR:
+        os.makedirs(MULTIPROC_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(MULTIPROC_DIR, "metrics-*.json*")):
+            os.remove(path)
+
+
+_snapshot_thread: Optional[threading.Thread] = None
+
+
+def start_snapshots(interval: float = SNAPSHOT_INTERVAL):
+    """多进程模式下后台定期写快照；单进程时什么都不做"""
+    global _snapshot_thread
+    if not MULTIPROC_DIR or _snapshot_thread is not None:
+        return
+
+    def run():
+        while True:
+            try:
+                write_snapshot()
+            except OSError as e:
+                eventlog.error("metrics_snapshot_failed", exc=e)
+            time.sleep(interval)
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    _snapshot_thread = threading.Thread(target=run, name="metrics-snapshot", daemon=True)
+    _snapshot_thread.start()
+
+
+# ---------- 各阶段耗时 / 错误 ----------
+stage_latency = register(Histogram("wecom_pass2u_stage_seconds", "Latency per pipeline stage", ("stage",)))
+stage_errors = register(Counter("wecom_pass2u_stage_errors_total", "Errors per pipeline stage", ("stage",)))
+
+
+class timed(ContextDecorator):
+    """with timed("pass2u_create", call=True): ...  或  @timed("db_log_pass_creation")"""
+
+    def __init__(self, stage: str, call: bool = False):
+        self.stage = (stage,)
+        self.call = call  # 出站调用：每次的耗时 / 结果写事件日志（成功按采样）
+
+    def _recreate_cm(self):
+        return timed(self.stage[0], self.call)  # 装饰器每次调用用新实例，线程安全
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        self._failed = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._t0
+        stage_latency.observe(elapsed, self.stage)
+        if exc_type is not None:
+            stage_errors.inc(self.stage)
+        if self.call:
+            if exc_type is not None:
+                eventlog.call(self.stage[0], elapsed, False, err=repr(exc))
+            elif self._failed is not None:
+                eventlog.call(self.stage[0], elapsed, False, **self._failed)
+            else:
+                eventlog.call(self.stage[0], elapsed, True)
+        return False
+
+    def fail(self, **detail):
+        """没有异常但结果是失败（如 errcode != 0）；detail 写进事件日志"""
+        stage_errors.inc(self.stage)
+        self._failed = detail
@@ -1,14 +1,34 @@
 # pass2u_api.py
-from pathlib import Path
-from dotenv import load_dotenv
-import os, requests
+import os, json, threading, time, requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
 
-BASE_DIR = Path(__file__).resolve().parent
-load_dotenv(dotenv_path=BASE_DIR/".env")
+import env  # 先加载 .env
+from ratelimit import limiter, ThrottledError
+from metrics import timed
+from async_http import aiohttp, get_session
+from breaker import CircuitBreaker
 
 class Pass2UError(Exception): ...
 
+class Pass2UThrottled(Pass2UError, ThrottledError):
+    """429 或本地令牌不足：应延后重试，而不是当作失败"""
+
+class Pass2UCircuitOpen(Pass2UError):
+    """熔断打开：未发请求，调用方应立即降级"""
+
+# 熔断：最近 WINDOW 次调用中 5xx/网络错误或慢调用（≥SLOW_SECONDS）占比过高即打开，OPEN_SECONDS 后半开探测
+breaker = CircuitBreaker(
+    "pass2u",
+    window=int(os.getenv("PASS2U_BREAKER_WINDOW", "20")),
+    min_calls=int(os.getenv("PASS2U_BREAKER_MIN_CALLS", "10")),
+    failure_rate=float(os.getenv("PASS2U_BREAKER_FAILURE_RATE", "0.5")),
+    slow_seconds=float(os.getenv("PASS2U_BREAKER_SLOW_SECONDS", "5")),
+    slow_rate=float(os.getenv("PASS2U_BREAKER_SLOW_RATE", "0.5")),
+    open_seconds=float(os.getenv("PASS2U_BREAKER_OPEN_SECONDS", "30")),
+    probes=int(os.getenv("PASS2U_BREAKER_PROBES", "1")),
+)
+
 def _auth_headers():
     api_key = os.getenv("PASS2U_API_KEY", "")
     if not api_key:
@@ -17,28 +37,160 @@ def _auth_headers():
     scheme = os.getenv("PASS2U_AUTH_SCHEME", "Bearer")
     return {hdr: f"{scheme} {api_key}", "Content-Type": "application/json", "Accept": "application/json"}
 
-def create_pass2u_link(external_userid: str, extras: dict | None = None) -> str:
-    base = os.getenv("PASS2U_BASE", "https://api.pass2u.net").rstrip("/")
-    model_id = os.getenv("PASS2U_MODEL_ID")
-    if not model_id:
-        raise Pass2UError("PASS2U_MODEL_ID not set")
-    utm = quote(os.getenv("PASS2U_UTM_SOURCE", "wecom"))
-    url = f"{base}/v2/models/{model_id}/passes?utm_source={utm}"
-
-    payload = {
-        "fields": [
-            {"key": "externalId", "value": external_userid}
-        ],
-        "barcode": {"message": external_userid, "altText": external_userid},
-        "metadata": extras or {}
-    }
-
-    r = requests.post(url, json=payload, headers=_auth_headers(), timeout=15)
-    if r.status_code >= 400:
-        raise Pass2UError(f"pass2u create failed {r.status_code}: {r.text}")
-    data = r.json()
+def extract_link(data, base: str) -> str | None:
+    """从创建返回里取直链；没有直链时用 passId 拼下载地址"""
+    if not isinstance(data, dict):
+        return None
     for k in ("link", "url", "downloadUrl", "passUrl"):
-        if isinstance(data, dict) and data.get(k):
+        if data.get(k):
             return data[k]
-    pid = data.get("passId") if isinstance(data, dict) else None
-    return f"{base}/v2/passes/{pid}/download" if pid else None
\ No newline at end of file
+    pid = data.get("passId")
+    return f"{base}/v2/passes/{pid}/download" if pid else None
+
+class _Pass2UCore:
+    """配置 + 请求构造 / 结果解析：同步、异步客户端共用"""
+
+    def __init__(self, base: str | None = None, model_id: str | None = None,
+                 connect_timeout: float | None = None, read_timeout: float | None = None):
+        self.base = (base or os.getenv("PASS2U_BASE", "https://api.pass2u.net")).rstrip("/")
+        self.model_id = model_id or os.getenv("PASS2U_MODEL_ID")
+        if not self.model_id:
+            raise Pass2UError("PASS2U_MODEL_ID not set")
+        utm = quote(os.getenv("PASS2U_UTM_SOURCE", "wecom"))
+        self.create_url = f"{self.base}/v2/models/{self.model_id}/passes?utm_source={utm}"
+        self.timeout = (
+            float(connect_timeout if connect_timeout is not None else os.getenv("PASS2U_CONNECT_TIMEOUT", "3.05")),
+            float(read_timeout if read_timeout is not None else os.getenv("PASS2U_READ_TIMEOUT", "15")),
+        )
+        self.headers = _auth_headers()
+
+    @staticmethod
+    def _payload(external_userid: str, extras: dict | None) -> dict:
+        return {
+            "fields": [
+                {"key": "externalId", "value": external_userid}
+            ],
+            "barcode": {"message": external_userid, "altText": external_userid},
+            "metadata": extras or {}
+        }
+
+    @staticmethod
+    def _record(status: int, seconds: float):
+        """计入熔断窗口：5xx 算失败；429 不计（属于限流）；其余 4xx 是请求本身的问题，不算对端故障"""
+        if status == 429:
+            breaker.release()
+        else:
+            breaker.record(status < 500, seconds)
+
+    @staticmethod
+    def _result(status: int, headers, text: str) -> dict:
+        if status == 429:
+            retry_after = headers.get("Retry-After")
+            raise Pass2UThrottled(f"pass2u throttled: {text[:200]}",
+                                  retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+        if status >= 400:
+            raise Pass2UError(f"pass2u create failed {status}: {text}")
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise Pass2UError(f"pass2u non-JSON response: status={status}, text={text[:200]!r}")
+        if not isinstance(data, dict):
+            raise Pass2UError(f"pass2u unexpected response: {data!r}")
+        return data
+
+class Pass2UClient(_Pass2UCore):
+    """
+    复用连接的 Pass2U 客户端
+    - 配置只在构造时读取一次
+    - keep-alive 连接池，省掉每次建券的 TCP+TLS 握手
+    - connect / read 超时分开配置
+    """
+
+    def __init__(self, base: str | None = None, model_id: str | None = None,
+                 connect_timeout: float | None = None, read_timeout: float | None = None,
+                 pool_size: int | None = None):
+        super().__init__(base, model_id, connect_timeout, read_timeout)
+        pool_size = int(pool_size or os.getenv("PASS2U_POOL_SIZE", "16"))
+
+        self.s = requests.Session()
+        self.s.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.s.mount("https://", adapter)
+        self.s.mount("http://", adapter)
+
+    def create_pass_raw(self, external_userid: str, extras: dict | None = None) -> dict:
+        """创建 Pass，返回 Pass2U 原始 JSON"""
+        payload = self._payload(external_userid, extras)
+        if not breaker.allow():
+            raise Pass2UCircuitOpen("pass2u circuit open")
+        try:
+            limiter.acquire("pass2u")
+        except ThrottledError as e:
+            breaker.release()
+            raise Pass2UThrottled(str(e)) from None
+        t0 = time.monotonic()
+        try:
+            with timed("pass2u_create", call=True) as t:
+                r = self.s.post(self.create_url, json=payload, timeout=self.timeout)
+                if r.status_code >= 400:
+                    t.fail(status=r.status_code)
+        except Exception:
+            breaker.record(False, time.monotonic() - t0)
+            raise
+        self._record(r.status_code, time.monotonic() - t0)
+        return self._result(r.status_code, r.headers, r.text)
+
+    def create_pass_link(self, external_userid: str, extras: dict | None = None) -> str | None:
+        return extract_link(self.create_pass_raw(external_userid, extras), self.base)
+
+    def close(self):
+        self.s.close()
+
+class AsyncPass2UClient(_Pass2UCore):
+    """协程版 Pass2U 客户端：与 AsyncWeComAPI 共用 async_http 的 aiohttp 连接池"""
+
+    async def create_pass_raw(self, external_userid: str, extras: dict | None = None) -> dict:
+        payload = self._payload(external_userid, extras)
+        session = get_session()
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        if not breaker.allow():
+            raise Pass2UCircuitOpen("pass2u circuit open")
+        try:
+            await limiter.acquire_async("pass2u")
+        except ThrottledError as e:
+            breaker.release()
+            raise Pass2UThrottled(str(e)) from None
+        t0 = time.monotonic()
+        try:
+            with timed("pass2u_create", call=True) as t:
+                async with session.post(self.create_url, json=payload, headers=self.headers,
+                                        timeout=timeout) as r:
+                    status, headers, text = r.status, r.headers, await r.text()
+                if status >= 400:
+                    t.fail(status=status)
+        except Exception:
+            breaker.record(False, time.monotonic() - t0)
+            raise
+        self._record(status, time.monotonic() - t0)
+        return self._result(status, headers, text)
+
+    async def create_pass_link(self, external_userid: str, extras: dict | None = None) -> str | None:
+        return extract_link(await self.create_pass_raw(external_userid, extras), self.base)
+
+_client: Pass2UClient | None = None
+_client_lock = threading.Lock()
+
+def get_client() -> Pass2UClient:
+    """进程内共享一个客户端（连接池）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = Pass2UClient()
+    return _client
+
+def create_pass2u_raw(external_userid: str, extras: dict | None = None) -> dict:
+    return get_client().create_pass_raw(external_userid, extras)
+
+def create_pass2u_link(external_userid: str, extras: dict | None = None) -> str | None:
+    return get_client().create_pass_link(external_userid, extras)
@@ -0,0 +1,93 @@
+# pass_pool.py
+# -*- coding: utf-8 -*-
+"""
+Pass 预铸券池
+- 后台线程把库存里 source='pass2u' 的未分配库存维持在 [low, high]（读写经由 Storage）
+- 入群时先从池子里原子领取一张，池子空了才实时调用 Pass2U
+- 预铸的券还不知道归属用户，条码用随机的池子编号
+- ready() 为假（Pass2U 熔断中）时不补货，等下一轮
+- 领取的券送达用户后库存行记为已送达（Storage.mark_delivered 按直链同步）
+"""
+
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import eventlog
+from pass2u_api import Pass2UClient, extract_link
+
+SOURCE = "pass2u"
+
+
+class PassPoolFiller:
+    def __init__(self, client_factory, store, low: int = 50, high: int = 200,
+                 interval: float = 10.0, concurrency: int = 4, ready=lambda: True):
+        self.client_factory = client_factory  # -> Pass2UClient
+        self.store = store
+        self.ready = ready
+        self.low = low
+        self.high = high
+        self.interval = interval
+        self.concurrency = concurrency
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _mint_one(self, client: Pass2UClient) -> bool:
+        pool_id = f"pool-{uuid.uuid4().hex}"
+        try:
+            resp = client.create_pass_raw(pool_id, {"pool": True})
+        except Exception as e:
+            eventlog.error("pass_pool_mint_failed", exc=e)
+            return False
+        link = extract_link(resp, client.base)
+        if not link:
+            eventlog.warning("pass_pool_mint_no_link", resp=resp)
+            return False
+        self.store.add_inventory(link, resp.get("passId"), json.dumps(resp, ensure_ascii=False), source=SOURCE)
+        return True
+
+    def fill_once(self) -> int:
+        """低于低水位时补到高水位；返回本次补入数量"""
+        if not self.ready():
+            return 0  # 熔断中：补货只会攒一堆失败调用
+        level = self.store.count_unassigned(source=SOURCE)
+        if level >= self.low:
+            return 0
+        need = self.high - level
+        client = self.client_factory()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="pass-pool") as ex:
+            ok = sum(ex.map(lambda _: self._mint_one(client), range(need)))
+        return ok
+
+    def kick(self):
+        """领取后调用：库存可能跌破低水位，提前唤醒补货"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.fill_once()
+            except Exception as e:
+                eventlog.error("pass_pool_fill_failed", exc=e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="pass-pool", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def claim(store, external_userid: str, chat_id: str | None) -> tuple[str, dict] | None:
+    """从券池领取一张；池子空返回 None"""
+    row = store.claim_inventory(external_userid, chat_id, source=SOURCE)
+    if not row:
+        return None
+    resp = json.loads(row["raw_resp"]) if row.get("raw_resp") else {"passId": row.get("pass_id")}
+    return row["download_link"], resp
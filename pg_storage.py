@@ -0,0 +1,270 @@
+# pg_storage.py
+# -*- coding: utf-8 -*-
+"""
+PostgreSQL 存储（多节点共享 assignments / 库存 / 回调去重 / 统计）
+- psycopg 为可选依赖，只有 STORAGE_URL 指向 PostgreSQL 时才需要安装
+- 与 SQLite 共用 storage.Storage 的 SQL：连接包装把 ? 换成 %s，行对象同 sqlite3.Row 可按列名取值
+- 每线程一条长连接，事务与 db.Database 一样可嵌套、只有最外层提交
+- 领取库存 / 补发行加 FOR UPDATE SKIP LOCKED；upsert 走唯一索引 ON CONFLICT，跨节点并发也是原子的
+- 计数同 SQLite 由触发器维护；建表在 advisory lock 内执行，多个节点同时启动不会互相踩
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import psycopg
+except ImportError:  # 可选依赖
+    psycopg = None
+
+from storage import Storage
+
+SCHEMA_LOCK_ID = 0x77705532  # pg_advisory_xact_lock 的键，任意固定值
+
+DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS assignments (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        external_userid TEXT NOT NULL,
+        chat_id TEXT,
+        link TEXT NOT NULL,
+        notes TEXT,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        scene TEXT,
+        pass_id TEXT,
+        model_id TEXT,
+        barcode_message TEXT,
+        download_url TEXT,
+        expiration_date TEXT,
+        created_time TEXT,
+        raw_resp TEXT,
+        gw_sent INTEGER NOT NULL DEFAULT 0,
+        gw_sent_at TEXT,
+        delivery_attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at DOUBLE PRECISION,
+        needs_mint INTEGER NOT NULL DEFAULT 0,
+        mint_after DOUBLE PRECISION,
+        archived_at TEXT
+    )
+    """,
+    "ALTER TABLE assignments ADD COLUMN IF NOT EXISTS mint_after DOUBLE PRECISION",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_assignments_user_scene"
+    " ON assignments (external_userid, (COALESCE(scene, '')))",
+    "CREATE INDEX IF NOT EXISTS idx_assignments_redeliver ON assignments (next_attempt_at)"
+    " WHERE delivered=0 AND next_attempt_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_assignments_needs_mint ON assignments (id) WHERE needs_mint=1",
+    "CREATE INDEX IF NOT EXISTS idx_assignments_chat ON assignments (chat_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_assignments_pass ON assignments (pass_id) WHERE pass_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_assignments_created ON assignments (created_at, id)",
+    """
+    CREATE TABLE IF NOT EXISTS assignment_raw (
+        assignment_id BIGINT PRIMARY KEY REFERENCES assignments (id) ON DELETE CASCADE,
+        body BYTEA NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS assignment_stats (
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        total BIGINT NOT NULL DEFAULT 0,
+        delivered BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (scope, key)
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION assignment_stats_apply(sign INTEGER, r assignments) RETURNS void AS $$
+    BEGIN
+        INSERT INTO assignment_stats (scope, key, total, delivered) VALUES
+            ('all', '', sign, sign * (r.delivered IS NOT DISTINCT FROM 1)::int),
+            ('day', substr(r.created_at, 1, 10), sign, sign * (r.delivered IS NOT DISTINCT FROM 1)::int),
+            ('chat', COALESCE(r.chat_id, ''), sign, sign * (r.delivered IS NOT DISTINCT FROM 1)::int)
+        ON CONFLICT (scope, key) DO UPDATE SET
+            total = assignment_stats.total + excluded.total,
+            delivered = assignment_stats.delivered + excluded.delivered;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION trg_assignment_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN PERFORM assignment_stats_apply(-1, OLD); END IF;
+        IF TG_OP <> 'DELETE' THEN PERFORM assignment_stats_apply(1, NEW); END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_assignment_stats_insert_delete ON assignments",
+    "CREATE TRIGGER trg_assignment_stats_insert_delete AFTER INSERT OR DELETE ON assignments"
+    " FOR EACH ROW EXECUTE FUNCTION trg_assignment_stats()",
+    "DROP TRIGGER IF EXISTS trg_assignment_stats_update ON assignments",
+    """
+    CREATE TRIGGER trg_assignment_stats_update AFTER UPDATE OF delivered, chat_id, created_at ON assignments
+    FOR EACH ROW WHEN (OLD.delivered IS DISTINCT FROM NEW.delivered OR OLD.chat_id IS DISTINCT FROM NEW.chat_id
+                       OR OLD.created_at IS DISTINCT FROM NEW.created_at)
+    EXECUTE FUNCTION trg_assignment_stats()
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS callback_dedup (
+        key TEXT PRIMARY KEY,
+        seen_at DOUBLE PRECISION NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_callback_dedup_seen ON callback_dedup (seen_at)",
+    """
+    CREATE TABLE IF NOT EXISTS inventory (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        download_link TEXT NOT NULL UNIQUE,
+        passcode TEXT,
+        notes TEXT,
+        assigned_to TEXT,
+        assigned_chat_id TEXT,
+        assigned_at TEXT,
+        delivered INTEGER NOT NULL DEFAULT 0,
+        source TEXT,
+        pass_id TEXT,
+        raw_resp TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_inventory_assigned ON inventory (assigned_to)",
+    "CREATE INDEX IF NOT EXISTS idx_inventory_free ON inventory (id) WHERE assigned_to IS NULL",
+    "CREATE INDEX IF NOT EXISTS idx_inventory_free_source ON inventory (source, id) WHERE assigned_to IS NULL",
+    """
+    CREATE TABLE IF NOT EXISTS inventory_stats (
+        source TEXT PRIMARY KEY,
+        total BIGINT NOT NULL DEFAULT 0,
+        assigned BIGINT NOT NULL DEFAULT 0,
+        delivered BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION inventory_stats_apply(sign INTEGER, r inventory) RETURNS void AS $$
+    BEGIN
+        INSERT INTO inventory_stats (source, total, assigned, delivered)
+        VALUES (COALESCE(r.source, ''), sign, sign * (r.assigned_to IS NOT NULL)::int,
+                sign * (r.delivered IS NOT DISTINCT FROM 1)::int)
+        ON CONFLICT (source) DO UPDATE SET
+            total = inventory_stats.total + excluded.total,
+            assigned = inventory_stats.assigned + excluded.assigned,
+            delivered = inventory_stats.delivered + excluded.delivered;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION trg_inventory_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN PERFORM inventory_stats_apply(-1, OLD); END IF;
+        IF TG_OP <> 'DELETE' THEN PERFORM inventory_stats_apply(1, NEW); END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_inventory_stats_insert_delete ON inventory",
+    "CREATE TRIGGER trg_inventory_stats_insert_delete AFTER INSERT OR DELETE ON inventory"
+    " FOR EACH ROW EXECUTE FUNCTION trg_inventory_stats()",
+    "DROP TRIGGER IF EXISTS trg_inventory_stats_update ON inventory",
+    """
+    CREATE TRIGGER trg_inventory_stats_update AFTER UPDATE OF source, assigned_to, delivered ON inventory
+    FOR EACH ROW WHEN (OLD.source IS DISTINCT FROM NEW.source
+                       OR (OLD.assigned_to IS NULL) <> (NEW.assigned_to IS NULL)
+                       OR OLD.delivered IS DISTINCT FROM NEW.delivered)
+    EXECUTE FUNCTION trg_inventory_stats()
+    """,
+]
+
+
+def require_psycopg():
+    if psycopg is None:
+        raise RuntimeError("psycopg 未安装：pip install 'psycopg[binary]'（STORAGE_URL 为 PostgreSQL 时需要）")
+
+
+class Row(tuple):
+    """同 sqlite3.Row：按下标或列名取值，dict(row) 得到 列名→值"""
+    __slots__ = ()
+    _index: dict = {}
+
+    def __getitem__(self, k):
+        return tuple.__getitem__(self, self._index[k] if isinstance(k, str) else k)
+
+    def keys(self):
+        return list(self._index)
+
+
+def _row_factory(cursor):
+    names = [c.name for c in cursor.description or ()]
+    cls = type("Row", (Row,), {"__slots__": (), "_index": {n: i for i, n in enumerate(names)}})
+    return cls
+
+
+class _Conn:
+    """把 ? 占位符换成 %s；其余接口同 sqlite3.Connection 里用到的部分"""
+
+    def __init__(self, con):
+        self.raw = con
+
+    def execute(self, sql: str, params=()):
+        return self.raw.execute(sql.replace("?", "%s"), params or None)
+
+    def executemany(self, sql: str, seq):
+        cur = self.raw.cursor()
+        cur.executemany(sql.replace("?", "%s"), seq)
+        return cur
+
+
+class PgDatabase:
+    def __init__(self, url: str):
+        require_psycopg()
+        self.url = url
+        self._local = threading.local()
+
+    def conn(self) -> _Conn:
+        """当前线程的长连接（autocommit；事务由 transaction() 显式控制）；断线后重连"""
+        con = getattr(self._local, "con", None)
+        if con is None or con.raw.closed or (con.raw.broken and not self._local.depth):
+            con = self._local.con = _Conn(psycopg.connect(self.url, autocommit=True, row_factory=_row_factory))
+            self._local.depth = 0
+        return con
+
+    @contextmanager
+    def transaction(self) -> Iterator[_Conn]:
+        """工作单元：BEGIN … COMMIT；嵌套调用并入外层事务"""
+        con = self.conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield con
+            finally:
+                self._local.depth -= 1
+            return
+
+        con.execute("BEGIN")
+        self._local.depth = 1
+        try:
+            yield con
+        except BaseException:
+            if not con.raw.broken:
+                con.execute("ROLLBACK")
+            raise
+        else:
+            con.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        """关闭当前线程的连接"""
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            con.raw.close()
+            self._local.con = None
+
+
+class PgStorage(Storage):
+    shared = True
+    _SKIP_LOCKED = " FOR UPDATE SKIP LOCKED"
+
+    def __init__(self, url: str):
+        db = PgDatabase(url)
+        super().__init__(db, db)
+
+    def init_schema(self):
+        with self.db.transaction() as con:
+            con.execute("SELECT pg_advisory_xact_lock(?)", (SCHEMA_LOCK_ID,))
+            for sql in DDL:
+                con.execute(sql)
@@ -0,0 +1,125 @@
+# ratelimit.py
+# -*- coding: utf-8 -*-
+"""
+出站限流
+- 每个接口一个令牌桶，配额来自环境变量 RATE_LIMITS：
+  "kf/send_msg=20/1,pass2u=10/1"  即 kf/send_msg 每 1 秒 20 次（突发上限也是 20）
+- 拿不到令牌或对端返回限频错误时抛 ThrottledError，由任务队列按抖动退避延后重试
+- 令牌桶在进程内：多进程部署（gunicorn 多 worker）时按 RATE_LIMIT_PROCESSES 平分配额，
+  合计不超过 RATE_LIMITS；gunicorn.conf.py 默认把它设成 worker 数
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import env  # 先加载 .env
+
+# 企业微信限频错误码：接口调用超过限制 / 分钟配额 / 并发上限
+WECOM_THROTTLE_CODES = {45009, 45011, 45033}
+
+DEFAULT_LIMITS = (
+    "kf/send_msg=20/1,"
+    "kf/add_contact=20/1,"
+    "externalcontact/group_welcome_template/send=20/1,"
+    "pass2u=10/1"
+)
+MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))  # 本地排队最多等多久，超过视为被限流
+PROCESSES = max(1, int(os.getenv("RATE_LIMIT_PROCESSES", "1")))  # 共享同一配额的进程数
+
+
+class ThrottledError(Exception):
+    """被限流（本地令牌不足或对端限频），retry_after 为建议的重试延迟（秒）"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def jittered_backoff(attempt: int, base: float = 2.0, cap: float = 300.0) -> float:
+    """full jitter：[0, min(cap, base * 2^attempt)]"""
+    return random.uniform(0, min(cap, base * (2 ** max(attempt, 0))))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate      # 每秒补充的令牌数
+        self.burst = burst    # 桶容量
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """取一个令牌；返回还需等待的秒数（0 表示已取到）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._reserve()
+            if wait == 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        """协程版：等待期间让出事件循环"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._reserve()
+            if wait == 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+def parse_limits(spec: str, processes: int = 1) -> Dict[str, TokenBucket]:
+    """processes > 1 时每个进程只拿 1/processes 的速率与突发（突发至少 1）"""
+    buckets: Dict[str, TokenBucket] = {}
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item or "=" not in item:
+            continue
+        key, quota = item.rsplit("=", 1)
+        count, _, per = quota.partition("/")
+        count_f, per_f = float(count), float(per or 1)
+        buckets[key.strip()] = TokenBucket(rate=count_f / per_f / processes,
+                                           burst=max(1.0, count_f / processes))
+    return buckets
+
+
+class RateLimiter:
+    """按接口名分桶；未配置的接口不限流"""
+
+    def __init__(self, buckets: Dict[str, TokenBucket]):
+        self.buckets = buckets
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        return cls(parse_limits(os.getenv("RATE_LIMITS", DEFAULT_LIMITS), PROCESSES))
+
+    def acquire(self, key: str, timeout: Optional[float] = MAX_WAIT):
+        """拿不到令牌抛 ThrottledError"""
+        bucket = self.buckets.get(key)
+        if bucket is not None and not bucket.acquire(timeout):
+            raise ThrottledError(f"local rate limit exceeded: {key}")
+
+    async def acquire_async(self, key: str, timeout: Optional[float] = MAX_WAIT):
+        bucket = self.buckets.get(key)
+        if bucket is not None and not await bucket.acquire_async(timeout):
+            raise ThrottledError(f"local rate limit exceeded: {key}")
+
+
+limiter = RateLimiter.from_env()
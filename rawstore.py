@@ -0,0 +1,50 @@
+# rawstore.py
+# -*- coding: utf-8 -*-
+"""
+Pass2U 原始返回的紧凑存储
+- 不再写 assignments.raw_resp，改存旁表 assignment_raw：紧凑 JSON + zlib 压缩
+- 主表行变窄，热索引和常用列更容易留在页缓存里；原始返回只在需要时按 id 读取
+"""
+
+import json
+import sqlite3
+import zlib
+from typing import Optional
+
+DDL = """
+CREATE TABLE IF NOT EXISTS assignment_raw (
+    assignment_id INTEGER PRIMARY KEY,
+    body BLOB NOT NULL                 -- zlib(JSON)
+)
+"""
+
+
+def pack(resp: dict) -> bytes:
+    return zlib.compress(json.dumps(resp, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def unpack(body: bytes) -> dict:
+    return json.loads(zlib.decompress(body).decode("utf-8"))
+
+
+def save(con: sqlite3.Connection, assignment_id: int, resp: Optional[dict]):
+    if not resp:
+        con.execute("DELETE FROM assignment_raw WHERE assignment_id=?", (assignment_id,))
+        return
+    con.execute("INSERT INTO assignment_raw (assignment_id, body) VALUES (?, ?)"
+                " ON CONFLICT (assignment_id) DO UPDATE SET body=excluded.body",
+                (assignment_id, pack(resp)))
+
+
+def load(con: sqlite3.Connection, assignment_id: int) -> Optional[dict]:
+    """先查旁表；老数据还在 raw_resp 列里的照旧读取"""
+    row = con.execute("SELECT body FROM assignment_raw WHERE assignment_id=?", (assignment_id,)).fetchone()
+    if row:
+        return unpack(row[0])
+    row = con.execute("SELECT raw_resp FROM assignments WHERE id=?", (assignment_id,)).fetchone()
+    if row and row[0]:
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+    return None
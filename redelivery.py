@@ -0,0 +1,160 @@
+# redelivery.py
+# -*- coding: utf-8 -*-
+"""
+未送达补发
+- KF 私聊失败的 assignments 行带 next_attempt_at，进入部分索引 idx_assignments_redeliver
+- 后台线程按 next_attempt_at 分批领取到期行（领取即顺延租约，多进程 / 多节点不会重复发送；SQL 见 storage）
+- 成功标记 delivered=1；失败按退避顺延；超过次数或超龄清空 next_attempt_at 退出队列
+- 券没建成（needs_mint=1）的行不进上面的次数预算：PendingMinter 单独扫描，熔断打开时整轮跳过，
+  建不成只按退避顺延、不会出队；建成后再私聊（失败则转入补发队列）
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable
+
+import eventlog
+from ratelimit import jittered_backoff
+
+INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_assignments_redeliver
+ON assignments (next_attempt_at)
+WHERE delivered=0 AND next_attempt_at IS NOT NULL
+"""
+
+
+class Redeliverer:
+    def __init__(self, store, send: Callable[[dict], bool], batch_size: int = 50,
+                 interval: float = 30.0, max_attempts: int = 8, max_age_hours: float = 48,
+                 base_delay: float = 60.0, lease_seconds: float = 300.0, concurrency: int = 4):
+        self.store = store  # storage.Storage
+        self.send = send  # send(row) -> 是否送达
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.max_age = timedelta(hours=max_age_hours)
+        self.base_delay = base_delay
+        self.lease_seconds = lease_seconds
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="redeliver")
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def next_delay(self, attempts: int) -> float:
+        return self.base_delay + jittered_backoff(attempts, base=self.base_delay, cap=6 * 3600)
+
+    def _claim_batch(self) -> list[dict]:
+        now = time.time()
+        return self.store.claim_redelivery(now, now + self.lease_seconds, self.batch_size)
+
+    def _expired(self, row: dict) -> bool:
+        if row["delivery_attempts"] > self.max_attempts:
+            return True
+        try:
+            created = datetime.fromisoformat(row["created_at"])
+        except (TypeError, ValueError):
+            return False
+        return datetime.utcnow() - created > self.max_age
+
+    def _process(self, row: dict) -> bool:
+        if self._expired(row):
+            self.store.finish_redelivery(row["id"], False, None)
+            return False
+        try:
+            with eventlog.trace(trace_id=eventlog.new_id(), eu=row["external_userid"]):
+                with eventlog.span("redeliver", attempt=row["delivery_attempts"]):
+                    ok = self.send(row)
+        except Exception:
+            ok = False  # span 已记录
+        self.store.finish_redelivery(row["id"], ok,
+                                     None if ok else time.time() + self.next_delay(row["delivery_attempts"]))
+        return ok
+
+    def run_once(self) -> int:
+        """处理一批到期行；返回本批领取的行数"""
+        rows = self._claim_batch()
+        list(self._pool.map(self._process, rows))
+        return len(rows)
+
+    def backlog(self) -> int:
+        return self.store.redelivery_backlog()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                # 一批满了说明还有积压，立即处理下一批
+                while self.run_once() >= self.batch_size and not self._stop.is_set():
+                    pass
+            except Exception as e:
+                eventlog.error("redelivery_loop_failed", exc=e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="redelivery", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        """停止线程；给了 timeout 时等本轮补发做完"""
+        self._stop.set()
+        if timeout is not None and self._thread is not None:
+            self._thread.join(timeout)
+
+
+class PendingMinter:
+    def __init__(self, store, mint: Callable[[dict], bool], ready: Callable[[], bool] = lambda: True,
+                 batch_size: int = 50, interval: float = 30.0, base_delay: float = 60.0,
+                 lease_seconds: float = 300.0):
+        self.store = store  # storage.Storage
+        self.mint = mint    # mint(row) -> 是否建成（建成后由其落库并私聊）
+        self.ready = ready  # 是否可以尝试（如 Pass2U 熔断未打开）
+        self.batch_size = batch_size
+        self.interval = interval
+        self.base_delay = base_delay
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _process(self, row: dict) -> bool:
+        try:
+            with eventlog.trace(trace_id=eventlog.new_id(), eu=row["external_userid"]):
+                with eventlog.span("mint_pending"):
+                    ok = self.mint(row)
+        except Exception:
+            ok = False  # span 已记录
+        if not ok:
+            self.store.defer_mint(row["id"], time.time() + self.base_delay
+                                  + jittered_backoff(1, base=self.base_delay, cap=3600))
+        return ok
+
+    def run_once(self) -> int:
+        """处理一批；熔断打开时不领取（不顺延、不计数）；返回本批领取的行数"""
+        if not self.ready():
+            return 0
+        now = time.time()
+        rows = self.store.claim_mint(now, now + self.lease_seconds, self.batch_size)
+        for row in rows:
+            if not self.ready():  # 处理中途熔断：剩下的行等租约到期再领
+                break
+            self._process(row)
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                while self.run_once() >= self.batch_size and not self._stop.is_set():
+                    pass
+            except Exception as e:
+                eventlog.error("mint_pending_loop_failed", exc=e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mint-pending", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        self._stop.set()
+        if timeout is not None and self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,180 @@
+# retention.py
+# -*- coding: utf-8 -*-
+"""
+assignments 冷热分层
+- 老库 raw_resp 列里的原始返回分批搬进 assignment_raw（压缩），并清掉与 link 重复的 download_url
+- 已送达且早于 keep_days 的行整行复制进归档库（ATTACH），主表只留瘦行：
+  external_userid / scene / link / delivered / gw_sent 等幂等判断要用的列保留，冷列清空、原始返回删除
+  老成员再次入群仍能查到已发的券和欢迎语记录，不会重复建券 / 重复发欢迎语；行没删，物化计数不受影响
+- 跨库提交在 WAL 下不保证原子：归档端用 INSERT OR REPLACE，中途崩溃重跑也只会覆盖同一批
+- 删除后按 incremental_vacuum 归还空闲页；老库需先用 `wecom.py db-compact` 切换 auto_vacuum
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+import eventlog
+import rawstore
+from db import Database
+
+# 归档后主表清空的冷列（幂等判断、统计、管理端检索用到的列保留）
+COLD_COLUMNS = ("notes", "model_id", "barcode_message", "download_url", "expiration_date", "created_time",
+                "raw_resp")
+
+
+class Retention:
+    def __init__(self, db: Database, archive_path: str, keep_days: float = 90, batch_size: int = 1000,
+                 interval: float = 3600.0, vacuum_pages: int = 2000, pause: float = 0.05):
+        self.db = db
+        self.archive_path = archive_path
+        self.keep_days = keep_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause  # 批次之间让出写锁
+        self._compacted = False  # 新写入不再有 raw_resp，老数据搬完一遍即可
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- 归档库 ----------
+    def _attach(self) -> sqlite3.Connection:
+        con = self.db.conn()
+        if "archive" in {r[1] for r in con.execute("PRAGMA database_list")}:
+            return con
+        os.makedirs(os.path.dirname(os.path.abspath(self.archive_path)), exist_ok=True)
+        con.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        con.execute("PRAGMA archive.journal_mode=WAL")
+        # 表结构跟随主库：先建表，主库后来加的列再补上
+        cols = [(r[1], r[2]) for r in con.execute("PRAGMA main.table_info(assignments)") if r[1] != "id"]
+        con.execute("CREATE TABLE IF NOT EXISTS archive.assignments (id INTEGER PRIMARY KEY, "
+                    + ", ".join(f"{c} {t}" for c, t in cols) + ")")
+        have = {r[1] for r in con.execute("PRAGMA archive.table_info(assignments)")}
+        for c, t in cols:
+            if c not in have:
+                con.execute(f"ALTER TABLE archive.assignments ADD COLUMN {c} {t}")
+        con.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_user ON assignments (external_userid)")
+        con.execute(rawstore.DDL.replace("EXISTS assignment_raw", "EXISTS archive.assignment_raw"))
+        return con
+
+    # ---------- 老数据压缩 ----------
+    def compact_batch(self, after_id: int = 0) -> tuple[int, int]:
+        """把 id > after_id 的一批 raw_resp 搬进旁表；返回 (处理行数, 本批最大 id)"""
+        with self.db.transaction() as con:
+            rows = con.execute("""
+                SELECT id, raw_resp FROM assignments
+                WHERE id > ? AND (raw_resp IS NOT NULL OR download_url IS NOT NULL)
+                ORDER BY id LIMIT ?
+            """, (after_id, self.batch_size)).fetchall()
+            for r in rows:
+                if r["raw_resp"]:
+                    try:
+                        rawstore.save(con, r["id"], json.loads(r["raw_resp"]))
+                    except ValueError:
+                        continue  # 解析不了的保留原样
+                con.execute("UPDATE assignments SET raw_resp=NULL, download_url=NULL WHERE id=?", (r["id"],))
+        return len(rows), (rows[-1]["id"] if rows else after_id)
+
+    def compact(self) -> int:
+        if self._compacted:
+            return 0
+        total, last = 0, 0
+        while not self._stop.is_set():
+            n, last = self.compact_batch(last)
+            total += n
+            if n < self.batch_size:
+                self._compacted = True
+                break
+            time.sleep(self.pause)
+        return total
+
+    # ---------- 归档 ----------
+    def archive_batch(self) -> int:
+        """归档一批已送达的过期行（整行进归档库，主表留瘦行）；返回行数"""
+        now = datetime.utcnow()
+        cutoff = (now - timedelta(days=self.keep_days)).isoformat()
+        con = self._attach()
+        cols = ", ".join(r[1] for r in con.execute("PRAGMA main.table_info(assignments)"))
+        with self.db.transaction() as con:
+            ids = [r[0] for r in con.execute("""
+                SELECT id FROM main.assignments
+                WHERE created_at < ? AND delivered=1 AND archived_at IS NULL
+                ORDER BY created_at, id LIMIT ?
+            """, (cutoff, self.batch_size))]
+            if not ids:
+                return 0
+            batch = json.dumps(ids)
+            con.execute(f"""
+                INSERT OR REPLACE INTO archive.assignments ({cols})
+                SELECT {cols} FROM main.assignments WHERE id IN (SELECT value FROM json_each(?))
+            """, (batch,))
+            con.execute("""
+                INSERT OR REPLACE INTO archive.assignment_raw (assignment_id, body)
+                SELECT assignment_id, body FROM main.assignment_raw
+                WHERE assignment_id IN (SELECT value FROM json_each(?))
+            """, (batch,))
+            con.execute(f"""
+                UPDATE main.assignments SET {", ".join(f"{c}=NULL" for c in COLD_COLUMNS)}, archived_at=?
+                WHERE id IN (SELECT value FROM json_each(?))
+            """, (now.isoformat(), batch))
+            con.execute("DELETE FROM main.assignment_raw WHERE assignment_id IN (SELECT value FROM json_each(?))",
+                        (batch,))
+        return len(ids)
+
+    def vacuum(self) -> int:
+        """auto_vacuum=INCREMENTAL 时归还最多 vacuum_pages 个空闲页；返回归还前的空闲页数"""
+        con = self.db.conn()
+        if con.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+            return 0
+        free = con.execute("PRAGMA main.freelist_count").fetchone()[0]
+        if free:
+            # execute() 只 step 一次（只还一页），executescript 才会跑完整条语句
+            con.executescript(f"PRAGMA main.incremental_vacuum({int(self.vacuum_pages)});")
+        return free
+
+    def run_once(self) -> dict:
+        compacted = self.compact()
+        archived = 0
+        while not self._stop.is_set():
+            n = self.archive_batch()
+            archived += n
+            if n < self.batch_size:
+                break
+            time.sleep(self.pause)
+        freed = self.vacuum() if (compacted or archived) else 0
+        return {"compacted": compacted, "archived": archived, "free_pages": freed}
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                result = self.run_once()
+                if result["compacted"] or result["archived"]:
+                    eventlog.info("retention", **result)
+            except Exception as e:
+                eventlog.error("retention_failed", exc=e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def enable_incremental_vacuum(path: str) -> bool:
+    """老库切换 auto_vacuum=INCREMENTAL（需要一次完整 VACUUM，会锁库，停服时执行）；返回是否做了切换"""
+    con = sqlite3.connect(path, isolation_level=None)
+    try:
+        if con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")
+        return True
+    finally:
+        con.close()
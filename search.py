@@ -0,0 +1,109 @@
+# search.py
+# -*- coding: utf-8 -*-
+"""
+assignments 查询 / 导出（管理端）
+- 按 external_userid / chat_id / pass_id / 时间段过滤，均走索引
+- keyset 分页：以 id 为游标（id < cursor），翻到多深都不用 OFFSET 扫描
+- 导出按 id 分块读取，每块一条短查询：内存恒定，也不会长时间占着读事务（WAL 检查点照常推进）
+"""
+
+import csv
+import io
+import json
+import sqlite3
+from typing import Iterator
+
+INDEX_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_assignments_chat ON assignments (chat_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_assignments_pass ON assignments (pass_id) WHERE pass_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_assignments_created ON assignments (created_at, id)",
+]
+
+# raw_resp 体积大，不在列表 / 导出里返回
+COLUMNS = ("id", "external_userid", "chat_id", "scene", "link", "pass_id", "delivered",
+           "delivery_attempts", "gw_sent", "created_at")
+
+FILTERS = ("external_userid", "chat_id", "pass_id")
+MAX_LIMIT = 1000
+EXPORT_CHUNK = 1000
+
+
+def build_where(args) -> tuple[str, list]:
+    """args: 类 dict（request.args）；since / until 为 ISO 时间（含 since，不含 until）"""
+    clauses, params = [], []
+    for f in FILTERS:
+        v = args.get(f)
+        if v:
+            clauses.append(f"{f} = ?")
+            params.append(v)
+    if args.get("since"):
+        clauses.append("created_at >= ?")
+        params.append(args["since"])
+    if args.get("until"):
+        clauses.append("created_at < ?")
+        params.append(args["until"])
+    if args.get("delivered") not in (None, ""):
+        if args["delivered"] not in ("0", "1"):
+            raise ValueError("delivered 只能是 0 或 1")
+        clauses.append("delivered = ?")
+        params.append(int(args["delivered"]))
+    return " AND ".join(clauses) or "1=1", params
+
+
+def _page(con: sqlite3.Connection, where: str, params: list, before_id: int | None,
+          limit: int, descending: bool = True) -> list[sqlite3.Row]:
+    if before_id is not None:
+        where = f"({where}) AND id {'<' if descending else '>'} ?"
+        params = params + [before_id]
+    return con.execute(
+        f"SELECT {', '.join(COLUMNS)} FROM assignments WHERE {where}"
+        f" ORDER BY id {'DESC' if descending else 'ASC'} LIMIT ?",
+        params + [limit],
+    ).fetchall()
+
+
+def search(con: sqlite3.Connection, args, cursor: int | None = None, limit: int = 100) -> dict:
+    """新到旧一页；next_cursor 为 None 表示没有更多"""
+    limit = max(1, min(limit, MAX_LIMIT))
+    where, params = build_where(args)
+    rows = _page(con, where, params, cursor, limit)
+    return {"items": [dict(r) for r in rows],
+            "next_cursor": rows[-1]["id"] if len(rows) == limit else None}
+
+
+def iter_rows(con: sqlite3.Connection, args, chunk: int = EXPORT_CHUNK) -> Iterator[sqlite3.Row]:
+    """按 id 升序分块产出全部匹配行"""
+    where, params = build_where(args)
+    last_id = None
+    while True:
+        rows = _page(con, where, params, last_id, chunk, descending=False)
+        yield from rows
+        if len(rows) < chunk:
+            return
+        last_id = rows[-1]["id"]
+
+
+def export_ndjson(con: sqlite3.Connection, args, chunk: int = EXPORT_CHUNK) -> Iterator[str]:
+    buf = []
+    for r in iter_rows(con, args, chunk):
+        buf.append(json.dumps(dict(r), ensure_ascii=False))
+        if len(buf) >= chunk:
+            yield "\n".join(buf) + "\n"
+            buf = []
+    if buf:
+        yield "\n".join(buf) + "\n"
+
+
+def export_csv(con: sqlite3.Connection, args, chunk: int = EXPORT_CHUNK) -> Iterator[str]:
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(COLUMNS)
+    n = 0
+    for r in iter_rows(con, args, chunk):
+        w.writerow(tuple(r))
+        n += 1
+        if n % chunk == 0:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue()
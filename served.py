@@ -0,0 +1,135 @@
+# served.py
+# -*- coding: utf-8 -*-
+"""
+已发券成员的进程内缓存：(external_userid, scene) → (link, delivered)
+- 布隆过滤器覆盖 assignments 全部 (external_userid, scene)：判定「没发过」时不查库
+- 最近的条目放 LRU：命中直接返回；过滤器说「可能发过」且 LRU 未命中时，走唯一索引查一次
+- 启动时后台加载；加载完成前一律查库，保证不漏判
+- 多进程共用本地库（gunicorn 多 worker、CLI 补数）时别的进程随时会写入：
+  过滤器判定「没发过」之前先按 id 增量补齐加载之后新增的行；LRU 里只有已送达的条目可信（送达只会 0 → 1），
+  未送达的命中照样查库。exclusive=True（本进程是唯一写入方）时两者都直接作答
+- 共享存储（store.shared，多节点）时别的节点随时会写入 / 标记送达，本地缓存不可信，一律查库
+"""
+
+import hashlib
+import math
+import threading
+from typing import Optional, Tuple
+
+import eventlog
+import metrics
+from cache import TTLCache
+
+lookups = metrics.register(metrics.Counter(
+    "wecom_pass2u_served_lookups_total", "Served-member cache lookups by outcome", ("result",)))
+
+
+class BloomFilter:
+    """定长位图 + 双重哈希；只增不删，误判只会多一次查库"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, key: str):
+        d = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        pos = self._positions(key)
+        with self._lock:
+            for p in pos:
+                self._bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+def _key(external_userid: str, scene: Optional[str]) -> str:
+    return f"{external_userid}\x1f{scene or ''}"
+
+
+class ServedCache:
+    def __init__(self, store, maxsize: int = 50000, capacity: int = 1_000_000,
+                 error_rate: float = 0.01, ttl: float = 24 * 3600, exclusive: bool = False):
+        self.store = store  # storage.Storage
+        self.maxsize = maxsize
+        self.exclusive = exclusive  # 本进程是否唯一写 assignments 的进程
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._lru = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._ready = threading.Event()
+        self._last_id = 0  # 已加载到的最大 assignments.id
+        self._load_lock = threading.Lock()
+
+    def _add_rows(self, rows):
+        for r in rows:
+            if r["link"]:
+                key = _key(r["external_userid"], r["scene"])
+                self._bloom.add(key)
+                self._lru.set(key, (r["link"], r["delivered"] == 1))
+            self._last_id = max(self._last_id, r["id"])
+
+    def load(self, chunk: int = 10000):
+        """从 assignments 按 id 分块加载（只读覆盖索引列 + link），最近的 maxsize 条进 LRU"""
+        if self.store.shared:
+            return
+        with self._load_lock:
+            self._add_rows(self.store.iter_served(chunk))
+        self._ready.set()
+
+    def _catch_up(self):
+        """补齐别的进程在加载之后写入的行（SQLite 单写者，id 按提交顺序递增，不会漏行）"""
+        with self._load_lock:
+            self._add_rows(self.store.iter_served(after_id=self._last_id))
+
+    def start(self):
+        threading.Thread(target=self._load_safe, name="served-load", daemon=True).start()
+
+    def _load_safe(self):
+        try:
+            self.load()
+        except Exception as e:
+            eventlog.error("served_cache_load_failed", exc=e)
+
+    def lookup(self, external_userid: str, scene: Optional[str]) -> Optional[Tuple[str, bool]]:
+        """返回 (link, delivered)；没发过券返回 None"""
+        key = _key(external_userid, scene)
+        hit = None if self.store.shared else self._lru.get(key)
+        if hit is not None and (self.exclusive or hit[1]):
+            lookups.inc(("cache_hit",))
+            return hit
+        if hit is None and self._ready.is_set():
+            if not self.exclusive:
+                self._catch_up()
+            if key not in self._bloom:
+                lookups.inc(("filter_negative",))
+                return None
+        value = self.store.find_assignment(external_userid, scene)
+        if value is None:
+            lookups.inc(("db_miss",))
+            return None
+        lookups.inc(("db_hit",))
+        self._bloom.add(key)
+        self._lru.set(key, value)
+        return value
+
+    def remember(self, external_userid: str, scene: Optional[str], link: Optional[str], delivered: bool = False):
+        if not link:
+            return
+        key = _key(external_userid, scene)
+        self._bloom.add(key)
+        self._lru.set(key, (link, delivered))
+
+    def mark_delivered(self, external_userid: str, scene: Optional[str]):
+        key = _key(external_userid, scene)
+        hit = self._lru.get(key)
+        if hit is not None:
+            self._lru.set(key, (hit[0], True))
+
+    def __len__(self) -> int:
+        return len(self._lru)
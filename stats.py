@@ -0,0 +1,102 @@
+# stats.py
+# -*- coding: utf-8 -*-
+"""
+assignments 物化计数
+- 触发器在每次 INSERT / UPDATE / DELETE 时增量维护 assignment_stats，读统计不再扫全表
+- 三个维度：all（总数）、day（created_at 的日期）、chat（chat_id）
+- 老库首次建表时按现有数据回填一次；计数异常时可调用 rebuild() 重算
+"""
+
+import sqlite3
+
+TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS assignment_stats (
+    scope TEXT NOT NULL,                 -- all / day / chat
+    key TEXT NOT NULL,                   -- all 为 ''；day 为 YYYY-MM-DD；chat 为 chat_id
+    total INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, key)
+) WITHOUT ROWID
+"""
+
+# 一行对三个维度的贡献：sign=+1 计入，-1 扣除
+_APPLY = """
+    INSERT INTO assignment_stats (scope, key, total, delivered) VALUES
+        ('all', '', {sign}, {sign} * ({row}.delivered IS 1)),
+        ('day', substr({row}.created_at, 1, 10), {sign}, {sign} * ({row}.delivered IS 1)),
+        ('chat', COALESCE({row}.chat_id, ''), {sign}, {sign} * ({row}.delivered IS 1))
+    ON CONFLICT (scope, key) DO UPDATE SET
+        total = total + excluded.total,
+        delivered = delivered + excluded.delivered;
+"""
+
+TRIGGERS_SQL = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_assignment_stats_insert AFTER INSERT ON assignments
+    BEGIN {_APPLY.format(sign=1, row="NEW")} END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_assignment_stats_delete AFTER DELETE ON assignments
+    BEGIN {_APPLY.format(sign=-1, row="OLD")} END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_assignment_stats_update
+    AFTER UPDATE OF delivered, chat_id, created_at ON assignments
+    WHEN OLD.delivered IS NOT NEW.delivered OR OLD.chat_id IS NOT NEW.chat_id
+      OR OLD.created_at IS NOT NEW.created_at
+    BEGIN {_APPLY.format(sign=-1, row="OLD")} {_APPLY.format(sign=1, row="NEW")} END
+    """,
+]
+
+
+def init_db(con: sqlite3.Connection):
+    """建表 + 触发器；需在写事务内调用，保证回填与触发器之间没有漏计的写入"""
+    con.execute(TABLE_SQL)
+    con.execute("DROP TRIGGER IF EXISTS trg_assignment_stats_delete")  # 曾带归档判断，按当前定义重建
+    for sql in TRIGGERS_SQL:
+        con.execute(sql)
+    if con.execute("SELECT 1 FROM assignment_stats WHERE scope='all'").fetchone() is None:
+        rebuild(con)
+
+
+def rebuild(con: sqlite3.Connection):
+    """按 assignments 全量重算（需在写事务内调用；归档行在主表留有瘦行，照常计入）"""
+    con.execute("DELETE FROM assignment_stats")
+    con.execute("""
+        INSERT INTO assignment_stats (scope, key, total, delivered)
+        SELECT 'all', '', COUNT(*), COALESCE(SUM(delivered IS 1), 0) FROM assignments
+    """)
+    con.execute("""
+        INSERT INTO assignment_stats (scope, key, total, delivered)
+        SELECT 'day', substr(created_at, 1, 10), COUNT(*), SUM(delivered IS 1)
+        FROM assignments GROUP BY substr(created_at, 1, 10)
+    """)
+    con.execute("""
+        INSERT INTO assignment_stats (scope, key, total, delivered)
+        SELECT 'chat', COALESCE(chat_id, ''), COUNT(*), SUM(delivered IS 1)
+        FROM assignments GROUP BY COALESCE(chat_id, '')
+    """)
+
+
+def totals(con: sqlite3.Connection) -> dict:
+    row = con.execute("SELECT total, delivered FROM assignment_stats WHERE scope='all' AND key=''").fetchone()
+    total, delivered = (row[0], row[1]) if row else (0, 0)
+    return {"total": total, "delivered": delivered, "undelivered": total - delivered}
+
+
+def by_day(con: sqlite3.Connection, days: int = 30) -> list[dict]:
+    """最近 days 天（按日期倒序）"""
+    rows = con.execute("""
+        SELECT key, total, delivered FROM assignment_stats
+        WHERE scope='day' AND total > 0 ORDER BY key DESC LIMIT ?
+    """, (days,)).fetchall()
+    return [{"day": r[0], "total": r[1], "delivered": r[2]} for r in rows]
+
+
+def by_chat(con: sqlite3.Connection, limit: int = 50) -> list[dict]:
+    """入群人数最多的 limit 个群"""
+    rows = con.execute("""
+        SELECT key, total, delivered FROM assignment_stats
+        WHERE scope='chat' AND total > 0 ORDER BY total DESC, key LIMIT ?
+    """, (limit,)).fetchall()
+    return [{"chat_id": r[0], "total": r[1], "delivered": r[2]} for r in rows]
@@ -0,0 +1,462 @@
+# storage.py
+# -*- coding: utf-8 -*-
+"""
+存储接口：assignments / 库存 / 回调去重 / 统计的读写都经由 Storage
+- SQLiteStorage：本地文件（bot.db + coupons.db），单节点部署
+- PgStorage（pg_storage.py）：PostgreSQL，多个节点共享同一份状态
+- 两种实现共用这里的 SQL（? 占位符、UPDATE … RETURNING、ON CONFLICT），只有建表和领取时的行锁不同：
+  PostgreSQL 领取加 FOR UPDATE SKIP LOCKED，多个节点同时领取互不等待、也不会领到同一行
+- 任务队列（jobqueue）仍在各节点本地 bot.db：回调在哪个节点入队就由哪个节点处理
+"""
+
+import random
+import sqlite3
+import time
+from datetime import datetime
+from typing import Iterable, Optional
+
+import inventory
+import rawstore
+import search
+import stats
+from db import Database
+from metrics import timed
+from redelivery import INDEX_SQL as REDELIVER_INDEX_SQL
+
+DEDUP_DDL = """
+CREATE TABLE IF NOT EXISTS callback_dedup (
+    key TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_callback_dedup_seen ON callback_dedup (seen_at);
+"""
+
+_INVENTORY_COLUMNS = "id, download_link, passcode, pass_id, raw_resp"
+
+
+def _inventory_row(row) -> dict:
+    return {"id": row["id"], "download_link": row["download_link"], "passcode": row["passcode"],
+            "pass_id": row["pass_id"], "raw_resp": row["raw_resp"]}
+
+
+class Storage:
+    shared = False      # 是否多节点共享（进程内缓存不能据此判定“库里没有”）
+    _SKIP_LOCKED = ""   # 领取子查询的行锁后缀
+
+    def __init__(self, db, inventory_db):
+        self.db = db                      # assignments / 去重 / 统计
+        self.inventory_db = inventory_db  # 库存
+
+    def init_schema(self):
+        raise NotImplementedError
+
+    def conn(self):
+        """当前线程的连接（行可按列名取值，? 占位符）"""
+        return self.db.conn()
+
+    def transaction(self):
+        """工作单元：可嵌套，只有最外层提交"""
+        return self.db.transaction()
+
+    def _retry(self, fn):
+        return fn()
+
+    def warm_up(self):
+        """建好本线程连接，热点查询各跑一次（SQLite 语句缓存 / PG 连接与计划都就绪）"""
+        self.find_assignment("", "")
+        self.is_welcome_sent("", "")
+        self.event_seen("", 0)
+        self.count_unassigned()
+
+    # ---------- assignments ----------
+    @timed("db_log_pass_creation")
+    def upsert_assignment(self, external_userid: str, chat_id: Optional[str], scene: str,
+                          link: Optional[str], resp: Optional[dict]) -> int:
+        """创建/更新一条（幂等：相同 external_userid+scene）；原始返回压缩存旁表；返回行 id"""
+        resp = resp or {}
+        # download_url 与 link 相同、raw_resp 改存旁表，两列不再写入（覆盖时一并清掉老值）
+        with self.transaction() as con:
+            row_id = con.execute("""
+              INSERT INTO assignments (
+                external_userid, chat_id, link, notes, delivered, created_at,
+                scene, pass_id, model_id, barcode_message,
+                expiration_date, created_time, needs_mint
+              )
+              VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?)
+              ON CONFLICT(external_userid, COALESCE(scene,'')) DO UPDATE SET
+                link=excluded.link,
+                pass_id=excluded.pass_id,
+                model_id=excluded.model_id,
+                barcode_message=excluded.barcode_message,
+                download_url=NULL,
+                expiration_date=excluded.expiration_date,
+                created_time=excluded.created_time,
+                raw_resp=NULL,
+                needs_mint=excluded.needs_mint
+              RETURNING id
+            """, (
+                external_userid, chat_id, link or "", "pass2u_api",
+                datetime.utcnow().isoformat(),
+                scene, resp.get("passId"), str(resp.get("modelId") or ""), resp.get("barcodeMessage"),
+                resp.get("expirationDate"), resp.get("createdTime"), 0 if link else 1
+            )).fetchone()[0]
+            rawstore.save(con, row_id, resp)
+        return row_id
+
+    def find_assignment(self, external_userid: str, scene: Optional[str]) -> Optional[tuple[str, bool]]:
+        """(link, delivered)；没有记录或没有链接返回 None"""
+        row = self.conn().execute(
+            "SELECT link, delivered FROM assignments WHERE external_userid=? AND COALESCE(scene,'')=?",
+            (external_userid, scene or "")).fetchone()
+        if not row or not row[0]:
+            return None
+        return row[0], row[1] == 1
+
+    def iter_served(self, chunk: int = 10000, after_id: int = 0) -> Iterable:
+        """按 id 分块产出 id > after_id 的 (id, external_userid, scene, link, delivered)"""
+        last_id = after_id
+        while True:
+            rows = self.conn().execute(
+                "SELECT id, external_userid, scene, link, delivered FROM assignments"
+                " WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk)).fetchall()
+            yield from rows
+            if len(rows) < chunk:
+                return
+            last_id = rows[-1]["id"]
+
+    @timed("db_mark_delivered")
+    def mark_delivered(self, external_userid: str, scene: str):
+        with self.transaction() as con:
+            rows = con.execute("UPDATE assignments SET delivered=1, next_attempt_at=NULL"
+                               " WHERE external_userid=? AND COALESCE(scene,'')=? RETURNING link",
+                               (external_userid, scene)).fetchall()
+        for r in rows:
+            self.mark_inventory_delivered(r[0])
+
+    @timed("db_schedule_redelivery")
+    def schedule_redelivery(self, external_userid: str, scene: str, at: float):
+        """放入补发队列（已在队列中的保持原计划）"""
+        with self.transaction() as con:
+            con.execute("""UPDATE assignments SET next_attempt_at=?
+                           WHERE external_userid=? AND COALESCE(scene,'')=? AND delivered=0
+                             AND next_attempt_at IS NULL""",
+                        (at, external_userid, scene))
+
+    @timed("db_is_welcome_sent")
+    def is_welcome_sent(self, external_userid: str, scene: str) -> bool:
+        row = self.conn().execute(
+            "SELECT gw_sent FROM assignments WHERE external_userid=? AND COALESCE(scene,'')=?",
+            (external_userid, scene)).fetchone()
+        return bool(row and row[0] == 1)
+
+    @timed("db_mark_welcome_sent")
+    def mark_welcome_sent(self, external_userid: str, scene: str):
+        with self.transaction() as con:
+            con.execute("UPDATE assignments SET gw_sent=1, gw_sent_at=?"
+                        " WHERE external_userid=? AND COALESCE(scene,'')=?",
+                        (datetime.utcnow().isoformat(), external_userid, scene))
+
+    def load_raw(self, assignment_id: int) -> Optional[dict]:
+        row = self.conn().execute("SELECT body FROM assignment_raw WHERE assignment_id=?",
+                                  (assignment_id,)).fetchone()
+        return rawstore.unpack(bytes(row[0])) if row else None
+
+    # ---------- 补发队列 ----------
+    def claim_redelivery(self, now: float, lease_until: float, limit: int) -> list[dict]:
+        """领取到期行（领取即顺延租约，多进程 / 多节点不会重复发送）；券还没建成的行不领取，由 claim_mint 负责"""
+        def claim():
+            rows = self.conn().execute(f"""
+                UPDATE assignments
+                SET next_attempt_at = ?, delivery_attempts = COALESCE(delivery_attempts, 0) + 1
+                WHERE id IN (
+                    SELECT id FROM assignments
+                    WHERE delivered=0 AND next_attempt_at IS NOT NULL AND next_attempt_at <= ?
+                      AND needs_mint=0
+                    ORDER BY next_attempt_at
+                    LIMIT ?{self._SKIP_LOCKED}
+                ) AND next_attempt_at <= ?
+                RETURNING id, external_userid, chat_id, scene, link, delivery_attempts, created_at
+            """, (lease_until, now, limit, now)).fetchall()
+            return [dict(r) for r in rows]
+        return self._retry(claim)
+
+    def finish_redelivery(self, assignment_id: int, delivered: bool, next_at: Optional[float]):
+        """送达：delivered=1；未送达：按 next_at 顺延，None 表示退出补发队列"""
+        con = self.conn()
+        if delivered:
+            rows = con.execute("UPDATE assignments SET delivered=1, next_attempt_at=NULL WHERE id=? RETURNING link",
+                               (assignment_id,)).fetchall()
+            for r in rows:
+                self.mark_inventory_delivered(r[0])
+        else:
+            con.execute("UPDATE assignments SET next_attempt_at=? WHERE id=? AND delivered=0",
+                        (next_at, assignment_id))
+
+    # ---------- 补建券 ----------
+    def claim_mint(self, now: float, lease_until: float, limit: int) -> list[dict]:
+        """领取券没建成（needs_mint=1）且到期的行，领取即顺延租约；不占用补发的次数预算"""
+        def claim():
+            rows = self.conn().execute(f"""
+                UPDATE assignments SET mint_after = ?
+                WHERE id IN (
+                    SELECT id FROM assignments
+                    WHERE needs_mint=1 AND COALESCE(mint_after, 0) <= ?
+                    ORDER BY id
+                    LIMIT ?{self._SKIP_LOCKED}
+                ) AND COALESCE(mint_after, 0) <= ?
+                RETURNING id, external_userid, chat_id, scene
+            """, (lease_until, now, limit, now)).fetchall()
+            return [dict(r) for r in rows]
+        return self._retry(claim)
+
+    def defer_mint(self, assignment_id: int, at: float):
+        """补建失败：at 之后再试"""
+        self.conn().execute("UPDATE assignments SET mint_after=? WHERE id=? AND needs_mint=1", (at, assignment_id))
+
+    def redelivery_backlog(self) -> int:
+        """待补发行数（走部分索引，不扫全表）"""
+        return self.conn().execute(
+            "SELECT COUNT(*) FROM assignments WHERE delivered=0 AND next_attempt_at IS NOT NULL"
+        ).fetchone()[0]
+
+    # ---------- 回调去重 ----------
+    def event_seen(self, key: str, since: float) -> bool:
+        return self.conn().execute("SELECT 1 FROM callback_dedup WHERE key=? AND seen_at>?",
+                                   (key, since)).fetchone() is not None
+
+    def claim_event(self, key: str, now: float, expired_before: float) -> bool:
+        """首次出现（或旧记录已过期）返回 True 并登记；单条语句，多节点并发也只有一个成功"""
+        return self.conn().execute("""
+            INSERT INTO callback_dedup (key, seen_at) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET seen_at=excluded.seen_at
+            WHERE callback_dedup.seen_at <= ?
+            RETURNING 1
+        """, (key, now, expired_before)).fetchone() is not None
+
+    def forget_event(self, key: str):
+        self.conn().execute("DELETE FROM callback_dedup WHERE key=?", (key,))
+
+    def prune_events(self, expired_before: float):
+        self.conn().execute("DELETE FROM callback_dedup WHERE seen_at<=?", (expired_before,))
+
+    # ---------- 统计 / 查询 ----------
+    def assignment_stats(self, days: int = 30, chats: int = 50) -> dict:
+        """计数来自触发器维护的 assignment_stats，不扫 assignments 全表"""
+        con = self.conn()
+        last20 = [dict(r) for r in con.execute(
+            """SELECT id, external_userid, scene, link, pass_id, delivered, created_at
+               FROM assignments ORDER BY id DESC LIMIT 20""")]
+        return {**stats.totals(con),
+                "pending_mint": con.execute("SELECT COUNT(*) FROM assignments WHERE needs_mint=1").fetchone()[0],
+                "by_day": stats.by_day(con, days),
+                "by_chat": stats.by_chat(con, chats),
+                "last20": last20}
+
+    def search_assignments(self, args, cursor: Optional[int] = None, limit: int = 100) -> dict:
+        return search.search(self.conn(), args, cursor=cursor, limit=limit)
+
+    def export_assignments(self, args, fmt: str = "ndjson"):
+        gen = search.export_csv if fmt == "csv" else search.export_ndjson
+        return gen(self.conn(), args)
+
+    # ---------- 库存 ----------
+    def add_inventory(self, download_link: str, pass_id: Optional[str], raw_resp: Optional[str],
+                      source: str = "pass2u") -> int:
+        """券池补货：写入一条预先创建好的 Pass"""
+        return self.inventory_db.conn().execute(
+            "INSERT INTO inventory (download_link, passcode, notes, delivered, source, pass_id, raw_resp)"
+            " VALUES (?, '', '', 0, ?, ?, ?) RETURNING id",
+            (download_link, source, pass_id, raw_resp)).fetchone()[0]
+
+    def insert_inventory(self, batch: list[tuple]) -> int:
+        """批量导入 (download_link, passcode, notes, source)；重复链接跳过；返回新增行数"""
+        with self.inventory_db.transaction() as con:
+            cur = con.executemany(
+                "INSERT INTO inventory (download_link, passcode, notes, delivered, source)"
+                " VALUES (?, ?, ?, 0, ?) ON CONFLICT DO NOTHING", batch)
+            return max(cur.rowcount, 0)
+
+    def count_unassigned(self, source: Optional[str] = None) -> int:
+        con = self.inventory_db.conn()
+        if source is None:
+            return con.execute("SELECT COUNT(*) FROM inventory WHERE assigned_to IS NULL").fetchone()[0]
+        return con.execute("SELECT COUNT(*) FROM inventory WHERE source=? AND assigned_to IS NULL",
+                           (source,)).fetchone()[0]
+
+    def _free_ids_sql(self, source: Optional[str], limit: str) -> tuple[str, tuple]:
+        where = "assigned_to IS NULL" if source is None else "source = ? AND assigned_to IS NULL"
+        return (f"SELECT id FROM inventory WHERE {where} ORDER BY id LIMIT {limit}{self._SKIP_LOCKED}",
+                () if source is None else (source,))
+
+    @timed("db_inventory_assign_one")
+    def claim_inventory(self, external_userid: str, chat_id: Optional[str],
+                        source: Optional[str] = None) -> Optional[dict]:
+        """
+        分配一条未被占用的记录（FIFO），source 为空则不限来源
+        单条 UPDATE … RETURNING 一次往返完成“选中 + 占用”，不会在有库存时误报缺货
+        """
+        pick_sql, pick_args = self._free_ids_sql(source, "1")
+
+        def claim():
+            row = self.inventory_db.conn().execute(f"""
+                UPDATE inventory
+                SET assigned_to = ?, assigned_chat_id = ?, assigned_at = ?
+                WHERE id = ({pick_sql}) AND assigned_to IS NULL
+                RETURNING {_INVENTORY_COLUMNS}
+            """, (external_userid, chat_id, datetime.utcnow().isoformat(), *pick_args)).fetchone()
+            return _inventory_row(row) if row else None
+
+        return self._retry(claim)
+
+    @timed("db_inventory_assign_many")
+    def claim_inventory_many(self, users: list[str], chat_id: Optional[str],
+                             source: Optional[str] = None) -> list[Optional[dict]]:
+        """批量入群：一个事务内按顺序给 users 各分配一条；库存不足的位置返回 None"""
+        if not users:
+            return []
+        pick_sql, pick_args = self._free_ids_sql(source, "?")
+
+        def claim():
+            out: list[Optional[dict]] = []
+            with self.inventory_db.transaction() as con:
+                ids = [r[0] for r in con.execute(pick_sql, (*pick_args, len(users))).fetchall()]
+                now = datetime.utcnow().isoformat()
+                for inv_id, eu in zip(ids, users):
+                    row = con.execute(f"""
+                        UPDATE inventory
+                        SET assigned_to = ?, assigned_chat_id = ?, assigned_at = ?
+                        WHERE id = ? AND assigned_to IS NULL
+                        RETURNING {_INVENTORY_COLUMNS}
+                    """, (eu, chat_id, now, inv_id)).fetchone()
+                    if row:
+                        out.append(_inventory_row(row))
+            return out + [None] * (len(users) - len(out))
+
+        return self._retry(claim)
+
+    def mark_inventory_delivered(self, link: Optional[str]):
+        """券送达用户后调用：发出的是库存 / 券池里的券时，把该库存行记为已送达（按直链匹配）"""
+        if link:
+            self.inventory_db.conn().execute(
+                "UPDATE inventory SET delivered=1 WHERE download_link=? AND COALESCE(delivered, 0) <> 1", (link,))
+
+    def inventory_stats(self) -> dict:
+        """读物化计数（O(来源数)），按 source 细分"""
+        rows = self.inventory_db.conn().execute(
+            "SELECT source, total, assigned, delivered FROM inventory_stats").fetchall()
+        by_source = {r[0]: {"unassigned": r[1] - r[2], "assigned": r[2], "delivered": r[3]} for r in rows}
+        return {"unassigned": sum(v["unassigned"] for v in by_source.values()),
+                "assigned": sum(v["assigned"] for v in by_source.values()),
+                "delivered": sum(v["delivered"] for v in by_source.values()),
+                "by_source": by_source}
+
+
+CLAIM_RETRIES = 5
+
+
+def _is_busy(e: sqlite3.OperationalError) -> bool:
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, db: Database, inventory_db: Database = inventory._db):
+        super().__init__(db, inventory_db)
+
+    def _retry(self, fn):
+        """写锁竞争（database is locked）时带抖动退避重试"""
+        for attempt in range(CLAIM_RETRIES):
+            try:
+                return fn()
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e) or attempt == CLAIM_RETRIES - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+
+    def init_schema(self):
+        with self.db.transaction() as con:
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS assignments(
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              external_userid TEXT NOT NULL,
+              chat_id TEXT,
+              link TEXT NOT NULL,
+              notes TEXT,
+              delivered INTEGER DEFAULT 0,
+              created_at TEXT NOT NULL
+            );
+            """)
+        self._ensure_schema()
+        self.db.conn().executescript(DEDUP_DDL)
+        inventory.init_db()
+
+    def _ensure_schema(self):
+        """补充列 & 建幂等索引（external_userid+scene）"""
+        with self.db.transaction() as con:
+            cols = {r[1] for r in con.execute("PRAGMA table_info(assignments)")}
+            def add(col, typ="TEXT", default_sql=None):
+                if col not in cols:
+                    sql = f"ALTER TABLE assignments ADD COLUMN {col} {typ}"
+                    if default_sql is not None:
+                        sql += f" DEFAULT {default_sql}"
+                    con.execute(sql)
+
+            # pass 结果
+            add("scene")
+            add("pass_id")
+            add("model_id")
+            add("barcode_message")
+            add("download_url")
+            add("expiration_date")
+            add("created_time")
+            add("raw_resp")  # 老数据；新写入存 assignment_raw
+            con.execute(rawstore.DDL)
+
+            # 欢迎语只发一次
+            add("gw_sent", "INTEGER", 0)
+            add("gw_sent_at")
+
+            # 未送达补发：尝试次数 + 下次尝试时间（epoch 秒；NULL 表示不在补发队列）
+            add("delivery_attempts", "INTEGER", 0)
+            if "next_attempt_at" not in cols:
+                add("next_attempt_at", "REAL")
+                # 老库里未送达的行一并纳入补发（超龄的会在首次扫描时出队）
+                con.execute("UPDATE assignments SET next_attempt_at=? WHERE delivered=0", (time.time(),))
+            con.execute(REDELIVER_INDEX_SQL)
+
+            # 券没建成（Pass2U 故障 / 熔断）：先发“私聊领取”文案，补发线程稍后补建券再私聊
+            add("needs_mint", "INTEGER", 0)
+            add("mint_after", "REAL")  # 补建券租约 / 下次重试时间（epoch 秒）
+            con.execute("CREATE INDEX IF NOT EXISTS idx_assignments_needs_mint ON assignments (id) WHERE needs_mint=1")
+
+            # 冷热分层：整行已进归档库、主表只剩瘦行的时间（retention）
+            add("archived_at")
+            con.execute("CREATE INDEX IF NOT EXISTS idx_assignments_archive ON assignments (created_at, id)"
+                        " WHERE delivered=1 AND archived_at IS NULL")
+
+            con.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS
+                idx_assignments_user_scene
+                ON assignments (external_userid, COALESCE(scene,''))
+            """)
+
+            # 管理端查询索引
+            for sql in search.INDEX_SQL:
+                con.execute(sql)
+
+            # 物化计数（触发器维护）
+            stats.init_db(con)
+
+    def load_raw(self, assignment_id: int) -> Optional[dict]:
+        """老数据还在 raw_resp 列里的照旧读取"""
+        return rawstore.load(self.conn(), assignment_id)
+
+
+def open_storage(url: str, db: Database) -> Storage:
+    """url 为空用本地 SQLite（db 即 bot.db，与任务队列共用连接）；postgresql://… 用 PostgreSQL"""
+    if not url:
+        return SQLiteStorage(db)
+    if url.startswith(("postgres://", "postgresql://")):
+        from pg_storage import PgStorage
+        return PgStorage(url)
+    raise ValueError(f"不支持的 STORAGE_URL: {url}")
@@ -0,0 +1,64 @@
+# tests/conftest.py
+# -*- coding: utf-8 -*-
+"""模块都在仓库根目录（平铺）；测试只用临时库，不碰 bot.db / token_cache.db"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 先于 .env 生效（env.py 不覆盖已有变量）：出站地址指向本机不可达端口，token 缓存放临时目录
+os.environ["WECOM_API_BASE"] = "http://127.0.0.1:9/cgi-bin"
+os.environ["PASS2U_BASE"] = "http://127.0.0.1:9"
+os.environ["WECOM_TOKEN_DB"] = os.path.join(tempfile.mkdtemp(prefix="wecom-test-"), "token_cache.db")
+os.environ["WECOM_CACHE_DB"] = ""
+os.environ["JOURNAL_DIR"] = ""
+
+import pytest
+
+from db import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    d = Database(str(tmp_path / "test.db"))
+    yield d
+    d.close()
+
+
+@pytest.fixture
+def store(tmp_path, db, monkeypatch):
+    """本地 SQLite 存储；库存库也换成临时文件（inventory 模块级的 _db）"""
+    import inventory
+    from storage import SQLiteStorage
+    inv = Database(str(tmp_path / "inventory.db"))
+    monkeypatch.setattr(inventory, "_db", inv)
+    s = SQLiteStorage(db, inventory_db=inv)
+    s.init_schema()
+    yield s
+    inv.close()
+
+
+@pytest.fixture
+def mocks(tmp_path, monkeypatch):
+    """bench/mock_servers 的两个替身起在随机端口；出站地址、KF、Pass2U 配置都指过去"""
+    import pass2u_api
+    import wecom_api
+    from bench.mock_servers import Behaviour, Pass2UHandler, WeComHandler, serve
+    from breaker import CircuitBreaker
+
+    wecom, pass2u = Behaviour(latency_ms=0, jitter_ms=0), Behaviour(latency_ms=0, jitter_ms=0)
+    servers = [serve(WeComHandler, 0, wecom), serve(Pass2UHandler, 0, pass2u)]
+    wecom_base = f"http://127.0.0.1:{servers[0].server_port}/cgi-bin"
+    monkeypatch.setattr(wecom_api, "API_BASE", wecom_base)
+    monkeypatch.setattr(wecom_api, "OPEN_KFID", "kf-test")
+    monkeypatch.setenv("PASS2U_BASE", f"http://127.0.0.1:{servers[1].server_port}")
+    monkeypatch.setenv("PASS2U_API_KEY", "test-key")
+    monkeypatch.setenv("PASS2U_MODEL_ID", "42")
+    monkeypatch.setattr(pass2u_api, "breaker", CircuitBreaker("pass2u-test"))
+    tokens = wecom_api.TokenProvider("corp", "secret", db_path=str(tmp_path / "token.db"), api_base=wecom_base)
+    yield type("Mocks", (), {"wecom": wecom, "pass2u": pass2u, "tokens": tokens})
+    for srv in servers:
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,265 @@
+# tests/test_app.py
+# -*- coding: utf-8 -*-
+"""入群任务编排：存储 / 队列换成临时库，出站调用换成桩"""
+
+import threading
+import time
+
+import pytest
+from wechatpy.enterprise.crypto import WeChatCrypto
+
+import app as app_module
+from bench.callbacks import build_callback
+from dedup import EventDedup
+from jobqueue import JobQueue
+from served import ServedCache
+
+
+class FakeAPI:
+    def __init__(self):
+        self.kf = []
+
+    def kf_send_text(self, eu, text):
+        self.kf.append(eu)
+        return {"errcode": 0}
+
+
+@pytest.fixture
+def app(store, db, monkeypatch):
+    jobs = JobQueue(db, retry_base=0.01)
+    jobs.init_db()
+    jobs._handlers = dict(app_module.jobs._handlers)
+    minted = []
+
+    def create_pass(eu, chat_id, scene):
+        minted.append(eu)
+        return f"https://pass/{eu}", {"passId": eu}
+    monkeypatch.setattr(app_module, "store", store)
+    monkeypatch.setattr(app_module, "jobs", jobs)
+    monkeypatch.setattr(app_module, "served", ServedCache(store))
+    monkeypatch.setattr(app_module, "api", FakeAPI())
+    monkeypatch.setattr(app_module, "create_pass", create_pass)
+    app_module.minted = minted
+    return app_module
+
+
+def _kinds(app):
+    return [r["kind"] for r in app.jobs.db.conn().execute("SELECT kind FROM jobs ORDER BY id")]
+
+
+def test_add_member_mints_sends_and_records(app):
+    app.handle_add_member({"chat_id": "c", "scene": "join", "members": ["a", "b"]})
+    assert sorted(app.minted) == ["a", "b"] and sorted(app.api.kf) == ["a", "b"]
+    assert app.store.find_assignment("a", "join") == ("https://pass/a", True)
+    assert _kinds(app) == []
+
+
+def test_failed_commit_replays_writes_without_resending(app, monkeypatch):
+    real = app.store.upsert_assignment
+    calls = {"n": 0}
+
+    def flaky(*args):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise RuntimeError("storage unavailable")
+        return real(*args)
+    monkeypatch.setattr(app.store, "upsert_assignment", flaky)
+
+    app.handle_add_member({"chat_id": "c", "scene": "join", "members": ["a", "b"]})
+    assert app.store.find_assignment("a", "join") is None          # 整批回滚
+    assert _kinds(app) == ["apply_writes"]
+
+    assert app.jobs.run_one() is True
+    assert app.store.find_assignment("a", "join") == ("https://pass/a", True)
+    assert app.store.find_assignment("b", "join") == ("https://pass/b", True)
+    assert sorted(app.minted) == ["a", "b"] and sorted(app.api.kf) == ["a", "b"]  # 没有重复建券 / 私聊
+    assert _kinds(app) == []
+
+
+def test_failed_member_is_requeued_alone(app, monkeypatch):
+    def kf(eu, text):
+        if eu == "b":
+            raise ConnectionError("kf down")
+        app.api.kf.append(eu)
+        return {"errcode": 0}
+    monkeypatch.setattr(app.api, "kf_send_text", kf)
+    app.handle_add_member({"chat_id": "c", "scene": "join", "members": ["a", "b"]})
+    row = app.jobs.db.conn().execute("SELECT kind, payload FROM jobs").fetchone()
+    assert row["kind"] == "add_member" and '"members": ["b"]' in row["payload"] and '"reuse_link": true' in row["payload"]
+    assert app.store.find_assignment("b", "join") == ("https://pass/b", False)  # 券已落库，重试沿用
+
+
+def test_single_member_with_deferred_writes_is_not_retried_whole(app, monkeypatch):
+    def down(*args):
+        raise ConnectionError("down")
+    monkeypatch.setattr(app.api, "kf_send_text", down)
+    monkeypatch.setattr(app.store, "upsert_assignment", down)
+    app.handle_add_member({"chat_id": "c", "scene": "join", "members": ["a"]})  # 不抛出：否则整任务重试会重复建券
+    rows = app.jobs.db.conn().execute("SELECT kind, payload FROM jobs ORDER BY id").fetchall()
+    assert [r["kind"] for r in rows] == ["apply_writes", "add_member"]
+    assert '"reuse_link": true' in rows[1]["payload"]
+    assert app.minted == ["a"]
+
+
+@pytest.fixture
+def client(app, store, monkeypatch):
+    """回调入口：真实加解密，去重落在临时库"""
+    monkeypatch.setattr(app, "crypto", WeChatCrypto("tok", "a" * 43, "corp"))
+    monkeypatch.setattr(app, "dedup", EventDedup(store))
+    monkeypatch.setattr(app, "journal", None)
+    return app.app.test_client()
+
+
+def _post(app, client, members, create_time=1700000000):
+    params, body = build_callback(app.crypto, "chat-1", members, create_time=create_time)
+    return client.post("/wecom/callback", query_string=params, data=body)
+
+
+def test_callback_acks_and_defers_work_to_the_queue(app, client):
+    r = _post(app, client, ["a", "b"])
+    assert r.status_code == 200 and r.get_data(as_text=True) == "success"
+    assert app.minted == [] and app.api.kf == []        # 回调线程不做出站调用
+    assert _kinds(app) == ["add_member"]
+    assert app.jobs.run_one() is True
+    assert sorted(app.api.kf) == ["a", "b"]
+
+
+def test_bad_signature_is_rejected(app, client):
+    params, body = build_callback(app.crypto, "chat-1", ["a"])
+    params["msg_signature"] = "0" * 40
+    assert client.post("/wecom/callback", query_string=params, data=body).status_code == 403
+    assert _kinds(app) == []
+
+
+def test_retried_callbacks_enqueue_once(app, client):
+    params, body = build_callback(app.crypto, "chat-1", ["a", "b"], create_time=1700000000)
+    for _ in range(3):                                   # 原样重推
+        assert client.post("/wecom/callback", query_string=params, data=body).status_code == 200
+    assert _post(app, client, ["b", "a"]).status_code == 200   # 重新加密的同一事件
+    assert _kinds(app) == ["add_member"]
+    assert _post(app, client, ["a", "b"], create_time=1700000001).status_code == 200  # 新事件
+    assert _kinds(app) == ["add_member", "add_member"]
+
+
+def test_failed_enqueue_releases_the_dedup_claim(app, client, monkeypatch):
+    real = app.jobs.enqueue
+
+    def down(*a, **kw):
+        raise RuntimeError("db down")
+    monkeypatch.setattr(app.jobs, "enqueue", down)
+    assert _post(app, client, ["a"]).status_code == 500   # 不回 success：企业微信会重试
+    monkeypatch.setattr(app.jobs, "enqueue", real)
+    _post(app, client, ["a"])                            # 企业微信重试可以再次进入
+    assert _kinds(app) == ["add_member"]
+
+
+def test_members_fan_out_with_bounded_concurrency(app, monkeypatch):
+    lock, active, peak = threading.Lock(), [0], [0]
+
+    def slow_pass(eu, chat_id, scene):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return f"https://pass/{eu}", None
+    monkeypatch.setattr(app, "create_pass", slow_pass)
+    members = [f"m{i}" for i in range(app.MEMBER_CONCURRENCY + 4)]
+    t0 = time.monotonic()
+    app.handle_add_member({"chat_id": "c", "scene": "join", "members": members})
+    assert 1 < peak[0] <= app.MEMBER_CONCURRENCY
+    assert time.monotonic() - t0 < 0.05 * len(members) / 2
+    assert sorted(app.api.kf) == sorted(members)
+
+
+def test_warm_up_gives_up_on_slow_outbound(app, monkeypatch):
+    class Hanging(FakeAPI):
+        def access_token(self):
+            time.sleep(5)
+    monkeypatch.setattr(app, "api", Hanging())
+    t0 = time.monotonic()
+    app.warm_up(timeout=0.3)
+    assert time.monotonic() - t0 < 1.5
+
+
+def test_create_app_without_serve_starts_nothing(app, monkeypatch):
+    monkeypatch.setattr(app, "crypto", None)
+    monkeypatch.setattr(app, "start_workers", lambda: pytest.fail("should not start workers"))
+    assert app.create_app(migrate=False, serve=False) is app.app
+    assert app.crypto is None
+
+
+def test_drain_finishes_inflight_job_once(app, monkeypatch):
+    done, started = [], threading.Event()
+
+    def slow(payload):
+        started.set()
+        time.sleep(0.2)
+        done.append(payload["n"])
+    app.jobs.register("slow", slow)
+    monkeypatch.setattr(app, "_drained", False)
+    app.jobs.start(1)
+    app.jobs.enqueue("slow", {"n": 1})
+    assert started.wait(5)
+    app.drain(timeout=5)
+    assert done == [1] and app.jobs.depth() == {}
+    app.drain(timeout=5)                                 # 重复调用（atexit + worker_exit）无副作用
+
+
+def test_journal_replay_backfills_only_missing_members(app, tmp_path, capsys):
+    import argparse
+
+    import wecom
+    from journal import Journal
+
+    app.log_pass_creation("a", "c", "wecom_group_join", "https://pass/a-old", None)  # 故障前已发过
+    j = Journal(str(tmp_path))
+    for ts, members in ((1.0, ["a", "b"]), (2.0, ["b", "c"]), (3.0, ["d"])):
+        j.append({"ts": ts, "event": "change_external_chat", "change_type": "add_member",
+                  "chat_id": "c", "members": members})
+    j.append({"ts": 2.5, "event": "change_external_chat", "change_type": "del_member", "members": ["x"]})
+    j.close()
+
+    args = argparse.Namespace(dir=str(tmp_path), since=None, until=3.0, concurrency=2, pass2u_rate=None,
+                              kf_rate=None, retries=0, out=str(tmp_path / "out.ndjson"), dry_run=False)
+    wecom.cmd_journal_replay(args)
+    assert sorted(app.minted) == ["b", "c"] and sorted(app.api.kf) == ["b", "c"]
+    assert app.store.find_assignment("c", "wecom_group_join") == ("https://pass/c", True)
+    assert '"failed": 0' in capsys.readouterr().err
+
+
+def test_journal_replay_defers_writes_when_commit_fails(app, tmp_path, monkeypatch, capsys):
+    import argparse
+
+    import wecom
+    from journal import Journal
+
+    j = Journal(str(tmp_path))
+    j.append({"ts": 1.0, "event": "change_external_chat", "change_type": "add_member",
+              "chat_id": "c", "members": ["a"]})
+    j.close()
+
+    def down(*args):
+        raise RuntimeError("db down")
+    real = app.store.upsert_assignment
+    monkeypatch.setattr(app.store, "upsert_assignment", down)
+    args = argparse.Namespace(dir=str(tmp_path), since=None, until=None, concurrency=1, pass2u_rate=None,
+                              kf_rate=None, retries=0, out=str(tmp_path / "out.ndjson"), dry_run=False)
+    wecom.cmd_journal_replay(args)
+    assert _kinds(app) == ["apply_writes"]                     # 建券 / 私聊的结果交给队列重放
+    assert '"deferred_writes": true' in (tmp_path / "out.ndjson").read_text()
+    monkeypatch.setattr(app.store, "upsert_assignment", real)
+    assert app.jobs.run_one() is True and _kinds(app) == []
+    assert app.store.find_assignment("a", "wecom_group_join") == ("https://pass/a", True)
+
+
+def test_mint_pending_mints_sends_and_skips_while_breaker_open(app, monkeypatch):
+    app.log_pass_creation("a", "c", "join", None, None)          # Pass2U 故障时的占位
+    monkeypatch.setattr(app.minter, "store", app.store)
+    monkeypatch.setattr(app.minter, "ready", lambda: False)
+    assert app.minter.run_once() == 0 and app.minted == []
+    monkeypatch.setattr(app.minter, "ready", lambda: True)
+    assert app.minter.run_once() == 1
+    assert app.minted == ["a"] and app.api.kf == ["a"]
+    assert app.store.find_assignment("a", "join") == ("https://pass/a", True)
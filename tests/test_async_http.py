@@ -0,0 +1,71 @@
+# tests/test_async_http.py
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+import async_http
+from pass2u_api import AsyncPass2UClient, Pass2UError
+from ratelimit import ThrottledError
+from wecom_api import AsyncWeComAPI, template_list_cache
+
+
+def _run(coro_fn):
+    async def main():
+        try:
+            return await coro_fn()
+        finally:
+            await async_http.close_session()
+    return asyncio.run(main())
+
+
+def test_session_is_shared_per_loop():
+    async def sessions():
+        return async_http.get_session(), async_http.get_session()
+    a, b = _run(sessions)
+    assert a is b
+    c, _ = _run(sessions)
+    assert c is not a                  # 新的事件循环：新会话
+
+
+def test_async_wecom_concurrent_sends(mocks):
+    api = AsyncWeComAPI(mocks.tokens)
+
+    async def go():
+        return await asyncio.gather(*(api.kf_send_text(f"eu{i}", "hi") for i in range(15)))
+    results = _run(go)
+    assert all(r["errcode"] == 0 for r in results)
+    assert len({r["msgid"] for r in results}) == 15
+    assert mocks.wecom.calls["/cgi-bin/gettoken"] == 1
+
+
+def test_async_wecom_templates_and_throttle(mocks):
+    api = AsyncWeComAPI(mocks.tokens)
+    template_list_cache.clear()
+
+    async def go():
+        tpl = await api.create_group_welcome_template(text="hi")
+        await api.list_group_welcome_templates()
+        await api.list_group_welcome_templates()
+        mocks.wecom.throttle_rate = 1.0
+        with pytest.raises(ThrottledError):
+            await api.kf_add_contact_url("eu-async", scene="s")
+        return tpl
+    assert _run(go).startswith("tpl-")
+    assert mocks.wecom.calls["/cgi-bin/externalcontact/group_welcome_template/get"] == 1
+    template_list_cache.clear()
+
+
+def test_async_pass2u(mocks):
+    client = AsyncPass2UClient()
+
+    async def go():
+        links = await asyncio.gather(*(client.create_pass_link(f"eu{i}") for i in range(5)))
+        mocks.pass2u.error_rate = 1.0
+        with pytest.raises(Pass2UError):
+            await client.create_pass_raw("eu")
+        return links
+    links = _run(go)
+    assert len(set(links)) == 5 and all(link.endswith("/download") for link in links)
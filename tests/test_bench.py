@@ -0,0 +1,46 @@
+# tests/test_bench.py
+# -*- coding: utf-8 -*-
+import pytest
+
+import pass2u_api
+from bench import callbacks
+from ratelimit import ThrottledError
+from wecom_api import WeComAPI
+
+
+def test_wecom_stand_in_round_trip(mocks):
+    api = WeComAPI(mocks.tokens)
+    assert api.kf_send_text("eu", "hi")["errcode"] == 0
+    assert "u=eu" in api.kf_add_contact_url("eu", scene="bench")
+    assert mocks.wecom.calls["/cgi-bin/gettoken"] == 1
+    assert mocks.wecom.calls["/cgi-bin/kf/send_msg"] == 1
+
+
+def test_wecom_stand_in_throttles(mocks):
+    mocks.wecom.throttle_rate = 1.0
+    with pytest.raises(ThrottledError):
+        WeComAPI(mocks.tokens).kf_add_contact_url("eu-throttled", scene="bench")
+
+
+def test_pass2u_stand_in_round_trip_and_errors(mocks):
+    client = pass2u_api.Pass2UClient()
+    resp = client.create_pass_raw("eu")
+    assert resp["modelId"] == "42" and resp["barcodeMessage"] == "eu"
+    assert client.create_pass_link("eu").endswith("/download")
+    mocks.pass2u.error_rate = 1.0
+    with pytest.raises(pass2u_api.Pass2UError):
+        client.create_pass_raw("eu")
+    mocks.pass2u.error_rate, mocks.pass2u.throttle_rate = 0.0, 1.0
+    with pytest.raises(ThrottledError):
+        client.create_pass_raw("eu")
+
+
+def test_generated_callback_decrypts(monkeypatch):
+    monkeypatch.setenv("WECHAT_TOKEN", "tok")
+    monkeypatch.setenv("WECHAT_ENCODING_AES_KEY", "a" * 43)
+    monkeypatch.setenv("WECHAT_CORP_ID", "corp")
+    crypto = callbacks.make_crypto()
+    params, body = callbacks.build_callback(crypto, "chat-1", ["u1", "u2"], create_time=123)
+    xml = crypto.decrypt_message(body.decode("utf-8"), params["msg_signature"], params["timestamp"],
+                                 params["nonce"])
+    assert "<ChatId><![CDATA[chat-1]]></ChatId>" in xml and xml.count("<ExternalUserID>") == 2
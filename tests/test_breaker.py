@@ -0,0 +1,101 @@
+# tests/test_breaker.py
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import breaker as breaker_module
+import pass2u_api
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(breaker_module, "time", SimpleNamespace(monotonic=c))
+    return c
+
+
+def _cb(**kw):
+    return CircuitBreaker("t", **{"window": 4, "min_calls": 4, "open_seconds": 30, **kw})
+
+
+def test_opens_on_failure_rate(clock):
+    cb = _cb()
+    for ok in (True, False, True):
+        assert cb.allow()
+        cb.record(ok)
+    assert cb.state == CLOSED          # 不足 min_calls 不判定
+    cb.allow()
+    cb.record(False)                   # 2/4 失败
+    assert cb.state == OPEN and not cb.allow()
+    assert cb.snapshot()["retry_in"] == 30
+
+
+def test_opens_on_slow_rate(clock):
+    cb = _cb(slow_seconds=1, slow_rate=0.75)
+    for s in (2, 2, 0, 2):
+        cb.allow()
+        cb.record(True, s)
+    assert cb.state == OPEN
+
+
+def test_half_open_probe_closes_or_reopens(clock):
+    cb = _cb(probes=1)
+    for _ in range(4):
+        cb.allow()
+        cb.record(False)
+    clock.now += 30
+    assert cb.state == HALF_OPEN
+    assert cb.allow() and not cb.allow()   # 只放行一个探测
+    cb.record(False)
+    assert cb.state == OPEN and cb.snapshot()["opens"] == 2
+    clock.now += 30
+    assert cb.allow()
+    cb.record(True)
+    assert cb.state == CLOSED and cb.snapshot()["calls"] == 0
+
+
+def test_release_frees_probe_slot(clock):
+    cb = _cb(probes=1)
+    for _ in range(4):
+        cb.allow()
+        cb.record(False)
+    clock.now += 30
+    assert cb.allow()
+    cb.release()                       # 例如被本地限流：不算结果
+    assert cb.allow()
+
+
+def test_pass2u_client_fails_fast_when_open(monkeypatch):
+    monkeypatch.setenv("PASS2U_API_KEY", "k")
+    monkeypatch.setenv("PASS2U_MODEL_ID", "1")
+    cb = CircuitBreaker("pass2u", window=2, min_calls=2, open_seconds=60)
+    monkeypatch.setattr(pass2u_api, "breaker", cb)
+    client = pass2u_api.Pass2UClient(connect_timeout=0.5)  # PASS2U_BASE 指向不可达端口
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            client.create_pass_raw("eu")
+    assert cb.state == OPEN
+    with pytest.raises(pass2u_api.Pass2UCircuitOpen):
+        client.create_pass_raw("eu")
+
+
+def test_pass2u_status_accounting(monkeypatch):
+    cb = CircuitBreaker("pass2u", window=10, min_calls=10)
+    monkeypatch.setattr(pass2u_api, "breaker", cb)
+    for status in (200, 404, 503):
+        cb.allow()
+        pass2u_api._Pass2UCore._record(status, 0.1)
+    cb.allow()
+    pass2u_api._Pass2UCore._record(429, 0.1)    # 限流不计入
+    assert cb.snapshot()["calls"] == 3 and cb.snapshot()["failure_rate"] == round(1 / 3, 3)
@@ -0,0 +1,81 @@
+# tests/test_bulk.py
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import bulk
+from ratelimit import ThrottledError
+
+
+def test_read_rows_csv_and_ndjson_with_aliases(tmp_path):
+    c = tmp_path / "in.csv"
+    c.write_text("\ufeffexternal_userid , content\n u1 , hi \n", encoding="utf-8")
+    n = tmp_path / "in.ndjson"
+    n.write_text('{"user": "u2", "text": "yo"}\n\n', encoding="utf-8")
+    assert list(bulk.read_rows(str(c))) == [{"user": "u1", "text": "hi"}]
+    assert list(bulk.read_rows(str(n))) == [{"user": "u2", "text": "yo"}]
+
+
+def _run(rows, fn, checkpoint, **kw):
+    out = io.StringIO()
+    counts = bulk.run(iter(rows), fn, out, checkpoint, **kw)
+    return counts, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_run_counts_and_writes_results():
+    rows = [{"user": f"u{i}"} for i in range(10)]
+
+    def fn(row):
+        if row["user"] == "u3":
+            raise RuntimeError("bad user")
+        return {"ok": True}
+    counts, results = _run(rows, fn, bulk.Checkpoint(None), concurrency=3)
+    assert counts == {"rows": 10, "skipped": 0, "ok": 9, "failed": 1}
+    assert sorted(r["row"] for r in results) == list(range(1, 11))
+    assert "bad user" in next(r["error"] for r in results if r["user"] == "u3")
+
+
+def test_throttled_rows_are_retried():
+    calls = []
+
+    def fn(row):
+        calls.append(row["user"])
+        if len(calls) == 1:
+            raise ThrottledError("45009", retry_after=0.01)
+        return {"ok": True}
+    counts, _ = _run([{"user": "u"}], fn, bulk.Checkpoint(None), retries=2)
+    assert counts["ok"] == 1 and calls == ["u", "u"]
+
+    def always(row):
+        raise ThrottledError("45009", retry_after=0.001)
+    counts, results = _run([{"user": "u"}], always, bulk.Checkpoint(None), retries=1)
+    assert counts["failed"] == 1 and results[0]["error"].startswith("throttled")
+
+
+def test_checkpoint_resumes(tmp_path):
+    path = str(tmp_path / "done")
+    rows = [{"user": f"u{i}"} for i in range(5)]
+    cp = bulk.Checkpoint(path)
+    _run(rows[:3], lambda row: {"ok": True}, cp)
+    cp.close()
+
+    seen = []
+    cp = bulk.Checkpoint(path)
+    counts, _ = _run(rows, lambda row: seen.append(row["user"]) or {"ok": True}, cp)
+    cp.close()
+    assert counts["skipped"] == 3 and sorted(seen) == ["u3", "u4"]
+
+
+def test_checkpoint_skips_only_successful_rows(tmp_path):
+    path = str(tmp_path / "done")
+    rows = [{"user": f"u{i}"} for i in range(3)]
+    cp = bulk.Checkpoint(path)
+    counts, _ = _run(rows, lambda row: {"ok": row["user"] != "u1"}, cp)
+    cp.close()
+    assert counts["failed"] == 1
+
+    seen = []
+    cp = bulk.Checkpoint(path)
+    counts, _ = _run(rows, lambda row: seen.append(row["user"]) or {"ok": True}, cp)
+    cp.close()
+    assert counts["skipped"] == 2 and seen == ["u1"]          # 失败的行重跑时再试
@@ -0,0 +1,66 @@
+# tests/test_db.py
+# -*- coding: utf-8 -*-
+import gc
+import os
+import threading
+
+import pytest
+
+
+def _open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_same_thread_reuses_connection(db):
+    assert db.conn() is db.conn()
+    assert db.conn().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_short_lived_threads_do_not_leak_connections(db):
+    db.conn().execute("CREATE TABLE t (x)")
+    fds = _open_fds()
+
+    def work():
+        db.conn().execute("INSERT INTO t VALUES (1)")
+    for _ in range(300):
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+    gc.collect()
+    assert len(db._all) == 1                 # 只剩主线程的连接
+    assert _open_fds() <= fds + 3
+    assert db.conn().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 300
+
+
+def test_nested_transaction_commits_once_and_rolls_back_together(db):
+    db.conn().execute("CREATE TABLE t (x)")
+    with pytest.raises(RuntimeError):
+        with db.transaction() as con:
+            con.execute("INSERT INTO t VALUES (1)")
+            with db.transaction() as inner:
+                inner.execute("INSERT INTO t VALUES (2)")
+            raise RuntimeError
+    assert db.conn().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    with db.transaction() as con:
+        with db.transaction() as inner:
+            inner.execute("INSERT INTO t VALUES (3)")
+        assert con.in_transaction                 # 内层结束不提交
+    assert not db.conn().in_transaction
+
+
+def test_close_closes_live_threads_connections(db):
+    ready, done = threading.Event(), threading.Event()
+    holder = {}
+
+    def work():
+        holder["con"] = db.conn()
+        ready.set()
+        done.wait(5)
+    t = threading.Thread(target=work)
+    t.start()
+    ready.wait(5)
+    db.close()
+    with pytest.raises(Exception):
+        holder["con"].execute("SELECT 1")
+    done.set()
+    t.join()
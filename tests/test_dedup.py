@@ -0,0 +1,72 @@
+# tests/test_dedup.py
+# -*- coding: utf-8 -*-
+import time
+
+from cache import PersistentTTLCache, TTLCache
+from dedup import EventDedup, event_key, signature_key
+
+
+def test_event_key_ignores_member_order():
+    assert event_key("c", "add_member", ["b", "a"], "1") == event_key("c", "add_member", ["a", "b"], "1")
+    assert event_key("c", "add_member", ["a"], "1") != event_key("c", "add_member", ["a"], "2")
+    assert signature_key("s", "t", "n") == "sig:s:t:n"
+
+
+def test_claim_once_then_duplicate(store):
+    d = EventDedup(store)
+    assert d.claim("k") is True
+    assert d.claim("k") is False
+    assert d.seen("k")
+
+
+def test_claim_survives_restart(store):
+    """进程内 LRU 丢失后（新实例）仍从存储判重"""
+    assert EventDedup(store).claim("k") is True
+    fresh = EventDedup(store)
+    assert fresh.seen("k")
+    assert fresh.claim("k") is False
+
+
+def test_forget_allows_retry(store):
+    d = EventDedup(store)
+    d.claim("k")
+    d.forget("k")
+    assert not d.seen("k")
+    assert d.claim("k") is True
+
+
+def test_expired_record_can_be_reclaimed(store):
+    d = EventDedup(store, ttl=0.05)
+    assert d.claim("k") is True
+    time.sleep(0.1)
+    assert EventDedup(store, ttl=0.05).claim("k") is True
+
+
+def test_ttl_cache_lru_and_expiry():
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")            # a 变成最近使用
+    c.set("c", 3)         # 挤掉 b
+    assert "b" not in c and c.get("a") == 1 and c.get("c") == 3
+    assert c.pop("a") == 1 and "a" not in c
+    c.set("d", 4, ttl=0)
+    assert c.get("d", "miss") == "miss"
+
+
+def test_persistent_cache_shared_across_instances(db):
+    PersistentTTLCache(db, "kv").set(("k", 1), {"v": 1})
+    other = PersistentTTLCache(db, "kv")
+    assert other.get(("k", 1)) == {"v": 1}
+    other.pop(("k", 1))
+    assert PersistentTTLCache(db, "kv").get(("k", 1)) is None
+
+
+def test_persistent_cache_prune_keeps_maxsize(db):
+    c = PersistentTTLCache(db, "kv", maxsize=3, prune_every=1000)
+    for i in range(5):
+        c.set(i, i)
+    c.set("old", 0, ttl=-1)
+    c.prune()
+    keys = [r[0] for r in db.conn().execute("SELECT key FROM kv")]
+    assert len(keys) == 3 and '"old"' not in keys
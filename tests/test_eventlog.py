@@ -0,0 +1,106 @@
+# tests/test_eventlog.py
+# -*- coding: utf-8 -*-
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import eventlog
+
+
+@pytest.fixture
+def records(tmp_path, monkeypatch):
+    """日志改写到临时文件；返回读取函数（先 shutdown 写完队列）"""
+    path = tmp_path / "app.log"
+    eventlog.shutdown()
+    monkeypatch.setattr(eventlog, "LOG_FILE", str(path))
+    monkeypatch.setattr(eventlog, "LOG_SAMPLE", 1.0)
+
+    def read():
+        eventlog.shutdown()
+        return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()] if path.exists() else []
+    yield read
+    eventlog.shutdown()
+
+
+def test_info_emitted_before_any_warning(records):
+    eventlog.info("a")
+    eventlog.warning("b")
+    eventlog.info("c")
+    assert [r["event"] for r in records()] == ["a", "b", "c"]
+
+
+def test_success_sampling_keeps_failures(records, monkeypatch):
+    monkeypatch.setattr(eventlog, "LOG_SAMPLE", 0.0)
+    eventlog.success("ok")
+    eventlog.call("pass2u_create", 0.01, True)
+    eventlog.call("pass2u_create", 0.02, False, status=500)
+    out = records()
+    assert [(r["event"], r["level"]) for r in out] == [("call", "warning")]
+    assert out[0]["target"] == "pass2u_create" and out[0]["ms"] == 20.0 and out[0]["status"] == 500
+
+
+def test_trace_fields_follow_into_thread_pool(records):
+    def member(eu):
+        with eventlog.trace(member_trace=eu):
+            eventlog.info("member")
+
+    with eventlog.trace(trace_id="t1"):
+        run = eventlog.bound(member)
+        with ThreadPoolExecutor(2) as ex:
+            list(ex.map(run, ["m1", "m2"]))
+    eventlog.info("outside")
+    out = {r.get("member_trace"): r for r in records()}
+    assert out["m1"]["trace_id"] == out["m2"]["trace_id"] == "t1"
+    assert "trace_id" not in out[None]
+
+
+def test_span_records_error_and_reraises(records):
+    with pytest.raises(RuntimeError):
+        with eventlog.span("member"):
+            raise RuntimeError("boom")
+    (r,) = records()
+    assert r["event"] == "member" and r["level"] == "error" and "boom" in r["err"] and "ms" in r
+
+
+def test_full_queue_drops_instead_of_blocking():
+    h = eventlog._DropQueueHandler(queue.Queue(1))
+    rec = logging.LogRecord("x", logging.INFO, "", 0, "e", (), None)
+    for _ in range(3):
+        h.emit(rec)
+    assert h.dropped == 2
+
+
+def test_emit_does_not_block_on_slow_output(records, monkeypatch):
+    release = threading.Event()
+
+    class Slow(logging.Handler):
+        def emit(self, record):
+            release.wait(5)
+    monkeypatch.setattr(eventlog, "_output_handlers", lambda: [Slow()])
+    monkeypatch.setattr(eventlog, "LOG_QUEUE_SIZE", 2)
+    for i in range(10):
+        eventlog.warning("w", i=i)  # 监听线程卡住时调用方照样立即返回
+    assert eventlog.dropped() >= 7
+    release.set()
+
+
+def test_stderr_output_follows_replaced_stream(monkeypatch):
+    import io
+    import sys
+
+    eventlog.shutdown()
+    monkeypatch.setattr(eventlog, "LOG_FILE", "")
+    monkeypatch.setattr(eventlog, "LOG_SAMPLE", 1.0)
+    old = io.StringIO()
+    monkeypatch.setattr(sys, "stderr", old)
+    eventlog.setup()                       # 处理器在旧流时建好
+    old.close()
+    new = io.StringIO()
+    monkeypatch.setattr(sys, "stderr", new)  # pytest 每个阶段换一个 stderr，旧的随即关闭
+    eventlog.info("after_swap")
+    eventlog.shutdown()
+    assert '"event": "after_swap"' in new.getvalue()
@@ -0,0 +1,62 @@
+# tests/test_inventory.py
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+import inventory
+
+
+def _owner(store, inv_id):
+    return tuple(store.inventory_db.conn().execute(
+        "SELECT assigned_to, assigned_chat_id FROM inventory WHERE id=?", (inv_id,)).fetchone())
+
+
+def _stock(store, links, source="csv"):
+    return store.insert_inventory([(link, "", "", source) for link in links])
+
+
+def test_claim_is_fifo_and_marks_owner(store):
+    _stock(store, ["https://a", "https://b"])
+    row = store.claim_inventory("eu", "chat")
+    assert row["download_link"] == "https://a"
+    assert _owner(store, row["id"]) == ("eu", "chat")
+    assert store.claim_inventory("eu2", "chat")["download_link"] == "https://b"
+    assert store.claim_inventory("eu3", "chat") is None
+
+
+def test_claim_filters_by_source(store):
+    _stock(store, ["https://csv"])
+    _stock(store, ["https://pool"], source="pass2u")
+    assert store.claim_inventory("eu", None, source="pass2u")["download_link"] == "https://pool"
+    assert store.claim_inventory("eu", None, source="pass2u") is None
+    assert store.count_unassigned() == 1
+
+
+def test_claim_many_pads_shortfall_with_none(store):
+    _stock(store, ["https://a", "https://b"])
+    rows = store.claim_inventory_many(["u1", "u2", "u3"], "chat")
+    assert rows[2] is None
+    assert [_owner(store, r["id"])[0] for r in rows[:2]] == ["u1", "u2"]
+    assert store.claim_inventory_many([], "chat") == []
+
+
+def test_import_stream_batches_and_counts(store):
+    body = "download_link,passcode\n" + "".join(f"https://i/{i % 4},p\n" for i in range(6)) + ",x\n"
+    progress = []
+    counts = inventory.import_stream(io.StringIO(body), store.insert_inventory, batch_size=2,
+                                     progress=progress.append)
+    assert counts == {"rows": 7, "inserted": 4, "skipped": 2, "invalid": 1}
+    assert len(progress) == 3 and progress[-1]["inserted"] == 4
+    assert store.inventory_stats()["by_source"]["csv"]["unassigned"] == 4
+
+
+def test_import_binary_stream_strips_bom_and_header_spaces(store):
+    body = "\ufeff download_link , notes\nhttps://x,n\n".encode("utf-8")
+    counts = inventory.import_binary_stream(io.BytesIO(body), store.insert_inventory)
+    assert counts["inserted"] == 1
+
+
+def test_import_requires_download_link_column(store):
+    with pytest.raises(ValueError):
+        inventory.import_stream(io.StringIO("link\nhttps://x\n"), store.insert_inventory)
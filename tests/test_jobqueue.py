@@ -0,0 +1,114 @@
+# tests/test_jobqueue.py
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+import eventlog
+from jobqueue import JobQueue
+from ratelimit import ThrottledError
+
+
+@pytest.fixture
+def q(db):
+    jq = JobQueue(db, max_attempts=2, retry_base=0.01)
+    jq.init_db()
+    return jq
+
+
+def _job(q, job_id):
+    return q.db.conn().execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+
+
+def test_success_deletes_job(q):
+    seen = []
+    q.register("k", seen.append)
+    q.enqueue("k", {"x": 1})
+    assert q.run_one() is True
+    assert seen == [{"x": 1}]
+    assert q.depth() == {}
+    assert q.run_one() is False
+
+
+def test_failure_retries_then_marks_failed(q):
+    def boom(_):
+        raise RuntimeError("boom")
+    q.register("k", boom)
+    job_id = q.enqueue("k", {})
+    q.run_one()
+    row = _job(q, job_id)
+    assert row["status"] == "pending" and row["attempts"] == 1 and "boom" in row["last_error"]
+    time.sleep(0.05)
+    q.run_one()
+    assert _job(q, job_id)["status"] == "failed"
+    assert q.run_one() is False  # failed 不再领取
+
+
+def test_retry_after_is_respected(q):
+    def throttled(_):
+        raise ThrottledError("slow down", retry_after=60)
+    q.register("k", throttled)
+    job_id = q.enqueue("k", {})
+    q.run_one()
+    assert _job(q, job_id)["available_at"] > time.time() + 50
+
+
+def test_expired_lease_is_reclaimed(q):
+    q.lease_seconds = 0
+    q.register("k", lambda _: None)
+    job_id = q.enqueue("k", {})
+    assert q._claim()["id"] == job_id        # 模拟领取后崩溃
+    assert q._claim()["id"] == job_id        # 租约到期后再次领取
+
+
+def test_running_job_lease_is_renewed(q):
+    q.lease_seconds = 0.3
+    started, release = threading.Event(), threading.Event()
+
+    def slow(_):
+        started.set()
+        release.wait(5)
+    q.register("k", slow)
+    job_id = q.enqueue("k", {})
+    q.start(1)
+    try:
+        assert started.wait(5)
+        time.sleep(1)                            # 远超一个租约
+        assert _job(q, job_id)["available_at"] > time.time()
+        assert q._claim() is None                # 续租中不会被别处领走
+    finally:
+        release.set()
+        assert q.stop(5)
+
+
+def test_malformed_payload_goes_through_fail(q):
+    q.register("k", lambda _: None)
+    now = time.time()
+    q.db.conn().execute("INSERT INTO jobs (kind, payload, status, attempts, available_at, created_at, updated_at)"
+                        " VALUES ('k', '{not json', 'pending', 0, ?, ?, ?)", (now, now, now))
+    assert q.run_one() is True               # 不抛出：worker 线程不能因此退出
+    row = q.db.conn().execute("SELECT status, last_error FROM jobs").fetchone()
+    assert row["status"] == "pending" and "malformed" in row["last_error"]
+
+
+def test_trace_id_travels_with_payload(q):
+    seen = []
+    q.register("k", lambda p: seen.append(eventlog.current("trace_id")))
+    with eventlog.trace(trace_id="cb-1"):
+        q.enqueue("k", {})
+    q.enqueue("k", {})
+    q.run_one()
+    q.run_one()
+    assert seen[0] == "cb-1" and seen[1] and seen[1] != "cb-1"
+
+
+def test_stop_waits_for_inflight_job(q):
+    q.poll_interval = 0.01
+    done = []
+    q.register("k", lambda _: (time.sleep(0.2), done.append(1)))
+    q.enqueue("k", {})
+    q.start(1)
+    time.sleep(0.05)
+    assert q.stop(timeout=2) is True
+    assert done == [1]
@@ -0,0 +1,32 @@
+# tests/test_journal.py
+# -*- coding: utf-8 -*-
+import os
+
+import journal
+from journal import Journal
+
+
+def test_append_then_close_flushes_everything(tmp_path):
+    j = Journal(str(tmp_path), fsync_interval=0.01)
+    for i in range(100):
+        j.append({"i": i, "msg": "入群"})
+    j.close()
+    assert [r["i"] for r in journal.read(journal.segments(str(tmp_path)))] == list(range(100))
+
+
+def test_segments_rotate_by_size(tmp_path):
+    """轮转发生在批次之间：直接在当前线程按批写入"""
+    j = Journal(str(tmp_path), segment_bytes=200)
+    for i in range(0, 50, 5):
+        j._write([f'{{"i":{k},"pad":"{"x" * 20}"}}\n' for k in range(i, i + 5)])
+    j._sync()
+    paths = journal.segments(str(tmp_path))
+    assert len(paths) == 5                 # 每批约 175 字节，两批一段
+    assert [r["i"] for r in journal.read(paths)] == list(range(50))
+
+
+def test_read_skips_torn_tail(tmp_path):
+    path = os.path.join(str(tmp_path), "events-1.ndjson")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"a":1}\n{"a":2}\n{"a":')
+    assert list(journal.read([path])) == [{"a": 1}, {"a": 2}]
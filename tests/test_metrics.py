@@ -0,0 +1,71 @@
+# tests/test_metrics.py
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+import metrics
+
+
+def _in_threads(n, fn):
+    for _ in range(n):
+        t = threading.Thread(target=fn)
+        t.start()
+        t.join()
+
+
+def test_counter_sums_across_threads_and_folds_dead_shards():
+    c = metrics.Counter("c_total", "help", ("k",))
+    _in_threads(300, lambda: c.inc(("a",)))
+    c.inc(("a",), 2)
+    assert c.values() == {("a",): 302}
+    assert len(c._shards) == 1  # 只剩主线程
+    _in_threads(5, lambda: c.inc(("b",)))
+    assert c.values() == {("a",): 302, ("b",): 5}
+
+
+def test_histogram_buckets_survive_folding():
+    h = metrics.Histogram("h_seconds", "help", ("stage",), buckets=(0.1, 1))
+    _in_threads(50, lambda: h.observe(0.05, ("s",)))
+    _in_threads(50, lambda: h.observe(5, ("s",)))
+    text = "\n".join(h.render())
+    assert 'h_seconds_bucket{stage="s",le="0.1"} 50' in text
+    assert 'h_seconds_bucket{stage="s",le="+Inf"} 100' in text
+    assert 'h_seconds_count{stage="s"} 100' in text
+    assert len(h._shards) <= 1
+
+
+def test_timed_counts_errors_and_explicit_failures():
+    stage = ("test_stage",)
+    before = metrics.stage_errors.values().get(stage, 0)
+    with pytest.raises(ValueError):
+        with metrics.timed("test_stage"):
+            raise ValueError
+    with metrics.timed("test_stage") as t:
+        t.fail(status=500)
+    assert metrics.stage_errors.values()[stage] == before + 2
+    assert "wecom_pass2u_stage_seconds_count{stage=\"test_stage\"}" in "\n".join(metrics.stage_latency.render())
+
+
+def test_gauge_errors_do_not_break_scrape():
+    g = metrics.Gauge("g", "help", lambda: 1 / 0)
+    assert g.render()[-1].startswith("# error:")
+
+
+def test_multiproc_snapshots_are_summed_across_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "MULTIPROC_DIR", str(tmp_path))
+    c = metrics.Counter("mp_total", "help", ("k",))
+    h = metrics.Histogram("mp_seconds", "help", buckets=(1,))
+    monkeypatch.setattr(metrics, "_registry", [c, h])
+    c.inc(("a",), 2)
+    h.observe(0.5)
+    metrics.write_snapshot()
+    # 另一个 worker 的快照；快照写坏的文件跳过
+    (tmp_path / "metrics-1.json").write_text(
+        '{"mp_total": [[["a"], 3], [["b"], 1]], "mp_seconds": [[[], [0, 1, 7.0]]]}')
+    (tmp_path / "metrics-2.json").write_text("{")
+    assert c.values() == {("a",): 5, ("b",): 1}
+    text = "\n".join(h.render())
+    assert 'mp_seconds_count 2' in text and 'mp_seconds_sum 7.5' in text
+    metrics.clear_snapshots()
+    assert c.values() == {("a",): 2}
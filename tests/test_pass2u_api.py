@@ -0,0 +1,51 @@
+# tests/test_pass2u_api.py
+# -*- coding: utf-8 -*-
+import pytest
+
+import pass2u_api
+from pass2u_api import Pass2UClient, Pass2UError, extract_link
+
+
+def test_extract_link_prefers_direct_link():
+    assert extract_link({"downloadUrl": "https://d", "passId": "p"}, "https://b") == "https://d"
+    assert extract_link({"passId": "p"}, "https://b") == "https://b/v2/passes/p/download"
+    assert extract_link({}, "https://b") is None and extract_link("x", "https://b") is None
+
+
+def test_config_is_read_once(monkeypatch):
+    monkeypatch.setenv("PASS2U_API_KEY", "k")
+    monkeypatch.setenv("PASS2U_MODEL_ID", "7")
+    monkeypatch.setenv("PASS2U_CONNECT_TIMEOUT", "1.5")
+    monkeypatch.setenv("PASS2U_AUTH_HEADER", "Authorization")
+    monkeypatch.setenv("PASS2U_AUTH_SCHEME", "Bearer")
+    client = Pass2UClient(base="https://p2u/", read_timeout=9)
+    assert client.create_url.startswith("https://p2u/v2/models/7/passes?utm_source=")
+    assert client.timeout == (1.5, 9.0)
+    assert client.s.headers["Authorization"] == "Bearer k"
+    monkeypatch.delenv("PASS2U_MODEL_ID")
+    with pytest.raises(Pass2UError):
+        Pass2UClient()
+
+
+def test_sequential_calls_reuse_one_connection(mocks):
+    client = Pass2UClient()
+    for i in range(5):
+        assert client.create_pass_raw(f"eu{i}")["barcodeMessage"] == f"eu{i}"
+    pools = list(client.s.get_adapter(client.base).poolmanager.pools._container.values())
+    assert [(p.num_connections, p.num_requests) for p in pools] == [(1, 5)]
+    client.close()
+
+
+def test_shared_client_and_raw_helper(mocks, monkeypatch):
+    monkeypatch.setattr(pass2u_api, "_client", None)
+    assert pass2u_api.get_client() is pass2u_api.get_client()
+    assert pass2u_api.create_pass2u_raw("eu", {"scene": "join"})["passId"]
+    assert mocks.pass2u.calls["/v2/models/42/passes"] == 1
+
+
+def test_non_json_response_is_an_error():
+    with pytest.raises(Pass2UError, match="non-JSON"):
+        pass2u_api._Pass2UCore._result(200, {}, "<html>")
+    with pytest.raises(pass2u_api.Pass2UThrottled) as e:
+        pass2u_api._Pass2UCore._result(429, {"Retry-After": "7"}, "")
+    assert e.value.retry_after == 7
@@ -0,0 +1,66 @@
+# tests/test_pass_pool.py
+# -*- coding: utf-8 -*-
+import itertools
+import threading
+
+import pass_pool
+from pass_pool import PassPoolFiller
+
+
+class FakeClient:
+    base = "https://p2u"
+
+    def __init__(self, fail_every: int = 0):
+        self.calls = 0
+        self.fail_every = fail_every
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def create_pass_raw(self, external_userid, extras=None):
+        with self._lock:
+            self.calls += 1
+            n = self.calls
+        if self.fail_every and n % self.fail_every == 0:
+            raise RuntimeError("mint failed")
+        return {"passId": f"p{next(self._ids)}"}
+
+
+def test_fill_tops_up_to_high_water(store):
+    client = FakeClient()
+    f = PassPoolFiller(lambda: client, store, low=3, high=5)
+    assert f.fill_once() == 5
+    assert store.count_unassigned(source=pass_pool.SOURCE) == 5
+    assert f.fill_once() == 0          # 高于低水位不补
+    assert client.calls == 5
+
+
+def test_fill_counts_only_successful_mints(store):
+    f = PassPoolFiller(lambda: FakeClient(fail_every=2), store, low=1, high=4, concurrency=1)
+    assert f.fill_once() == 2
+    assert store.count_unassigned(source=pass_pool.SOURCE) == 2
+
+
+def test_claim_returns_link_and_raw_response(store):
+    PassPoolFiller(FakeClient, store, low=1, high=1).fill_once()
+    link, resp = pass_pool.claim(store, "eu", "chat")
+    assert link == f"https://p2u/v2/passes/{resp['passId']}/download"
+    assert pass_pool.claim(store, "eu2", "chat") is None   # 池子空
+
+
+def test_claim_ignores_other_sources(store):
+    store.insert_inventory([("https://imported/1", "", "", "import")])
+    assert pass_pool.claim(store, "eu", "chat") is None
+
+
+def test_fill_skips_while_not_ready(store):
+    client = FakeClient()
+    f = PassPoolFiller(lambda: client, store, low=1, high=3, ready=lambda: False)
+    assert f.fill_once() == 0 and client.calls == 0
+
+
+def test_delivered_pool_pass_counts_as_delivered(store):
+    PassPoolFiller(FakeClient, store, low=1, high=1).fill_once()
+    link, resp = pass_pool.claim(store, "eu", "chat")
+    store.upsert_assignment("eu", "chat", "join", link, resp)
+    store.mark_delivered("eu", "join")
+    assert store.inventory_stats()["by_source"][pass_pool.SOURCE]["delivered"] == 1
@@ -0,0 +1,59 @@
+# tests/test_ratelimit.py
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+from ratelimit import RateLimiter, ThrottledError, TokenBucket, jittered_backoff, parse_limits
+from wecom_api import _WeComCore, is_throttled
+
+
+def test_parse_limits():
+    b = parse_limits(" kf/send_msg=20/1, pass2u=30/60 ,bad, ")
+    assert set(b) == {"kf/send_msg", "pass2u"}
+    assert (b["kf/send_msg"].rate, b["kf/send_msg"].burst) == (20, 20)
+    assert (b["pass2u"].rate, b["pass2u"].burst) == (0.5, 30)
+
+
+def test_bucket_allows_burst_then_waits():
+    b = TokenBucket(rate=50, burst=3)
+    assert all(b.acquire(timeout=0) for _ in range(3))
+    assert not b.acquire(timeout=0)
+    t0 = time.monotonic()
+    assert b.acquire(timeout=1)
+    assert time.monotonic() - t0 >= 0.015     # 补一个令牌要 20ms
+
+
+def test_async_bucket():
+    b = TokenBucket(rate=50, burst=1)
+
+    async def run():
+        return [await b.acquire_async(timeout=1) for _ in range(3)]
+    assert asyncio.run(run()) == [True, True, True]
+
+
+def test_limiter_raises_throttled_only_for_configured_keys():
+    lim = RateLimiter(parse_limits("x=1/60"))
+    lim.acquire("x", timeout=0)
+    with pytest.raises(ThrottledError):
+        lim.acquire("x", timeout=0)
+    for _ in range(5):
+        lim.acquire("unlimited", timeout=0)
+
+
+def test_jittered_backoff_is_capped():
+    assert all(0 <= jittered_backoff(a, base=1, cap=10) <= 10 for a in range(20))
+    assert jittered_backoff(0, base=1) <= 1
+
+
+def test_wecom_throttle_codes_raise():
+    assert is_throttled({"errcode": 45009}) and not is_throttled({"errcode": 0})
+    with pytest.raises(ThrottledError):
+        _WeComCore._add_contact_result(200, '{"errcode": 45033, "errmsg": "busy"}')
+
+
+def test_parse_limits_splits_quota_across_processes():
+    b = parse_limits("kf/send_msg=20/1,pass2u=1/1", processes=4)
+    assert (b["kf/send_msg"].rate, b["kf/send_msg"].burst) == (5, 5)
+    assert (b["pass2u"].rate, b["pass2u"].burst) == (0.25, 1)
@@ -0,0 +1,31 @@
+# tests/test_rawstore.py
+# -*- coding: utf-8 -*-
+import json
+
+import rawstore
+
+RESP = {"passId": "p1", "barcodeMessage": "条码" * 50}
+
+
+def test_pack_roundtrip_and_compresses():
+    body = rawstore.pack(RESP)
+    assert rawstore.unpack(body) == RESP
+    assert len(body) < len(json.dumps(RESP, ensure_ascii=False).encode("utf-8"))
+
+
+def test_upsert_writes_side_table_not_raw_resp(store):
+    row_id = store.upsert_assignment("eu", "chat", "join", "https://l/1", RESP)
+    con = store.conn()
+    assert con.execute("SELECT raw_resp FROM assignments WHERE id=?", (row_id,)).fetchone()[0] is None
+    assert store.load_raw(row_id) == RESP
+
+
+def test_save_none_clears_and_legacy_column_still_reads(store):
+    con = store.conn()
+    row_id = store.upsert_assignment("eu", "chat", "join", "https://l/1", RESP)
+    rawstore.save(con, row_id, None)
+    assert rawstore.load(con, row_id) is None
+    con.execute("UPDATE assignments SET raw_resp=? WHERE id=?", (json.dumps({"old": 1}), row_id))
+    assert rawstore.load(con, row_id) == {"old": 1}
+    con.execute("UPDATE assignments SET raw_resp='not json' WHERE id=?", (row_id,))
+    assert rawstore.load(con, row_id) is None
@@ -0,0 +1,127 @@
+# tests/test_redelivery.py
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from redelivery import PendingMinter, Redeliverer
+
+
+def _pending(store, eu, at=None):
+    store.upsert_assignment(eu, "chat", "join", f"https://l/{eu}", None)
+    store.schedule_redelivery(eu, "join", time.time() - 1 if at is None else at)
+
+
+def _row(store, eu):
+    return store.conn().execute(
+        "SELECT delivered, next_attempt_at, delivery_attempts FROM assignments WHERE external_userid=?",
+        (eu,)).fetchone()
+
+
+@pytest.fixture
+def make(store):
+    made = []
+
+    def build(send, **kw):
+        r = Redeliverer(store, send, interval=0.01, base_delay=60, concurrency=2, **kw)
+        made.append(r)
+        return r
+    yield build
+    for r in made:
+        r.stop()
+
+
+def test_success_marks_delivered(store, make):
+    _pending(store, "eu")
+    sent = []
+    r = make(lambda row: sent.append(row["external_userid"]) or True)
+    assert r.run_once() == 1
+    assert sent == ["eu"]
+    assert _row(store, "eu")["delivered"] == 1 and r.backlog() == 0
+
+
+def test_failure_backs_off(store, make):
+    _pending(store, "eu")
+
+    def boom(row):
+        raise RuntimeError("kf down")
+    r = make(boom)
+    r.run_once()
+    row = _row(store, "eu")
+    assert row["delivered"] == 0 and row["delivery_attempts"] == 1
+    assert row["next_attempt_at"] >= time.time() + 59
+    assert r.run_once() == 0          # 还没到期
+
+
+def test_not_due_rows_are_left_alone(store, make):
+    _pending(store, "later", at=time.time() + 3600)
+    assert make(lambda row: True).run_once() == 0
+
+
+def test_exhausted_rows_leave_the_queue(store, make):
+    _pending(store, "eu")
+    r = make(lambda row: pytest.fail("should not send"), max_attempts=0)
+    r.run_once()
+    assert _row(store, "eu")["next_attempt_at"] is None
+    assert r.backlog() == 0
+
+
+def test_background_loop_drains_backlog(store, make):
+    for i in range(5):
+        _pending(store, f"eu{i}")
+    r = make(lambda row: True, batch_size=2)
+    r.start()
+    deadline = time.time() + 5
+    while r.backlog() and time.time() < deadline:
+        time.sleep(0.01)
+    r.stop(timeout=5)
+    assert r.backlog() == 0
+
+
+def _unminted(store, eu):
+    """券没建成：私聊了“领取”文案，行在补发队列里等补建"""
+    store.upsert_assignment(eu, "chat", "join", None, None)
+    store.schedule_redelivery(eu, "join", time.time() - 1)
+
+
+def _mint_state(store, eu):
+    return store.conn().execute(
+        "SELECT needs_mint, mint_after, delivery_attempts, next_attempt_at FROM assignments"
+        " WHERE external_userid=?", (eu,)).fetchone()
+
+
+def test_unminted_rows_do_not_spend_the_kf_budget(store, make):
+    _unminted(store, "eu")
+    r = make(lambda row: pytest.fail("no link to send"), max_attempts=1)
+    for _ in range(3):
+        assert r.run_once() == 0
+    row = _mint_state(store, "eu")
+    assert row["delivery_attempts"] == 0 and row["next_attempt_at"] is not None
+
+
+def test_minter_skips_whole_sweep_while_not_ready(store):
+    _unminted(store, "eu")
+    m = PendingMinter(store, lambda row: pytest.fail("breaker open"), ready=lambda: False)
+    assert m.run_once() == 0
+    assert _mint_state(store, "eu")["mint_after"] is None
+
+
+def test_minter_defers_failures_and_keeps_the_row(store):
+    _unminted(store, "eu")
+    m = PendingMinter(store, lambda row: False, base_delay=60)
+    assert m.run_once() == 1
+    row = _mint_state(store, "eu")
+    assert row["needs_mint"] == 1 and row["mint_after"] >= time.time() + 59
+    assert m.run_once() == 0                        # 还没到期
+
+
+def test_minted_row_returns_to_kf_redelivery(store, make):
+    _unminted(store, "eu")
+
+    def mint(row):
+        store.upsert_assignment(row["external_userid"], row["chat_id"], row["scene"], "https://l/new", None)
+        return True
+    assert PendingMinter(store, mint).run_once() == 1
+    sent = []
+    assert make(lambda row: sent.append(row["link"]) or True).run_once() == 1
+    assert sent == ["https://l/new"]
@@ -0,0 +1,72 @@
+# tests/test_retention.py
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import rawstore
+from retention import COLD_COLUMNS, Retention
+
+RESP = {"passId": "p1", "modelId": 7, "barcodeMessage": "b", "expirationDate": "2030-01-01"}
+
+
+@pytest.fixture
+def retention(store, tmp_path):
+    return Retention(store.db, str(tmp_path / "archive.db"), keep_days=30, batch_size=2, pause=0)
+
+
+def _age(store, days=60):
+    store.conn().execute("UPDATE assignments SET created_at=datetime('now', ?)", (f"-{days} days",))
+
+
+def test_archived_member_still_counts_as_served(store, retention):
+    store.upsert_assignment("eu1", "chat", "join", "https://l/1", RESP)
+    store.mark_delivered("eu1", "join")
+    store.mark_welcome_sent("eu1", "join")
+    store.upsert_assignment("eu2", "chat", "join", "https://l/2", RESP)  # 未送达：不归档
+    _age(store)
+    before = store.assignment_stats()
+
+    assert retention.run_once()["archived"] == 1
+
+    assert store.find_assignment("eu1", "join") == ("https://l/1", True)
+    assert store.is_welcome_sent("eu1", "join")
+    assert {r["external_userid"] for r in store.iter_served()} == {"eu1", "eu2"}
+    assert store.assignment_stats() == before
+    row = store.conn().execute("SELECT * FROM assignments WHERE external_userid='eu1'").fetchone()
+    assert row["archived_at"] and all(row[c] is None for c in COLD_COLUMNS)
+    assert store.load_raw(row["id"]) is None
+
+
+def test_archive_keeps_full_row_and_raw(store, retention):
+    row_id = store.upsert_assignment("eu1", "chat", "join", "https://l/1", RESP)
+    store.mark_delivered("eu1", "join")
+    _age(store)
+    retention.run_once()
+    con = store.conn()
+    arch = con.execute("SELECT * FROM archive.assignments WHERE id=?", (row_id,)).fetchone()
+    assert arch["barcode_message"] == "b" and arch["link"] == "https://l/1"
+    body = con.execute("SELECT body FROM archive.assignment_raw WHERE assignment_id=?", (row_id,)).fetchone()[0]
+    assert rawstore.unpack(body) == RESP
+
+
+def test_rerun_is_idempotent_and_respects_keep_days(store, retention):
+    for i in range(5):
+        store.upsert_assignment(f"eu{i}", "chat", "join", f"https://l/{i}", RESP)
+        store.mark_delivered(f"eu{i}", "join")
+    _age(store)
+    store.upsert_assignment("fresh", "chat", "join", "https://l/f", RESP)
+    store.mark_delivered("fresh", "join")
+    assert retention.run_once()["archived"] == 5   # 分 3 批
+    assert retention.run_once()["archived"] == 0
+    assert store.conn().execute("SELECT COUNT(*) FROM archive.assignments").fetchone()[0] == 5
+
+
+def test_compact_moves_legacy_raw_resp(store, retention):
+    row_id = store.upsert_assignment("eu1", "chat", "join", "https://l/1", None)
+    store.conn().execute("UPDATE assignments SET raw_resp=?, download_url='x' WHERE id=?",
+                         (json.dumps(RESP), row_id))
+    assert retention.compact() == 1
+    row = store.conn().execute("SELECT raw_resp, download_url FROM assignments WHERE id=?", (row_id,)).fetchone()
+    assert tuple(row) == (None, None)
+    assert store.load_raw(row_id) == RESP
@@ -0,0 +1,55 @@
+# tests/test_search.py
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+
+import pytest
+
+import search
+
+
+@pytest.fixture
+def rows(store):
+    for i in range(7):
+        store.upsert_assignment(f"eu{i}", "chatA" if i % 2 else "chatB", "join", f"https://l/{i}",
+                                {"passId": f"p{i}"})
+    store.mark_delivered("eu1", "join")
+    return store
+
+
+def test_keyset_pages_cover_everything_once(rows):
+    seen, cursor = [], None
+    while True:
+        page = rows.search_assignments({}, cursor=cursor, limit=3)
+        seen += [r["id"] for r in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == sorted(seen, reverse=True) and len(set(seen)) == 7
+
+
+def test_filters(rows):
+    assert {r["external_userid"] for r in rows.search_assignments({"chat_id": "chatA"})["items"]} \
+        == {"eu1", "eu3", "eu5"}
+    assert [r["external_userid"] for r in rows.search_assignments({"delivered": "1"})["items"]] == ["eu1"]
+    assert rows.search_assignments({"since": "2999-01-01"})["items"] == []
+    with pytest.raises(ValueError):
+        search.build_where({"delivered": "yes"})
+
+
+def test_list_omits_raw_response(rows):
+    item = rows.search_assignments({}, limit=1)["items"][0]
+    assert set(item) == set(search.COLUMNS)
+
+
+def test_exports_stream_in_chunks(rows):
+    con = rows.conn()
+    chunks = list(search.export_ndjson(con, {}, chunk=3))
+    assert len(chunks) == 3
+    ids = [json.loads(line)["id"] for c in chunks for line in c.splitlines()]
+    assert ids == sorted(ids) and len(ids) == 7
+
+    text = "".join(search.export_csv(con, {"chat_id": "chatB"}, chunk=2))
+    table = list(csv.reader(io.StringIO(text)))
+    assert table[0] == list(search.COLUMNS) and len(table) == 5
@@ -0,0 +1,70 @@
+# tests/test_served.py
+# -*- coding: utf-8 -*-
+from served import BloomFilter, ServedCache
+
+
+def test_bloom_has_no_false_negatives():
+    b = BloomFilter(1000)
+    keys = [f"k{i}" for i in range(1000)]
+    for k in keys:
+        b.add(k)
+    assert all(k in b for k in keys)
+    assert sum(f"x{i}" in b for i in range(1000)) < 50   # 1% 误判率，留足余量
+
+
+def test_lookup_before_load_falls_back_to_store(store):
+    store.upsert_assignment("eu", "chat", "join", "https://l/1", None)
+    c = ServedCache(store)
+    assert c.lookup("eu", "join") == ("https://l/1", False)
+    assert c.lookup("other", "join") is None
+
+
+def test_loaded_cache_answers_from_memory(store, monkeypatch):
+    store.upsert_assignment("eu", "chat", "join", "https://l/1", None)
+    store.mark_delivered("eu", "join")
+    c = ServedCache(store, exclusive=True)
+    c.load()
+
+    def no_db(*a):
+        raise AssertionError("should not hit the store")
+    monkeypatch.setattr(store, "find_assignment", no_db)
+    assert c.lookup("eu", "join") == ("https://l/1", True)
+    assert c.lookup("never", "join") is None   # 过滤器判定没发过
+
+
+def test_remember_and_mark_delivered(store):
+    c = ServedCache(store, exclusive=True)
+    c.load()
+    c.remember("eu", "join", "https://l/2")
+    assert c.lookup("eu", "join") == ("https://l/2", False)
+    c.mark_delivered("eu", "join")
+    assert c.lookup("eu", "join") == ("https://l/2", True)
+    c.remember("eu", "other", None)            # 没有链接不记
+    assert c.lookup("eu", "other") is None
+
+
+def test_shared_store_always_queries(store, monkeypatch):
+    monkeypatch.setattr(store, "shared", True)
+    c = ServedCache(store)
+    c.load()
+    c.remember("eu", "join", "https://stale")
+    store.upsert_assignment("eu", "chat", "join", "https://l/3", None)
+    assert c.lookup("eu", "join") == ("https://l/3", False)
+
+
+def test_rows_written_by_another_process_are_not_missed(store):
+    """两个 worker 共用本地库：A 加载之后 B 发的券，A 仍能查到，不会重新建券"""
+    a = ServedCache(store)
+    a.load()
+    assert a.lookup("eu", "join") is None
+    store.upsert_assignment("eu", "chat", "join", "https://l/b", None)   # 另一个进程写入
+    assert a.lookup("eu", "join") == ("https://l/b", False)
+
+
+def test_undelivered_hit_is_rechecked(store):
+    a = ServedCache(store)
+    a.load()
+    a.remember("eu", "join", "https://l/1")
+    store.upsert_assignment("eu", "chat", "join", "https://l/1", None)
+    store.mark_delivered("eu", "join")                                  # 另一个进程送达
+    assert a.lookup("eu", "join") == ("https://l/1", True)
@@ -0,0 +1,50 @@
+# tests/test_stats.py
+# -*- coding: utf-8 -*-
+import inventory
+import stats
+
+
+def _counters(con):
+    return sorted(tuple(r) for r in con.execute("SELECT scope, key, total, delivered FROM assignment_stats"))
+
+
+def _rebuilt(store):
+    with store.transaction() as con:
+        stats.rebuild(con)
+    return _counters(store.conn())
+
+
+def test_triggers_track_insert_update_delete(store):
+    for i in range(3):
+        store.upsert_assignment(f"eu{i}", "chatA" if i else "chatB", "join", f"https://l/{i}", None)
+    store.mark_delivered("eu1", "join")
+    s = store.assignment_stats()
+    assert (s["total"], s["delivered"], s["undelivered"]) == (3, 1, 2)
+    assert s["by_chat"][0] == {"chat_id": "chatA", "total": 2, "delivered": 1}
+    assert sum(d["total"] for d in s["by_day"]) == 3
+
+    store.conn().execute("DELETE FROM assignments WHERE external_userid='eu1'")
+    assert store.assignment_stats()["delivered"] == 0
+    live = _counters(store.conn())
+    assert live == _rebuilt(store)
+
+
+def test_upsert_of_existing_row_is_not_double_counted(store):
+    store.upsert_assignment("eu", "chat", "join", "https://l/1", None)
+    store.upsert_assignment("eu", "chat", "join", "https://l/2", None)
+    assert store.assignment_stats()["total"] == 1
+
+
+def test_inventory_stats_follow_claims(store):
+    store.insert_inventory([("https://a", "", "", "csv"), ("https://b", "", "", "pass2u")])
+    row = store.claim_inventory("eu", "chat", source="csv")
+    store.mark_inventory_delivered(row["download_link"])
+    s = store.inventory_stats()
+    assert (s["unassigned"], s["assigned"], s["delivered"]) == (1, 1, 1)
+    assert s["by_source"]["pass2u"] == {"unassigned": 1, "assigned": 0, "delivered": 0}
+
+    con = store.inventory_db.conn()
+    live = sorted(tuple(r) for r in con.execute("SELECT * FROM inventory_stats"))
+    with store.inventory_db.transaction() as tx:
+        inventory.rebuild_stats(tx)
+    assert live == sorted(tuple(r) for r in con.execute("SELECT * FROM inventory_stats"))
@@ -0,0 +1,128 @@
+# tests/test_storage.py
+# -*- coding: utf-8 -*-
+"""
+Storage 的并发语义：领取库存 / 补发行不重复、upsert 幂等、回调去重只有一个赢家
+SQLite 总是跑；PostgreSQL 需设置 PG_TEST_URL（会清空其中的业务表，只能指向测试库），未设置时跳过
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+PG_TEST_URL = os.getenv("PG_TEST_URL", "")
+PG_TABLES = "assignments, assignment_raw, assignment_stats, callback_dedup, inventory, inventory_stats"
+
+
+@pytest.fixture(params=["sqlite", "pg"])
+def backend(request):
+    if request.param == "sqlite":
+        yield request.getfixturevalue("store")
+        return
+    if not PG_TEST_URL:
+        pytest.skip("PG_TEST_URL 未设置")
+    pytest.importorskip("psycopg")
+    from pg_storage import PgStorage
+    s = PgStorage(PG_TEST_URL)
+    s.init_schema()
+    s.conn().execute(f"TRUNCATE {PG_TABLES} RESTART IDENTITY CASCADE")
+    yield s
+    s.db.close()
+
+
+def _parallel(n, fn):
+    """n 个线程同时起跑，返回各自结果"""
+    barrier = threading.Barrier(n)
+    out = [None] * n
+    errors = []
+
+    def run(i):
+        try:
+            barrier.wait()
+            out[i] = fn(i)
+        except Exception as e:  # 断言在主线程做
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors, errors
+    return out
+
+
+def _stock(s, n, source="pass2u"):
+    assert s.insert_inventory([(f"https://inv/{i}", "", "", source) for i in range(n)]) == n
+
+
+def test_concurrent_claim_inventory_never_double_assigns(backend):
+    _stock(backend, 40)
+
+    def drain(i):
+        got = []
+        while (row := backend.claim_inventory(f"eu{i}-{len(got)}", "chat")) is not None:
+            got.append(row["id"])
+        return got
+    claimed = [x for ids in _parallel(8, drain) for x in ids]
+    assert sorted(claimed) == list(range(1, 41))
+    assert backend.count_unassigned() == 0
+    assert backend.inventory_stats()["assigned"] == 40
+
+
+def test_concurrent_claim_inventory_many(backend):
+    _stock(backend, 25)
+    results = _parallel(6, lambda i: backend.claim_inventory_many([f"eu{i}-{j}" for j in range(5)], "chat"))
+    ids = [r["id"] for batch in results for r in batch if r]
+    assert len(ids) == len(set(ids)) == 25
+    assert sum(r is None for batch in results for r in batch) == 5
+
+
+def test_insert_inventory_skips_duplicate_links(backend):
+    _stock(backend, 3)
+    assert backend.insert_inventory([("https://inv/1", "", "", "pass2u"), ("https://inv/new", "", "", "pass2u")]) == 1
+
+
+def test_concurrent_upsert_is_idempotent(backend):
+    ids = _parallel(8, lambda i: backend.upsert_assignment("eu", "chat", "join", f"https://l/{i}", {"passId": i}))
+    assert len(set(ids)) == 1
+    link, delivered = backend.find_assignment("eu", "join")
+    assert link.startswith("https://l/") and not delivered
+    assert backend.assignment_stats()["total"] == 1
+    assert backend.load_raw(ids[0])["passId"] in range(8)
+
+
+def test_concurrent_claim_event_has_one_winner(backend):
+    now = time.time()
+    assert sum(_parallel(8, lambda i: backend.claim_event("evt", now, now - 60))) == 1
+    assert backend.event_seen("evt", now - 1)
+    assert not backend.claim_event("evt", now + 1, now - 60)          # 窗口内：重复
+    assert backend.claim_event("evt", now + 120, now + 60)            # 旧记录过期：重新登记
+    backend.forget_event("evt")
+    assert not backend.event_seen("evt", 0)
+
+
+def test_concurrent_claim_redelivery_hands_out_each_row_once(backend):
+    past = time.time() - 10
+    for i in range(20):
+        backend.upsert_assignment(f"eu{i}", "chat", "join", f"https://l/{i}", None)
+        backend.schedule_redelivery(f"eu{i}", "join", past)
+    assert backend.redelivery_backlog() == 20
+    now = time.time()
+    batches = _parallel(6, lambda i: backend.claim_redelivery(now, now + 300, 5))
+    ids = [r["id"] for b in batches for r in b]
+    assert len(ids) == len(set(ids)) == 20
+    backend.finish_redelivery(ids[0], True, None)
+    assert backend.redelivery_backlog() == 19
+
+
+def test_concurrent_claim_mint_hands_out_each_row_once(backend):
+    for i in range(12):
+        backend.upsert_assignment(f"eu{i}", "chat", "join", None, None)
+    backend.upsert_assignment("minted", "chat", "join", "https://l/m", None)
+    now = time.time()
+    batches = _parallel(4, lambda i: backend.claim_mint(now, now + 300, 5))
+    ids = [r["id"] for b in batches for r in b]
+    assert len(ids) == len(set(ids)) == 12
+    backend.defer_mint(ids[0], now - 1)
+    assert [r["id"] for r in backend.claim_mint(now, now + 300, 5)] == [ids[0]]
@@ -0,0 +1,129 @@
+# tests/test_wecom_api.py
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from wecom_api import TokenProvider, WeComAPI, template_list_cache
+
+
+class _Resp:
+    status_code = 200
+
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+@pytest.fixture
+def api(tmp_path):
+    tokens = TokenProvider("corp", "secret", db_path=str(tmp_path / "token.db"))
+    template_list_cache.clear()
+    yield WeComAPI(tokens)
+    template_list_cache.clear()
+
+
+def test_template_cache_cleared_after_mutation(api, monkeypatch):
+    def post(path, payload, **kw):
+        # 变更请求在途时，另一个线程的列表请求把旧列表写进了缓存
+        template_list_cache.set((0, 100), {"errcode": 0, "template_list": ["old"]})
+        return _Resp({"errcode": 0, "template_id": "tpl-1"})
+    monkeypatch.setattr(api, "_post", post)
+    assert api.create_group_welcome_template(text="hi") == "tpl-1"
+    assert template_list_cache.get((0, 100)) is None
+    api.delete_group_welcome_template("tpl-1")
+    assert template_list_cache.get((0, 100)) is None
+
+
+def test_template_cache_cleared_when_mutation_fails(api, monkeypatch):
+    def post(path, payload, **kw):
+        template_list_cache.set((0, 100), {"errcode": 0, "template_list": ["old"]})
+        raise ConnectionError("down")
+    monkeypatch.setattr(api, "_post", post)
+    with pytest.raises(ConnectionError):
+        api.delete_group_welcome_template("tpl-1")
+    assert template_list_cache.get((0, 100)) is None
+
+
+def test_template_list_is_cached(api, monkeypatch):
+    calls = []
+
+    def post(path, payload, **kw):
+        calls.append(path)
+        return _Resp({"errcode": 0, "template_list": []})
+    monkeypatch.setattr(api, "_post", post)
+    api.list_group_welcome_templates()
+    api.list_group_welcome_templates()
+    assert len(calls) == 1
+
+
+def test_kf_msgids_unique_under_concurrency():
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(32) as ex:
+        ids = list(ex.map(lambda i: WeComAPI._kf_text_payload(f"eu{i}", "hi")["msgid"], range(2000)))
+    assert len(set(ids)) == len(ids)
+
+
+def test_token_cache_is_keyed_by_api_base(tmp_path, monkeypatch):
+    path = str(tmp_path / "token.db")
+    mock = TokenProvider("corp", "secret", db_path=path, api_base="http://127.0.0.1:9001/cgi-bin")
+    prod = TokenProvider("corp", "secret", db_path=path, api_base="https://qyapi.weixin.qq.com/cgi-bin")
+    monkeypatch.setattr(mock, "_fetch", lambda: ("mock-token", 9e12))
+    monkeypatch.setattr(prod, "_fetch", lambda: ("prod-token", 9e12))
+    assert mock.get() == "mock-token"
+    assert prod.get() == "prod-token"
+
+    # 同一地址的另一个进程（新实例）直接读共享缓存，不再 gettoken
+    other = TokenProvider("corp", "secret", db_path=path, api_base="http://127.0.0.1:9001/cgi-bin")
+    monkeypatch.setattr(other, "_fetch", lambda: pytest.fail("should reuse the cached token"))
+    assert other.get() == "mock-token"
+
+
+def _counting_provider(tmp_path, lifetime=7200.0):
+    p = TokenProvider("corp", "secret", db_path=str(tmp_path / "token.db"), refresh_ahead=300)
+    p.fetches = 0
+
+    def fetch():
+        p.fetches += 1
+        time.sleep(0.02)
+        return f"t{p.fetches}", time.time() + lifetime
+    p._fetch = fetch
+    return p
+
+
+def test_concurrent_get_fetches_once(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    p = _counting_provider(tmp_path)
+    with ThreadPoolExecutor(16) as ex:
+        tokens = set(ex.map(lambda _: p.get(), range(64)))
+    assert tokens == {"t1"} and p.fetches == 1
+
+
+def test_refresh_ahead_serves_old_token_while_refreshing(tmp_path):
+    p = _counting_provider(tmp_path, lifetime=200)   # 已在提前刷新窗口内（剩余 < 300s）
+    assert p.get() == "t1"
+    assert p.get() == "t1"                          # 不阻塞，后台刷新
+    deadline = time.time() + 2
+    while p.fetches < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert p.fetches >= 2
+
+
+def test_invalidate_refreshes_only_the_stale_token(tmp_path):
+    p = _counting_provider(tmp_path)
+    assert p.get() == "t1"
+    p.invalidate("t1")
+    assert p.get() == "t2"
+    p.invalidate("t1")                              # 旧的已被换掉：不再刷新
+    assert p.fetches == 2
+
+
+def test_contact_url_is_cached(mocks):
+    api = WeComAPI(mocks.tokens)
+    first = api.kf_add_contact_url("eu-cached", scene="s")
+    assert api.kf_add_contact_url("eu-cached", scene="s") == first
+    assert mocks.wecom.calls["/cgi-bin/kf/add_contact"] == 1
+    api.kf_add_contact_url("eu-cached", scene="other")  # 场景不同：单独缓存
+    assert mocks.wecom.calls["/cgi-bin/kf/add_contact"] == 2
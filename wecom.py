@@ -2,16 +2,17 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
-from dotenv import load_dotenv
 
-# 同目录读取 .env（可选，但有它更稳）
-load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
+import env  # 同目录读取 .env（可选，但有它更稳）
 
 import argparse
 import json
 import sys
+import threading
 
-from wecom_api import WeComAPI   # 确保 wecom_api.py 与本文件同目录
+from wecom_api import WeComAPI, is_throttled   # 确保 wecom_api.py 与本文件同目录
+from ratelimit import limiter, TokenBucket, ThrottledError
+import bulk
 
 # 下面是你的命令实现……
 def cmd_token(_):
@@ -63,7 +64,7 @@ def cmd_welcome_send(args):
 
 def cmd_welcome_list(args):
     api = WeComAPI()
-    resp = api.list_group_welcome_templates(offset=args.offset, limit=args.limit)
+    resp = api.list_group_welcome_templates(offset=args.offset, limit=args.limit, use_cache=not args.refresh)
     print(json.dumps(resp, ensure_ascii=False, indent=2))
 
 def cmd_welcome_del(args):
@@ -73,6 +74,182 @@ def cmd_welcome_del(args):
     if resp.get("errcode") not in (0, None):
         sys.exit(1)
 
+def cmd_inventory_import(args):
+    import app
+    import inventory
+    app.init_db()
+    def progress(c):
+        print(f"\r已处理 {c['rows']} 行：新增 {c['inserted']}，重复 {c['skipped']}，无效 {c['invalid']}",
+              end="", file=sys.stderr, flush=True)
+    counts = inventory.import_csv(args.file, app.store.insert_inventory, batch_size=args.batch, progress=progress)
+    print(file=sys.stderr)
+    print(json.dumps(counts, ensure_ascii=False))
+
+# ---------- 批量：共享一个客户端 / token，并发执行，断点续跑 ----------
+def _run_bulk(args, path: str, fn):
+    """path 为该命令对应的接口（--rate 覆盖其令牌桶）；fn(api, row) -> 结果 dict"""
+    if args.rate:
+        limiter.buckets[path] = TokenBucket(rate=args.rate, burst=args.rate)
+    api = WeComAPI()
+    api.access_token()  # 先取一次 token，避免并发线程同时去刷新
+    checkpoint = bulk.Checkpoint(args.checkpoint or f"{args.file}.{args.cmd}.done")
+    out = open(args.out, "a", encoding="utf-8") if args.out else sys.stdout
+    try:
+        counts = bulk.run(bulk.read_rows(args.file), lambda row: fn(api, row), out, checkpoint,
+                          concurrency=args.concurrency, retries=args.retries, progress=bulk.print_progress)
+    finally:
+        checkpoint.close()
+        if args.out:
+            out.close()
+    print(file=sys.stderr)
+    print(json.dumps(counts, ensure_ascii=False), file=sys.stderr)
+    if counts["failed"]:
+        sys.exit(1)
+
+def _wecom_result(resp: dict, what: str) -> dict:
+    if is_throttled(resp):
+        raise ThrottledError(f"{what} throttled: {resp}")
+    return {"ok": resp.get("errcode") in (0, None), "resp": resp}
+
+def cmd_kf_text_bulk(args):
+    def send(api, row):
+        if not row.get("user"):
+            return {"ok": False, "error": "missing user"}
+        return _wecom_result(api.kf_send_text(row["user"], row.get("text") or args.text or ""), "kf_send_text")
+    _run_bulk(args, "kf/send_msg", send)
+
+def cmd_welcome_send_bulk(args):
+    def send(api, row):
+        if not row.get("user") or not row.get("chat"):
+            return {"ok": False, "error": "missing user or chat"}
+        resp = api.send_group_welcome(chat_id=row["chat"], external_userid=row["user"],
+                                      template_id=row.get("tpl") or args.tpl)
+        return _wecom_result(resp, "send_group_welcome")
+    _run_bulk(args, "externalcontact/group_welcome_template/send", send)
+
+def cmd_kf_link_bulk(args):
+    def link(api, row):
+        if not row.get("user"):
+            return {"ok": False, "error": "missing user"}
+        url = api.kf_add_contact_url(row["user"], scene=row.get("scene") or args.scene)
+        return {"ok": bool(url), "url": url}
+    _run_bulk(args, "kf/add_contact", link)
+
+# ---------- 回调日志重放：补处理故障期间漏掉的入群 ----------
+def cmd_journal_replay(args):
+    import app
+    import journal
+    from ratelimit import jittered_backoff
+
+    for key, rate in (("pass2u", args.pass2u_rate), ("kf/send_msg", args.kf_rate)):
+        if rate:
+            limiter.buckets[key] = TokenBucket(rate=rate, burst=rate)
+    app.create_app(serve=False)  # 建表 + 出站客户端；不启动后台线程
+    app.served.load()  # 过滤器就绪后，没发过券的成员判定不查库
+    scene = "wecom_group_join"
+    claimed: set = set()  # 本次已处理 / 正在处理的成员（同一人出现在多个事件里只处理一次）
+    failed: set = set()   # 本次处理失败的成员：券可能已建好，重试时不能因“已有券”被跳过
+    lock = threading.Lock()
+
+    def events():
+        for rec in journal.read(journal.segments(args.dir)):
+            if rec.get("event") != "change_external_chat" or rec.get("change_type") != "add_member":
+                continue
+            if (args.since and rec["ts"] < args.since) or (args.until and rec["ts"] >= args.until):
+                continue
+            yield {"ts": rec["ts"], "chat_id": rec.get("chat_id"), "members": rec.get("members") or []}
+
+    def replay(ev):
+        # 已有券（assignments 里有链接）的成员跳过
+        todo = []
+        for eu in ev["members"]:
+            with lock:
+                if eu in claimed:
+                    continue
+                claimed.add(eu)
+            if eu in failed or app.served.lookup(eu, scene) is None:
+                todo.append(eu)
+        if args.dry_run or not todo:
+            return {"ok": True, "pending" if args.dry_run else "processed": len(todo)}
+        results = [app._run_member(eu, ev["chat_id"], scene, False) for eu in todo]
+        writes = [w for ws, _ in results for w in ws]
+        deferred = False
+        try:
+            app.apply_writes(writes)
+        except Exception as e:
+            # 券已建好、私聊已发：写操作交给服务的任务队列重放，不能让成员停在 claimed 丢掉这些结果
+            try:
+                app.defer_writes(writes)
+                deferred = True
+            except Exception:
+                with lock:
+                    claimed.difference_update(todo)
+                    failed.update(todo)
+                return {"ok": False, "processed": 0, "errors": [repr(e)]}
+        with lock:
+            for eu, (_, err) in zip(todo, results):
+                if err is None:
+                    failed.discard(eu)
+                else:
+                    claimed.discard(eu)
+                    failed.add(eu)
+        errors = [err for _, err in results if err is not None]
+        throttled = [e for e in errors if isinstance(e, ThrottledError)]
+        if throttled:
+            # 整个事件重试：已成功的成员下次会被跳过
+            raise ThrottledError(str(throttled[0]), retry_after=throttled[0].retry_after
+                                 or jittered_backoff(1, base=1.0))
+        return {"ok": not errors, "processed": len(todo) - len(errors),
+                **({"deferred_writes": True} if deferred else {}),
+                **({"errors": [repr(e) for e in errors]} if errors else {})}
+
+    out = open(args.out, "a", encoding="utf-8") if args.out else sys.stdout
+    try:
+        counts = bulk.run(events(), replay, out, bulk.Checkpoint(None), concurrency=args.concurrency,
+                          retries=args.retries, progress=bulk.print_progress)
+    finally:
+        if args.out:
+            out.close()
+    print(file=sys.stderr)
+    print(json.dumps(counts, ensure_ascii=False), file=sys.stderr)
+    if counts["failed"]:
+        sys.exit(1)
+
+# ---------- 冷热分层：老数据压缩、归档、归还空闲页 ----------
+def cmd_retention_run(args):
+    import app
+    if app.store.shared:
+        sys.exit("STORAGE_URL 为共享库：归档只用于本地 SQLite")
+    app.init_db()
+    r = app.retention
+    if args.days is not None:
+        r.keep_days = args.days
+    if args.batch:
+        r.batch_size = args.batch
+    print(json.dumps(r.run_once(), ensure_ascii=False))
+
+def cmd_db_compact(args):
+    import app
+    from retention import enable_incremental_vacuum
+    changed = enable_incremental_vacuum(app.DB_PATH)
+    print("已切换 auto_vacuum=INCREMENTAL" if changed else "已是 INCREMENTAL，无需切换")
+
+# ---------- 部署：建表 / 迁移（gunicorn master 启动时调用一次） ----------
+def cmd_db_migrate(args):
+    import app
+    app.init_db()
+    print("schema ok")
+
+def _bulk_args(s, text: bool = False):
+    s.add_argument("--file", required=True, help="CSV（表头含 user 或 external_userid）或 .ndjson/.jsonl")
+    if text:
+        s.add_argument("--text", help="默认文案（行内 text 列优先）")
+    s.add_argument("--out", help="结果 NDJSON 追加写入的文件（默认 stdout）")
+    s.add_argument("--checkpoint", help="检查点文件（默认 <file>.<命令>.done），已成功的行重跑时跳过，失败的行会再试")
+    s.add_argument("--concurrency", type=int, default=8, help="并发数")
+    s.add_argument("--rate", type=float, help="每秒请求上限（覆盖 RATE_LIMITS 中该接口的配置）")
+    s.add_argument("--retries", type=int, default=3, help="被限流时的重试次数")
+
 def main():
     p = argparse.ArgumentParser(description="WeCom helper CLI")
     sub = p.add_subparsers(dest="cmd", required=True)
@@ -107,12 +284,55 @@ def main():
     s = sub.add_parser("welcome-list", help="列出欢迎语模板")
     s.add_argument("--offset", type=int, default=0)
     s.add_argument("--limit", type=int, default=100)
+    s.add_argument("--refresh", action="store_true", help="忽略缓存，重新拉取")
     s.set_defaults(func=cmd_welcome_list)
 
     s = sub.add_parser("welcome-del", help="删除欢迎语模板")
     s.add_argument("--tpl", required=True, help="template_id")
     s.set_defaults(func=cmd_welcome_del)
 
+    s = sub.add_parser("kf-text-bulk", help="批量 KF 私聊发文本")
+    _bulk_args(s, text=True)
+    s.set_defaults(func=cmd_kf_text_bulk)
+
+    s = sub.add_parser("welcome-send-bulk", help="批量发送群欢迎语（行需含 user、chat，可选 tpl）")
+    _bulk_args(s)
+    s.add_argument("--tpl", help="默认 template_id（行内 tpl 列优先）")
+    s.set_defaults(func=cmd_welcome_send_bulk)
+
+    s = sub.add_parser("kf-link-bulk", help="批量生成 KF 会话链接（行内 scene 列可选）")
+    _bulk_args(s)
+    s.add_argument("--scene", default="wecom_pass2u", help="默认 scene")
+    s.set_defaults(func=cmd_kf_link_bulk)
+
+    s = sub.add_parser("journal-replay", help="重放回调日志中的入群事件（跳过已有券的成员）")
+    s.add_argument("--dir", default=str(Path(__file__).with_name("journal")), help="回调日志目录（JOURNAL_DIR）")
+    s.add_argument("--since", type=float, help="起始时间（epoch 秒，含）")
+    s.add_argument("--until", type=float, help="截止时间（epoch 秒，不含）")
+    s.add_argument("--concurrency", type=int, default=32, help="并发处理的事件数")
+    s.add_argument("--pass2u-rate", type=float, help="Pass2U 建券每秒上限（覆盖 RATE_LIMITS）")
+    s.add_argument("--kf-rate", type=float, help="KF 私聊每秒上限（覆盖 RATE_LIMITS）")
+    s.add_argument("--retries", type=int, default=5, help="被限流时的重试次数")
+    s.add_argument("--out", help="每个事件的处理结果 NDJSON（默认 stdout）")
+    s.add_argument("--dry-run", action="store_true", help="只统计需要补处理的成员，不建券不发送")
+    s.set_defaults(func=cmd_journal_replay)
+
+    s = sub.add_parser("retention-run", help="执行一轮归档（raw_resp 压缩 + 老数据搬入归档库 + incremental vacuum）")
+    s.add_argument("--days", type=float, help="保留天数（覆盖 RETENTION_DAYS）")
+    s.add_argument("--batch", type=int, help="每个事务的行数（覆盖 RETENTION_BATCH）")
+    s.set_defaults(func=cmd_retention_run)
+
+    s = sub.add_parser("db-compact", help="老库切换 auto_vacuum=INCREMENTAL（整库 VACUUM，需停服）")
+    s.set_defaults(func=cmd_db_compact)
+
+    s = sub.add_parser("db-migrate", help="建表 / 迁移（多进程部署时由 master 启动前执行一次）")
+    s.set_defaults(func=cmd_db_migrate)
+
+    s = sub.add_parser("inventory-import", help="流式导入库存 CSV（download_link 去重）")
+    s.add_argument("--file", required=True, help="CSV 路径，需含 download_link 列")
+    s.add_argument("--batch", type=int, default=5000, help="每个事务的行数")
+    s.set_defaults(func=cmd_inventory_import)
+
     args = p.parse_args()
     args.func(args)
 
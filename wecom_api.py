@@ -3,90 +3,244 @@
 from __future__ import annotations
 
 from pathlib import Path
-from dotenv import load_dotenv
-load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
 
+import env  # 先加载 .env
+
+import asyncio
+import hashlib
+import json
 import os
+import sqlite3
+import threading
 import time
+import uuid
 import requests
-from functools import lru_cache
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
+
+from ratelimit import limiter, ThrottledError, WECOM_THROTTLE_CODES
+from metrics import timed
+import eventlog
+from async_http import aiohttp, get_session
+from cache import TTLCache, PersistentTTLCache
+from db import Database
 
 CORP_ID: str = os.getenv("WECHAT_CORP_ID", "")
 CORP_SECRET: str = os.getenv("WECHAT_CORP_SECRET", "")
 OPEN_KFID: str = os.getenv("WECHAT_OPEN_KFID", "")
 WELCOME_TPL_ID: str = os.getenv("WECOM_GROUP_WELCOME_TEMPLATE_ID", "")
+# 可指向本地 mock（bench/mock_servers.py）
+API_BASE: str = os.getenv("WECOM_API_BASE", "https://qyapi.weixin.qq.com/cgi-bin").rstrip("/")
+
+# access_token 跨进程共享：同机所有 gunicorn worker / CLI 读同一个 SQLite 文件
+TOKEN_DB_PATH: str = os.getenv("WECOM_TOKEN_DB", str(Path(__file__).with_name("token_cache.db")))
+TOKEN_REFRESH_AHEAD: float = float(os.getenv("WECOM_TOKEN_REFRESH_AHEAD", "600"))  # 到期前多久开始后台刷新
+TOKEN_EXPIRED_CODES = {40014, 42001}  # invalid / expired access_token
 
+# 结果缓存：KF 会话链接、欢迎语模板列表（WECOM_CACHE_DB 有值时另存 SQLite，CLI / 重启后也能命中）
+CACHE_DB_PATH: str = os.getenv("WECOM_CACHE_DB", "")
+CONTACT_URL_TTL: float = float(os.getenv("WECOM_CONTACT_URL_TTL", "86400"))
+CONTACT_URL_CACHE_SIZE: int = int(os.getenv("WECOM_CONTACT_URL_CACHE_SIZE", "10000"))
+TEMPLATE_LIST_TTL: float = float(os.getenv("WECOM_TEMPLATE_LIST_TTL", "300"))
 
-class WeComAPI:
-    def __init__(self):
+
+class TokenProvider:
+    """
+    线程安全、跨进程共享、提前刷新的 access_token
+    - 进程内：内存快路径 + 锁，同一时刻只有一个线程去刷新
+    - 跨进程：SQLite BEGIN IMMEDIATE 串行化，先拿到写锁的进程调 gettoken，其余直接读结果
+    - 进入提前刷新窗口后由后台线程刷新，请求线程继续用旧 token
+    """
+
+    def __init__(self, corp_id: str, corp_secret: str, db_path: str = TOKEN_DB_PATH,
+                 refresh_ahead: float = TOKEN_REFRESH_AHEAD, api_base: str = API_BASE):
+        self.corp_id = corp_id
+        self.corp_secret = corp_secret
+        self.db_path = db_path
+        self.refresh_ahead = refresh_ahead
+        self.api_base = api_base
+        # 键含 API 地址：压测替身（WECOM_API_BASE 指向 mock）发的 token 不会被生产读到
+        self.key = hashlib.sha1(f"{api_base}|{corp_id}:{corp_secret}".encode("utf-8")).hexdigest()
         self.s = requests.Session()
+        self._lock = threading.Lock()
+        self._token: Optional[str] = None
+        self._expire_at = 0.0
+        self._bg_running = False
+        self._schema_ready = False
 
-    # ---------- token ----------
-    @lru_cache(maxsize=1)
-    def _cached_token(self) -> Dict[str, Any]:
-        return {"token": self._fetch_token(), "expire_at": time.time() + 6600}
+    def _conn(self):
+        con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        if not self._schema_ready:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS wecom_token (
+                    app_key TEXT PRIMARY KEY,
+                    token TEXT NOT NULL,
+                    expire_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._schema_ready = True
+        return con
 
-    def _fetch_token(self) -> str:
+    @timed("token_fetch", call=True)
+    def _fetch(self) -> Tuple[str, float]:
         r = self.s.get(
-            "https://qyapi.weixin.qq.com/cgi-bin/gettoken",
-            params={"corpid": CORP_ID, "corpsecret": CORP_SECRET},
+            f"{self.api_base}/gettoken",
+            params={"corpid": self.corp_id, "corpsecret": self.corp_secret},
             timeout=10,
         )
         data = r.json()
         if data.get("errcode") != 0:
             raise RuntimeError(f"gettoken failed: {data}")
-        return data["access_token"]
+        return data["access_token"], time.time() + int(data.get("expires_in") or 7200)
 
-    def access_token(self) -> str:
-        c = self._cached_token()
-        if time.time() >= c["expire_at"]:
-            self._cached_token.cache_clear()
-            c = self._cached_token()
-        return c["token"]
+    def _refresh(self, stale: Optional[str] = None):
+        """跨进程刷新：共享记录仍新鲜（且不是已知失效的那个）就直接复用"""
+        con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                row = con.execute("SELECT token, expire_at FROM wecom_token WHERE app_key=?",
+                                  (self.key,)).fetchone()
+                if row and row[0] != stale and time.time() < row[1] - self.refresh_ahead:
+                    token, expire_at = row
+                else:
+                    token, expire_at = self._fetch()
+                    con.execute("""
+                        INSERT INTO wecom_token (app_key, token, expire_at, updated_at) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(app_key) DO UPDATE SET
+                          token=excluded.token, expire_at=excluded.expire_at, updated_at=excluded.updated_at
+                    """, (self.key, token, expire_at, time.time()))
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+        finally:
+            con.close()
+        self._token, self._expire_at = token, expire_at
 
-    # ---------- 客服：1:1 发文本 ----------
-    def kf_send_text(self, external_userid: str, content: str) -> Dict[str, Any]:
-        if not OPEN_KFID:
-            return {"errcode": -1, "errmsg": "OPEN_KFID not set (env WECHAT_OPEN_KFID)"}
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.access_token()}"
-        payload = {
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                if time.time() >= self._expire_at - self.refresh_ahead:
+                    self._refresh()
+        except Exception as e:
+            eventlog.error("token_refresh_failed", exc=e)
+        finally:
+            self._bg_running = False
+
+    def peek(self) -> Optional[str]:
+        """不阻塞：内存里的 token 仍可用就返回，否则 None（异步客户端先走这里，必要时再去线程里 get）"""
+        token, expire_at = self._token, self._expire_at
+        now = time.time()
+        if token and now < expire_at - self.refresh_ahead:
+            return token
+        if token and now < expire_at - 60:
+            # 提前刷新窗口：后台刷新，本次继续用旧 token
+            if not self._bg_running:
+                self._bg_running = True
+                threading.Thread(target=self._background_refresh, name="wecom-token", daemon=True).start()
+            return token
+        return None
+
+    def get(self) -> str:
+        token = self.peek()
+        if token:
+            return token
+        with self._lock:
+            if self._token and time.time() < self._expire_at - 60:
+                return self._token
+            self._refresh()
+            return self._token  # type: ignore[return-value]
+
+    def invalidate(self, stale: str):
+        """接口返回 token 失效：丢弃该 token，下次 get 强制刷新（其他线程/进程已换新的则直接复用）"""
+        with self._lock:
+            if self._token == stale:
+                self._refresh(stale=stale)
+
+
+_providers: Dict[Tuple[str, str], TokenProvider] = {}
+_providers_lock = threading.Lock()
+
+
+def get_token_provider(corp_id: str = CORP_ID, corp_secret: str = CORP_SECRET) -> TokenProvider:
+    """同一进程内同一应用只保留一个 TokenProvider"""
+    with _providers_lock:
+        p = _providers.get((corp_id, corp_secret))
+        if p is None:
+            p = _providers[(corp_id, corp_secret)] = TokenProvider(corp_id, corp_secret)
+        return p
+
+
+def is_throttled(data: Any) -> bool:
+    """接口返回限频错误（45009/45011/45033）"""
+    return isinstance(data, dict) and data.get("errcode") in WECOM_THROTTLE_CODES
+
+
+def _errcode(text: str) -> Optional[int]:
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    return data.get("errcode") if isinstance(data, dict) else None
+
+
+_NO_KFID = {"errcode": -1, "errmsg": "OPEN_KFID not set (env WECHAT_OPEN_KFID)"}
+_NO_TPL = {"errcode": -1, "errmsg": "WELCOME_TPL_ID not set"}
+
+
+def _make_cache(table: str, maxsize: int, ttl: float) -> TTLCache:
+    if CACHE_DB_PATH:
+        return PersistentTTLCache(Database(CACHE_DB_PATH), table, maxsize=maxsize, ttl=ttl)
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+# 进程内所有客户端（同步 / 异步）共用
+contact_url_cache = _make_cache("wecom_contact_url_cache", CONTACT_URL_CACHE_SIZE, CONTACT_URL_TTL)
+template_list_cache = _make_cache("wecom_template_list_cache", 64, TEMPLATE_LIST_TTL)
+
+
+class _WeComCore:
+    """请求构造 / 结果解析：同步、异步客户端共用，只有发送方式不同"""
+
+    def __init__(self, tokens: Optional[TokenProvider] = None):
+        self.tokens = tokens or get_token_provider()
+
+    @staticmethod
+    def _kf_text_payload(external_userid: str, content: str) -> Dict[str, Any]:
+        return {
             "touser": external_userid,
             "open_kfid": OPEN_KFID,
-            "msgid": str(int(time.time() * 1000)),
+            "msgid": uuid.uuid4().hex,  # 成员线程池 / 批量并发发送时毫秒时间戳会撞
             "msgtype": "text",
             "text": {"content": content},
         }
-        return self.s.post(url, json=payload, timeout=10).json()
 
-    # ---------- 客服：生成“开启会话”链接 ----------
-    def kf_add_contact_url(self, external_userid: str, scene: str = "wecom_pass2u") -> Optional[str]:
+    @staticmethod
+    def _add_contact_payload(external_userid: str, scene: str) -> Dict[str, Any]:
         if not OPEN_KFID:
             raise RuntimeError("OPEN_KFID not set (env WECHAT_OPEN_KFID)")
+        return {"open_kfid": OPEN_KFID, "external_userid": external_userid, "scene": scene}
 
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/add_contact?access_token={self.access_token()}"
-        payload = {"open_kfid": OPEN_KFID, "external_userid": external_userid, "scene": scene}
-        r = self.s.post(url, json=payload, timeout=10)
+    @staticmethod
+    def _add_contact_result(status: int, text: str) -> Optional[str]:
         try:
-            data = r.json()
+            data = json.loads(text)
         except ValueError:
             # 返回了非 JSON（例如 401/403/502 的 HTML 等），直接抛原文以便定位
             raise RuntimeError(
-                f"kf.add_contact non-JSON response: status={r.status_code}, text={r.text[:200]!r}"
+                f"kf.add_contact non-JSON response: status={status}, text={text[:200]!r}"
             )
+        if is_throttled(data):
+            raise ThrottledError(f"kf.add_contact throttled: {data}")
         if data.get("errcode") != 0:
             # 常见：40096 invalid external_userid
             raise RuntimeError(f"kf.add_contact failed: {data}")
         return data.get("url")
 
-    # ---------- 客户群欢迎语模板（固定文案场景） ----------
-    def create_group_welcome_template(
-        self,
-        text: Optional[str] = None,
-        link: Optional[Dict[str, str]] = None,
-        miniprogram: Optional[Dict[str, str]] = None,
-    ) -> str:
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/externalcontact/group_welcome_template/add?access_token={self.access_token()}"
+    @staticmethod
+    def _template_payload(text: Optional[str], link: Optional[Dict[str, str]],
+                          miniprogram: Optional[Dict[str, str]]) -> Dict[str, Any]:
         payload: Dict[str, Any] = {}
         if text:
             payload["text"] = {"content": text}
@@ -94,23 +248,189 @@ class WeComAPI:
             payload["link"] = link
         if miniprogram:
             payload["miniprogram"] = miniprogram
-        data = self.s.post(url, json=payload, timeout=10).json()
+        return payload
+
+    @staticmethod
+    def _template_id(data: Dict[str, Any]) -> str:
         if data.get("errcode") != 0:
             raise RuntimeError(f"create welcome template failed: {data}")
         return data["template_id"]
 
-    def list_group_welcome_templates(self, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/externalcontact/group_welcome_template/get?access_token={self.access_token()}"
-        return self.s.post(url, json={"offset": offset, "limit": limit}, timeout=10).json()
+    @staticmethod
+    def _welcome_payload(chat_id: str, external_userid: str, template_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        tpl_id = template_id or WELCOME_TPL_ID
+        if not tpl_id:
+            return None
+        return {"template_id": tpl_id, "chat_id": chat_id, "external_userid": external_userid}
+
+
+class WeComAPI(_WeComCore):
+    def __init__(self, tokens: Optional[TokenProvider] = None):
+        super().__init__(tokens)
+        self.s = requests.Session()
+
+    # ---------- token ----------
+    def access_token(self) -> str:
+        return self.tokens.get()
+
+    def _post(self, path: str, payload: Dict[str, Any], timeout: float = 10,
+              stage: Optional[str] = None) -> requests.Response:
+        """带 access_token 调用；按接口令牌桶限流；遇到 token 失效（40014/42001）刷新后重试一次"""
+        limiter.acquire(path)
+        with timed(stage or path, call=True) as t:
+            token = self.access_token()
+            r = self.s.post(f"{API_BASE}/{path}",
+                            params={"access_token": token}, json=payload, timeout=timeout)
+            code = _errcode(r.text)
+            if code in TOKEN_EXPIRED_CODES:
+                self.tokens.invalidate(token)
+                r = self.s.post(f"{API_BASE}/{path}",
+                                params={"access_token": self.access_token()}, json=payload, timeout=timeout)
+                code = _errcode(r.text)
+            if code not in (0, None) or r.status_code >= 400:
+                t.fail(status=r.status_code, errcode=code)
+        return r
+
+    # ---------- 客服：1:1 发文本 ----------
+    def kf_send_text(self, external_userid: str, content: str) -> Dict[str, Any]:
+        if not OPEN_KFID:
+            return dict(_NO_KFID)
+        payload = self._kf_text_payload(external_userid, content)
+        return self._post("kf/send_msg", payload, stage="kf_send_text").json()
+
+    # ---------- 客服：生成“开启会话”链接 ----------
+    def kf_add_contact_url(self, external_userid: str, scene: str = "wecom_pass2u") -> Optional[str]:
+        payload = self._add_contact_payload(external_userid, scene)
+        key = (OPEN_KFID, external_userid, scene)
+        url = contact_url_cache.get(key)
+        if url:
+            return url
+        r = self._post("kf/add_contact", payload, stage="kf_add_contact_url")
+        url = self._add_contact_result(r.status_code, r.text)
+        if url:
+            contact_url_cache.set(key, url)
+        return url
+
+    # ---------- 客户群欢迎语模板（固定文案场景） ----------
+    def create_group_welcome_template(
+        self,
+        text: Optional[str] = None,
+        link: Optional[Dict[str, str]] = None,
+        miniprogram: Optional[Dict[str, str]] = None,
+    ) -> str:
+        payload = self._template_payload(text, link, miniprogram)
+        try:
+            return self._template_id(self._post("externalcontact/group_welcome_template/add", payload).json())
+        finally:
+            template_list_cache.clear()  # 在变更之后清：中间插进来的列表请求不会把旧列表缓存下来
+
+    def list_group_welcome_templates(self, offset: int = 0, limit: int = 100, use_cache: bool = True) -> Dict[str, Any]:
+        hit = template_list_cache.get((offset, limit)) if use_cache else None
+        if hit is not None:
+            return hit
+        data = self._post("externalcontact/group_welcome_template/get", {"offset": offset, "limit": limit}).json()
+        if data.get("errcode") == 0:
+            template_list_cache.set((offset, limit), data)
+        return data
 
     def delete_group_welcome_template(self, template_id: str) -> Dict[str, Any]:
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/externalcontact/group_welcome_template/del?access_token={self.access_token()}"
-        return self.s.post(url, json={"template_id": template_id}, timeout=10).json()
+        try:
+            return self._post("externalcontact/group_welcome_template/del", {"template_id": template_id}).json()
+        finally:
+            template_list_cache.clear()
 
     def send_group_welcome(self, chat_id: str, external_userid: str, template_id: Optional[str] = None) -> Dict[str, Any]:
-        tpl_id = template_id or WELCOME_TPL_ID
-        if not tpl_id:
-            return {"errcode": -1, "errmsg": "WELCOME_TPL_ID not set"}
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/externalcontact/group_welcome_template/send?access_token={self.access_token()}"
-        payload = {"template_id": tpl_id, "chat_id": chat_id, "external_userid": external_userid}
-        return self.s.post(url, json=payload, timeout=10).json()
+        payload = self._welcome_payload(chat_id, external_userid, template_id)
+        if payload is None:
+            return dict(_NO_TPL)
+        return self._post("externalcontact/group_welcome_template/send", payload, stage="send_group_welcome").json()
+
+
+class AsyncWeComAPI(_WeComCore):
+    """
+    协程版 WeComAPI（同样的方法，均需 await），走 async_http 的共享 aiohttp 连接池
+    - token 与同步版共用 TokenProvider：内存命中不阻塞，需要刷新时放到线程里做
+    - 限流与同步版共用令牌桶
+    """
+
+    async def access_token(self) -> str:
+        return self.tokens.peek() or await asyncio.to_thread(self.tokens.get)
+
+    async def _send(self, path: str, token: str, payload: Dict[str, Any], timeout: float) -> Tuple[int, str]:
+        async with get_session().post(f"{API_BASE}/{path}", params={"access_token": token}, json=payload,
+                                      timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            return r.status, await r.text()
+
+    async def _post(self, path: str, payload: Dict[str, Any], timeout: float = 10,
+                    stage: Optional[str] = None) -> Tuple[int, str]:
+        """返回 (HTTP 状态码, 响应文本)；限流 / token 失效重试与同步版一致"""
+        await limiter.acquire_async(path)
+        with timed(stage or path, call=True) as t:
+            token = await self.access_token()
+            status, text = await self._send(path, token, payload, timeout)
+            code = _errcode(text)
+            if code in TOKEN_EXPIRED_CODES:
+                await asyncio.to_thread(self.tokens.invalidate, token)
+                status, text = await self._send(path, await self.access_token(), payload, timeout)
+                code = _errcode(text)
+            if code not in (0, None) or status >= 400:
+                t.fail(status=status, errcode=code)
+        return status, text
+
+    async def _post_json(self, path: str, payload: Dict[str, Any], stage: Optional[str] = None) -> Dict[str, Any]:
+        _, text = await self._post(path, payload, stage=stage)
+        return json.loads(text)
+
+    async def kf_send_text(self, external_userid: str, content: str) -> Dict[str, Any]:
+        if not OPEN_KFID:
+            return dict(_NO_KFID)
+        payload = self._kf_text_payload(external_userid, content)
+        return await self._post_json("kf/send_msg", payload, stage="kf_send_text")
+
+    async def kf_add_contact_url(self, external_userid: str, scene: str = "wecom_pass2u") -> Optional[str]:
+        payload = self._add_contact_payload(external_userid, scene)
+        key = (OPEN_KFID, external_userid, scene)
+        url = contact_url_cache.get(key)
+        if url:
+            return url
+        status, text = await self._post("kf/add_contact", payload, stage="kf_add_contact_url")
+        url = self._add_contact_result(status, text)
+        if url:
+            contact_url_cache.set(key, url)
+        return url
+
+    async def create_group_welcome_template(
+        self,
+        text: Optional[str] = None,
+        link: Optional[Dict[str, str]] = None,
+        miniprogram: Optional[Dict[str, str]] = None,
+    ) -> str:
+        payload = self._template_payload(text, link, miniprogram)
+        try:
+            return self._template_id(await self._post_json("externalcontact/group_welcome_template/add", payload))
+        finally:
+            template_list_cache.clear()  # 同步版：变更之后再清
+
+    async def list_group_welcome_templates(self, offset: int = 0, limit: int = 100,
+                                           use_cache: bool = True) -> Dict[str, Any]:
+        hit = template_list_cache.get((offset, limit)) if use_cache else None
+        if hit is not None:
+            return hit
+        data = await self._post_json("externalcontact/group_welcome_template/get", {"offset": offset, "limit": limit})
+        if data.get("errcode") == 0:
+            template_list_cache.set((offset, limit), data)
+        return data
+
+    async def delete_group_welcome_template(self, template_id: str) -> Dict[str, Any]:
+        try:
+            return await self._post_json("externalcontact/group_welcome_template/del", {"template_id": template_id})
+        finally:
+            template_list_cache.clear()
+
+    async def send_group_welcome(self, chat_id: str, external_userid: str,
+                                 template_id: Optional[str] = None) -> Dict[str, Any]:
+        payload = self._welcome_payload(chat_id, external_userid, template_id)
+        if payload is None:
+            return dict(_NO_TPL)
+        return await self._post_json("externalcontact/group_welcome_template/send", payload,
+                                     stage="send_group_welcome")
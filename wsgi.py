@@ -0,0 +1,7 @@
+# wsgi.py
+# -*- coding: utf-8 -*-
+"""gunicorn 的应用入口；建表 / 迁移已由 master 启动时完成（见 gunicorn.conf.py）"""
+
+from app import create_app
+
+application = create_app(migrate=False)